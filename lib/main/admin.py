@@ -127,8 +127,18 @@ class GroupAdmin(admin.ModelAdmin):
 
 class VariableDataAdmin(admin.ModelAdmin):
 
+    # Read only, since the same variables are shared by hosts and groups in
+    # any inventory; they're changed through each host or group instead.
     list_display = ('name', 'description', 'active')
-    filter_horizontal = ('tags',)
+    fields = ('name', 'description', 'data', 'data_hash', 'active', 'tags',
+              'created_by')
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 class CredentialAdmin(admin.ModelAdmin):
 
@@ -158,7 +168,7 @@ class LaunchJobAdmin(admin.ModelAdmin):
         (None, {'fields': ('name', 'active', 'created_by', 'description',
                            'get_start_link_display', 'get_statuses_link_display')}),
         (_('Job Parameters'), {'fields': ('inventory', 'project', 'credential',
-                                          'user', 'job_type')}),
+                                          'user', 'job_type', 'slice_count')}),
         (_('Tags'), {'fields': ('tags',)}),
         (_('Audit Trail'), {'fields': ('creation_date', 'audit_trail',)}),
     )
@@ -215,17 +225,28 @@ class LaunchJobStatusEventInline(admin.StackedInline):
 class LaunchJobStatusAdmin(admin.ModelAdmin):
 
     list_display = ('name', 'launch_job', 'status')
-    fields = ('name', 'launch_job', 'status', 'result_stdout', 'result_stderr',
-              'result_traceback', 'celery_task_id', 'tags', 'created_by')
-    readonly_fields = ('name', 'description', 'status', 'launch_job',
-                       'result_stdout', 'result_stderr', 'result_traceback',
-                       'celery_task_id', 'created_by', 'tags', 'audit_trail', 'active')
+    fields = ('name', 'launch_job', 'status', 'priority', 'parent',
+              'slice_index', 'slice_count', 'scm_revision', 'result_stdout', 'result_stderr',
+              'result_stdout_file', 'result_stderr_file', 'result_traceback',
+              'celery_task_id', 'admitted', 'started', 'tags', 'created_by')
+    readonly_fields = ('name', 'description', 'status', 'launch_job', 'parent',
+                       'slice_index', 'slice_count', 'scm_revision', 'result_stdout',
+                       'result_stderr', 'result_stdout_file',
+                       'result_stderr_file', 'result_traceback',
+                       'celery_task_id', 'admitted', 'started', 'created_by', 'tags', 'audit_trail',
+                       'active')
     filter_horizontal = ('tags',)
     inlines = [LaunchJobStatusEventInline]
+    actions = ['cancel_launch_job_statuses']
 
     def has_add_permission(self, request):
         return False
 
+    def cancel_launch_job_statuses(self, request, queryset):
+        canceled = len([obj for obj in queryset if obj.cancel()])
+        messages.success(request, '%d launch job status(es) canceled.' % canceled)
+    cancel_launch_job_statuses.short_description = _('Cancel selected launch job statuses')
+
 # FIXME: Add the rest of the models...
 
 admin.site.register(Organization, OrganizationAdmin)
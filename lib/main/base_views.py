@@ -21,19 +21,141 @@ from lib.main.models import *
 from django.contrib.auth.models import User
 from lib.main.serializers import *
 from lib.main.rbac import *
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 from rest_framework import mixins
 from rest_framework import generics
 from rest_framework import permissions
 from rest_framework.response import Response
 from rest_framework import status
+from django.db.models import Q
+from rest_framework.templatetags.rest_framework import replace_query_param
+import base64
 import exceptions
+import hashlib
+import operator
 import datetime
 import json as python_json
 
 # FIXME: machinery for auto-adding audit trail logs to all CREATE/EDITS
 
-class BaseList(generics.ListCreateAPIView):
+def encode_cursor(values):
+    ''' return an opaque cursor for the ordering values of the last item in a page '''
+    return base64.urlsafe_b64encode(python_json.dumps(values))
+
+def decode_cursor(cursor, model, ordering):
+    '''
+    return the values of the model's ordering fields from a cursor, or raise
+    ValueError if it's invalid
+    '''
+    try:
+        values = python_json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise ValueError('invalid cursor')
+    # the values end up in a filter, so each has to suit its field
+    result = []
+    for field, value in zip(ordering, values):
+        if value is None or isinstance(value, (bool, list, dict)):
+            raise ValueError('invalid cursor')
+        try:
+            result.append(model._meta.get_field(field).to_python(value))
+        except (ValidationError, TypeError, ValueError):
+            raise ValueError('invalid cursor')
+    return result
+
+class ConditionalGetMixin(object):
+    '''
+    Adds an ETag to GET responses, and returns 304 Not Modified without
+    serializing anything when the client already has the current response.
+    The ETag changes whenever the view's model, one of etag_models or one of
+    the models permissions are checked against changes (see ModelVersion),
+    and differs by user, URL and requested format.  Views of models that
+    aren't counted (see MODEL_VERSION_MODELS) don't get ETags.
+    '''
+
+    # other models the response is built from
+    etag_models = ()
+
+    # models the permission filters read
+    permission_models = (User, Organization, Team, Permission, Inventory)
+
+    def get_etag_models(self):
+        if self.model not in MODEL_VERSION_MODELS:
+            return None
+        return set((self.model,) + tuple(self.etag_models) + self.permission_models)
+
+    def get_etag(self, request):
+        models = self.get_etag_models()
+        if models is None:
+            return None
+        key = python_json.dumps([request.get_full_path(), request.META.get('HTTP_ACCEPT', ''),
+                                 request.user.pk, ModelVersion.get_versions(models)])
+        return '"%s"' % hashlib.sha1(key).hexdigest()
+
+    def conditional_response(self, request, respond):
+        # get the ETag before the response, so it can't be newer than the data
+        etag = self.get_etag(request)
+        if etag is None:
+            return respond()
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+        etags = [x.strip().replace('W/', '', 1) for x in if_none_match.split(',')]
+        if etag in etags or '*' in etags:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = respond()
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+        return response
+
+class BaseList(ConditionalGetMixin, generics.ListCreateAPIView):
+
+    # fields used to order results when paging with ?cursor=, ending with a
+    # unique field
+    cursor_ordering = ('id',)
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(request, lambda: self._list(request, *args, **kwargs))
+
+    def _list(self, request, *args, **kwargs):
+        if 'cursor' in request.QUERY_PARAMS:
+            return self.cursor_list(request, *args, **kwargs)
+        return super(BaseList, self).list(request, *args, **kwargs)
+
+    def cursor_list(self, request, *args, **kwargs):
+        '''
+        Forward-only keyset pagination, used instead of page numbers when a
+        cursor parameter is given (empty for the first page).  Each page only
+        reads the rows after the cursor, however deep it is, and items added
+        while paging don't shift later pages.
+        '''
+        ordering = self.cursor_ordering
+        queryset = self.filter_queryset(self.get_queryset()).order_by(*ordering)
+        cursor = request.QUERY_PARAMS['cursor']
+        if cursor:
+            try:
+                values = decode_cursor(cursor, queryset.model, ordering)
+            except ValueError:
+                return Response(status=status.HTTP_400_BAD_REQUEST,
+                                data=dict(msg='invalid cursor'))
+            # rows that sort after the cursor: (a, b) > (x, y) when a > x, or
+            # a = x and b > y
+            terms = []
+            for n in xrange(len(ordering)):
+                term = Q(**{'%s__gt' % ordering[n]: values[n]})
+                for field, value in zip(ordering[:n], values[:n]):
+                    term &= Q(**{field: value})
+                terms.append(term)
+            queryset = queryset.filter(reduce(operator.or_, terms))
+        page_size = self.get_paginate_by()
+        items = list(queryset[:page_size + 1])
+        next_url = None
+        if len(items) > page_size:
+            items = items[:page_size]
+            last = [getattr(items[-1], field) for field in ordering]
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', encode_cursor(last))
+        serializer = self.get_serializer(items, many=True)
+        return Response(dict(next=next_url, previous=None, results=serializer.data))
 
     def list_permissions_check(self, request, obj=None):
         ''' determines some early yes/no access decisions, pre-filtering '''
@@ -41,7 +163,11 @@ class BaseList(generics.ListCreateAPIView):
              return True
         if request.method == 'POST':
              if self.__class__.model in [ User ]:
-                  ok = request.user.is_superuser or (request.user.admin_of_organizations.count() > 0)
+                  memberships = UserAccessCache.memberships_for(request.user)
+                  if memberships is not None:
+                      ok = request.user.is_superuser or bool(memberships.admin_of_organization_ids)
+                  else:
+                      ok = request.user.is_superuser or (request.user.admin_of_organizations.count() > 0)
                   if not ok:
                       raise PermissionDenied()
                   return True
@@ -55,11 +181,23 @@ class BaseList(generics.ListCreateAPIView):
         base = self._get_queryset()
         model = self.__class__.model
         if model == User:
-            return base.filter(is_active=True)
+            queryset = base.filter(is_active=True)
         elif model in [ Tag, AuditTrail ]:
-            return base
+            queryset = base
         else:
-            return self._get_queryset().filter(active=True)
+            queryset = base.filter(active=True)
+        return self.load_related(queryset)
+
+    def load_related(self, queryset):
+        ''' load the related objects the serializer needs along with the queryset '''
+        serializer_class = self.get_serializer_class()
+        select_related = getattr(serializer_class, 'select_related', ())
+        prefetch_related = getattr(serializer_class, 'prefetch_related', ())
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
 
 
 
@@ -152,7 +290,10 @@ class BaseSubList(BaseList):
                 raise PermissionDenied()
             if sub in relationship.all():
                 return Response(status=status.HTTP_409_CONFLICT)
-            relationship.add(sub)
+            try:
+                relationship.add(sub)
+            except ValidationError, e:
+                return Response(status=status.HTTP_400_BAD_REQUEST, data=dict(msg='; '.join(e.messages)))
         else:
             if not request.user.is_superuser and not self.__class__.parent_model.can_user_unattach(request.user, main, sub, self.__class__.relationship):
                 raise PermissionDenied()
@@ -166,7 +307,14 @@ class BaseSubList(BaseList):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class BaseDetail(generics.RetrieveUpdateDestroyAPIView):
+class BaseDetail(ConditionalGetMixin, generics.RetrieveUpdateDestroyAPIView):
+
+    def retrieve(self, request, *args, **kwargs):
+        # looking up the object checks permissions on it, even if it hasn't
+        # changed
+        self.object = self.get_object()
+        return self.conditional_response(request,
+            lambda: Response(self.get_serializer(self.object).data))
 
     def pre_save(self, obj):
         if type(obj) not in [ User, Tag, AuditTrail ]:
@@ -257,19 +405,18 @@ class VariableBaseDetail(BaseDetail):
             pass
 
         if this_object is None:
-            this_object = self.__class__.model.objects.create(data=python_json.dumps(request.DATA))
+            this_object = self.__class__.model.get_or_create_for(request.DATA, created_by=request.user)
+            setattr(through_obj, self.__class__.reverse_relationship, this_object)
+            through_obj.save()
         else:
-            this_object.data = python_json.dumps(request.DATA)
-            this_object.save()
-        setattr(through_obj, self.__class__.reverse_relationship, this_object)
-        through_obj.save()
+            # the same variables may be shared with other hosts and groups
+            this_object = this_object.replace_for(through_obj, request.DATA)
 
-        return Response(status=status.HTTP_200_OK, data=python_json.loads(this_object.data))
+        return Response(status=status.HTTP_200_OK, data=this_object.variables)
 
 
     def get(self, request, *args, **kwargs):
 
-        # if null, recreate a blank object
         through_obj = self.__class__.parent_model.objects.get(pk=kwargs['pk'])
         this_object = None
 
@@ -278,15 +425,14 @@ class VariableBaseDetail(BaseDetail):
         except Exception, e:
             pass
 
-        if this_object is None:
-            new_args               = {}
-            new_args['data']       = python_json.dumps(dict())
-            this_object            = self.__class__.model.objects.create(**new_args)
-            setattr(through_obj, self.__class__.reverse_relationship, this_object)
-            through_obj.save()
-
         has_permission = Inventory._has_permission_types(request.user, through_obj.inventory, PERMISSION_TYPES_ALLOWING_INVENTORY_WRITE)
         if not has_permission:
             raise PermissionDenied()
-        return Response(status=status.HTTP_200_OK, data=python_json.loads(this_object.data))
+        # if null, the variables are empty; nothing is saved until a put, so
+        # reads never write to the database
+        if this_object is None:
+            return self.conditional_response(request,
+                lambda: Response(status=status.HTTP_200_OK, data=dict()))
+        return self.conditional_response(request,
+            lambda: Response(status=status.HTTP_200_OK, data=this_object.variables))
 
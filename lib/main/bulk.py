@@ -0,0 +1,308 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+from django.core.exceptions import ValidationError
+from django.db import transaction, IntegrityError
+from lib.main.models import *
+
+def batches(items, batch_size=500):
+    ''' split items into lists small enough to use as query parameters '''
+    items = list(items)
+    return [items[n:n + batch_size] for n in xrange(0, len(items), batch_size)]
+
+class InventoryLoader(object):
+    '''
+    Add hosts, groups, group memberships and variables to an inventory using
+    batched inserts instead of saving one object at a time.
+
+    Hosts and groups are matched by name, and only what differs from the
+    inventory is written, so loading the same data again is close to a no-op.
+    Existing hosts, groups and memberships that weren't added are kept unless
+    overwrite is set, in which case they are removed.
+    '''
+
+    def __init__(self, inventory, created_by=None, overwrite=False):
+        self.inventory = inventory
+        self.created_by = created_by
+        self.overwrite = overwrite
+        # host or group name -> dict of description/variables
+        self.hosts = {}
+        self.groups = {}
+        # (group name, host name)
+        self.group_hosts = set()
+        # (parent group name, child group name)
+        self.group_children = set()
+        # the inventory's own variables, or None to leave them alone
+        self.inventory_variables = None
+        # pks of VariableData that hosts, groups or the inventory stopped
+        # using while saving
+        self.replaced_variable_data_pks = set()
+
+    def _add(self, objects, name, variables=None, description=None):
+        info = objects.setdefault(name, {})
+        if variables is not None:
+            info['variables'] = variables
+        if description is not None:
+            info['description'] = description
+
+    def add_host(self, name, variables=None, description=None):
+        self._add(self.hosts, name, variables, description)
+
+    def add_group(self, name, variables=None, description=None):
+        self._add(self.groups, name, variables, description)
+
+    def set_inventory_variables(self, variables):
+        self.inventory_variables = variables
+
+    def add_group_host(self, group_name, host_name):
+        self.add_group(group_name)
+        self.add_host(host_name)
+        self.group_hosts.add((group_name, host_name))
+
+    def add_group_child(self, parent_name, child_name):
+        self.add_group(parent_name)
+        self.add_group(child_name)
+        self.group_children.add((parent_name, child_name))
+
+    def _get_variable_data(self, variables_by_name):
+        '''
+        Return a dict of name to the pk of the VariableData with its
+        variables, inserting rows for variables that aren't stored yet.
+        Names with the same variables share one row.
+        '''
+        encoded = dict([(name, VariableData.encode(variables))
+                        for name, variables in variables_by_name.items()])
+        hashes = dict([(data_hash, data) for data, data_hash in encoded.values()])
+        pks = {}
+        for data_hashes in batches(hashes):
+            pks.update(VariableData.objects.filter(data_hash__in=data_hashes).values_list('data_hash', 'pk'))
+        missing = [data_hash for data_hash in hashes if data_hash not in pks]
+        sid = transaction.savepoint()
+        try:
+            VariableData.objects.bulk_create([VariableData(data=hashes[data_hash], data_hash=data_hash,
+                                                           created_by=self.created_by)
+                                              for data_hash in missing])
+        except IntegrityError:
+            # Some were added at the same time by someone else.
+            transaction.savepoint_rollback(sid)
+            for data_hash in missing:
+                pks[data_hash] = VariableData.get_or_create_for(json.loads(hashes[data_hash]),
+                                                                created_by=self.created_by).pk
+            missing = []
+        else:
+            transaction.savepoint_commit(sid)
+        for data_hashes in batches(missing):
+            pks.update(VariableData.objects.filter(data_hash__in=data_hashes).values_list('data_hash', 'pk'))
+        return dict([(name, pks[data_hash]) for name, (data, data_hash) in encoded.items()])
+
+    def _save_objects(self, model, objects):
+        '''
+        Insert new hosts or groups and update changed variables of existing
+        ones, returning counts of objects added, updated and removed and a
+        dict of name to pk for all of them.
+        '''
+        manager = getattr(self.inventory, '%ss' % model._meta.module_name)
+        existing = {}
+        inactive_pks = {}
+        for name, pk, active, variable_data_pk, data_hash in manager.values_list(
+                'name', 'pk', 'active', 'variable_data', 'variable_data__data_hash'):
+            existing[name] = (pk, variable_data_pk, data_hash)
+            if not active:
+                inactive_pks[name] = pk
+        new_names = [name for name in objects if name not in existing]
+        variable_data_pks = self._get_variable_data(dict([
+            (name, objects[name]['variables']) for name in new_names
+            if objects[name].get('variables', None)
+        ]))
+        model.objects.bulk_create([model(name=name, inventory=self.inventory,
+                                         description=objects[name].get('description', None) or '',
+                                         variable_data_id=variable_data_pks.get(name, None),
+                                         created_by=self.created_by)
+                                   for name in new_names])
+        # Objects that were removed before are marked active again.
+        reactivated_pks = [pk for name, pk in inactive_pks.items() if name in objects]
+        for pks in batches(reactivated_pks):
+            model.objects.filter(pk__in=pks).update(active=True)
+
+        # Only objects whose variables differ are changed, by pointing them at
+        # the VariableData with the new variables, with one update for each
+        # distinct set of variables.
+        changed = {}
+        for name, info in objects.items():
+            variables = info.get('variables', None)
+            if name not in existing or variables is None:
+                continue
+            pk, variable_data_pk, data_hash = existing[name]
+            if variable_data_pk is None and not variables:
+                continue
+            if VariableData.encode(variables)[1] != data_hash:
+                changed[name] = variables
+        updated_pks = {}
+        for name, variable_data_pk in self._get_variable_data(changed).items():
+            updated_pks.setdefault(variable_data_pk, []).append(existing[name][0])
+            if existing[name][1] is not None:
+                self.replaced_variable_data_pks.add(existing[name][1])
+        for variable_data_pk, object_pks in updated_pks.items():
+            for pks in batches(object_pks):
+                model.objects.filter(pk__in=pks).update(variable_data=variable_data_pk)
+
+        # Removed objects are marked inactive like they are through the API,
+        # but keep their names, so importing them again reactivates them.
+        removed_pks = []
+        if self.overwrite:
+            removed_pks = [value[0] for name, value in existing.items()
+                           if name not in objects and name not in inactive_pks]
+            for pks in batches(removed_pks):
+                model.objects.filter(pk__in=pks).update(active=False)
+        if new_names:
+            existing = dict(manager.values_list('name', 'pk'))
+        else:
+            existing = dict([(name, value[0]) for name, value in existing.items()])
+        return (len(new_names) + len(reactivated_pks), len(changed), len(removed_pks)), existing
+
+    def _save_inventory_variables(self):
+        ''' set the inventory's own variables, returning 1 if they changed '''
+        variables = self.inventory_variables
+        variable_data = self.inventory.variable_data
+        if variables is None or (variable_data is None and not variables):
+            return 0
+        if variable_data is not None and VariableData.encode(variables)[1] == variable_data.data_hash:
+            return 0
+        if variable_data is not None and variables:
+            variable_data.replace_for(self.inventory, variables)
+            return 1
+        # Empty variables are cleared rather than stored.
+        if variables:
+            self.inventory.variable_data = VariableData.get_or_create_for(variables, created_by=self.created_by)
+        else:
+            self.inventory.variable_data = None
+            self.replaced_variable_data_pks.add(variable_data.pk)
+        self.inventory.save()
+        return 1
+
+    def _save_relationships(self, model, fields, queryset, pairs):
+        '''
+        Insert rows of the m2m through model for (parent pk, child pk) pairs
+        that queryset doesn't have yet, and remove the others when
+        overwriting.  fields names the parent and child columns.  Returns the
+        counts added and removed.
+        '''
+        existing = dict([((parent, child), pk) for pk, parent, child in
+                         queryset.values_list('pk', *fields)])
+        added = [pair for pair in pairs if pair not in existing]
+        model.objects.bulk_create([model(**dict(zip(fields, pair))) for pair in added])
+        removed = 0
+        if self.overwrite:
+            removed_pks = [pk for pair, pk in existing.items() if pair not in pairs]
+            for pks in batches(removed_pks):
+                model.objects.filter(pk__in=pks).delete()
+            removed = len(removed_pks)
+        return len(added), removed
+
+    def _check_objects(self):
+        '''
+        Raise ValidationError listing every host or group whose name,
+        description or variables are invalid, before anything is written.
+        '''
+        errors = []
+        for model, objects in ((Host, self.hosts), (Group, self.groups)):
+            for name, info in sorted(objects.items()):
+                obj = model(name=name, description=info.get('description', ''),
+                            inventory=self.inventory)
+                # Existing hosts and groups are matched by name, so uniqueness
+                # isn't checked (nor the inventory, which is known to exist).
+                try:
+                    obj.clean_fields(exclude=('inventory', 'created_by', 'variable_data'))
+                    obj.clean()
+                except ValidationError, e:
+                    for field, messages in sorted(e.message_dict.items()):
+                        errors.extend(['%s %s: %s: %s' % (model._meta.verbose_name, name, field, message)
+                                       for message in messages])
+                variables = info.get('variables', None)
+                if variables is not None and not isinstance(variables, dict):
+                    errors.append('%s %s: variables must be a dict' % (model._meta.verbose_name, name))
+        if self.inventory_variables is not None and not isinstance(self.inventory_variables, dict):
+            errors.append('inventory: variables must be a dict')
+        if errors:
+            raise ValidationError(errors)
+
+    def _check_cycles(self):
+        '''
+        Raise ValidationError if adding the group children would create a
+        cycle, before anything is written.
+        '''
+        parents = {}
+        edges = [(parent, child) for parent, child in self.group_children]
+        if not self.overwrite:
+            # from_group is the child and to_group is the parent.
+            existing = Group.parents.through.objects.filter(to_group__inventory=self.inventory)
+            edges.extend(existing.values_list('to_group__name', 'from_group__name'))
+        for parent, child in edges:
+            parents.setdefault(child, []).append(parent)
+        for group in parents:
+            GroupAncestry.get_depths(parents, group)
+
+    @transaction.commit_on_success
+    def save(self):
+        '''
+        Write everything that differs from the inventory, returning a dict of
+        counts of the hosts, groups, variables and relationships changed.
+        Raises ValidationError, without writing anything, if any host or group
+        is invalid or the groups would contain a cycle.
+        '''
+        self._check_objects()
+        self._check_cycles()
+        result = {}
+        self.replaced_variable_data_pks.clear()
+        (result['hosts'], host_vars, removed_hosts), host_pks = self._save_objects(Host, self.hosts)
+        (result['groups'], group_vars, removed_groups), group_pks = self._save_objects(Group, self.groups)
+        result['variables'] = host_vars + group_vars + self._save_inventory_variables()
+        # Variables no host or group uses any more are removed.
+        for pks in batches(self.replaced_variable_data_pks):
+            VariableData.objects.filter(pk__in=pks, hosts=None, groups=None, inventories=None).delete()
+        if self.overwrite:
+            result['removed_hosts'] = removed_hosts
+            result['removed_groups'] = removed_groups
+
+        GroupHosts = Group.hosts.through
+        pairs = set([(group_pks[g], host_pks[h]) for g, h in self.group_hosts])
+        result['group_hosts'], removed = self._save_relationships(
+            GroupHosts, ('group_id', 'host_id'),
+            GroupHosts.objects.filter(group__inventory=self.inventory), pairs)
+        if self.overwrite:
+            result['removed_group_hosts'] = removed
+
+        # from_group is the child and to_group is the parent.
+        GroupParents = Group.parents.through
+        pairs = set([(group_pks[p], group_pks[c]) for p, c in self.group_children])
+        result['group_children'], removed = self._save_relationships(
+            GroupParents, ('to_group_id', 'from_group_id'),
+            GroupParents.objects.filter(to_group__inventory=self.inventory), pairs)
+        if self.overwrite:
+            result['removed_group_children'] = removed
+
+        # Bulk inserts and updates don't send the signals that keep these
+        # current.
+        if (result['groups'] or result['group_children'] or result.get('removed_groups', 0) or
+                result.get('removed_group_children', 0)):
+            GroupAncestry.rebuild([self.inventory.pk])
+        if any(result.values()):
+            Inventory.update_snapshot_version([self.inventory.pk])
+            for model in (Host, Group, VariableData):
+                ModelVersion.bump(model)
+        return result
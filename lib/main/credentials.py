@@ -0,0 +1,244 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from django.conf import settings
+
+# Answers the passphrase prompt from ssh-add, which runs without a terminal.
+# ssh-add asks again after a wrong passphrase until it gets an empty one, so
+# the script removes itself to only answer once.
+ASKPASS_SCRIPT = '''#!/bin/sh
+rm -f "$0"
+echo "$ACOM_SSH_KEY_UNLOCK"
+'''
+
+# Runs ssh-agent until the worker that started it closes the pipe on stdin,
+# which also happens when the worker is killed, so agents never outlive it.
+# (Background commands get /dev/null as stdin, hence the copy on fd 3.)
+AGENT_SCRIPT = '''exec 3<&0
+ssh-agent -D -a "$1" -t "$2" </dev/null >/dev/null 2>&1 &
+agent=$!
+(cat <&3 >/dev/null; kill $agent 2>/dev/null) &
+exec 3<&-
+wait $agent
+'''
+
+class SshAgent(object):
+    '''
+    An ssh-agent holding the key from one credential, listening on a socket
+    in a private temporary directory.  The key is only written to disk long
+    enough for ssh-add to load it, and the agent drops it once it could no
+    longer be needed (see get_key_lifetime).  The agent stops when the
+    process that started it exits, however it exits.
+    '''
+
+    def __init__(self, credential):
+        self.credential_pk = credential.pk
+        self.key_hash = self.get_key_hash(credential)
+        # Number of jobs using the agent, and when it may be stopped once
+        # none are.
+        self.in_use = 0
+        self.expires = None
+        self.started = time.time()
+        self.proc = None
+        self.temp_dir = tempfile.mkdtemp(prefix='acom_ssh_')
+        self.socket_path = os.path.join(self.temp_dir, 'agent.sock')
+        try:
+            self.start()
+            self.add_key(credential.ssh_key_data, credential.ssh_key_unlock)
+        except:
+            self.stop()
+            raise
+
+    @classmethod
+    def get_key_hash(cls, credential):
+        ''' identify the key (and passphrase) an agent was started with '''
+        data = u'%s\0%s' % (credential.ssh_key_data, credential.ssh_key_unlock)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_key_lifetime(cls):
+        '''
+        Seconds the agent keeps its key: agents are only given to new jobs
+        for SSH_AGENT_TTL seconds after they start, and jobs end within
+        CELERYD_TASK_TIME_LIMIT seconds.
+        '''
+        ttl = max(getattr(settings, 'SSH_AGENT_TTL', 300), 0)
+        time_limit = getattr(settings, 'CELERYD_TASK_TIME_LIMIT', None) or 3600
+        return int(ttl + time_limit + 60)
+
+    def start(self, timeout=10.0):
+        devnull = file(os.devnull, 'r+b')
+        try:
+            # In its own session so signals for the worker don't reach it.
+            self.proc = subprocess.Popen(['sh', '-c', AGENT_SCRIPT, 'sh', self.socket_path,
+                                          str(self.get_key_lifetime())],
+                                         stdin=subprocess.PIPE, stdout=devnull,
+                                         stderr=devnull, close_fds=True,
+                                         preexec_fn=os.setsid)
+        finally:
+            devnull.close()
+        deadline = time.time() + timeout
+        while not os.path.exists(self.socket_path):
+            if self.proc.poll() is not None:
+                raise RuntimeError('ssh-agent exited with status %d' % self.proc.returncode)
+            if time.time() > deadline:
+                raise RuntimeError('timed out waiting for ssh-agent to start')
+            time.sleep(0.01)
+
+    def add_key(self, key_data, key_unlock=''):
+        key_path = os.path.join(self.temp_dir, 'key')
+        askpass_path = os.path.join(self.temp_dir, 'askpass')
+        if not key_data.endswith('\n'):
+            key_data += '\n'
+        handle = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            os.write(handle, key_data.encode('utf-8'))
+        finally:
+            os.close(handle)
+        try:
+            handle = os.open(askpass_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0700)
+            try:
+                os.write(handle, ASKPASS_SCRIPT)
+            finally:
+                os.close(handle)
+            env = dict(os.environ.items())
+            env['SSH_AUTH_SOCK'] = self.socket_path
+            env['SSH_ASKPASS'] = askpass_path
+            env['SSH_ASKPASS_REQUIRE'] = 'force'
+            # Older versions of ssh-add only use SSH_ASKPASS with a display.
+            env.setdefault('DISPLAY', ':0')
+            env['ACOM_SSH_KEY_UNLOCK'] = key_unlock.encode('utf-8')
+            devnull = file(os.devnull, 'rb')
+            try:
+                proc = subprocess.Popen(['ssh-add', key_path], stdin=devnull,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, env=env,
+                                        close_fds=True, preexec_fn=os.setsid)
+                stdout, stderr = proc.communicate()
+            finally:
+                devnull.close()
+            if proc.returncode != 0:
+                raise RuntimeError('ssh-add failed (%d): %s' % (proc.returncode,
+                                                                stderr.strip()))
+        finally:
+            for path in (key_path, askpass_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        ''' stop the agent and remove its socket '''
+        if self.proc is not None and not self.proc.stdin.closed:
+            self.proc.stdin.close()
+            self.proc.wait()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+class SshAgentPool(object):
+    '''
+    ssh-agents for credentials used by launch jobs in this process, kept for
+    SSH_AGENT_TTL seconds after the last job using each one finishes, so
+    jobs with the same credential don't each start an agent and decrypt the
+    key.  Agents are replaced when the credential's key changes or they
+    have been running for SSH_AGENT_TTL seconds, and at most
+    SSH_AGENT_POOL_SIZE idle agents are kept.
+    '''
+
+    def __init__(self):
+        # credential pk -> SshAgent
+        self.agents = {}
+        self.lock = threading.RLock()
+        # Stops the next agent to expire even if no more jobs run here.
+        self.timer = None
+
+    def acquire(self, credential):
+        ''' return a running agent with the credential's key; release it when done '''
+        with self.lock:
+            self.evict()
+            agent = self.agents.get(credential.pk, None)
+            ttl = getattr(settings, 'SSH_AGENT_TTL', 300)
+            if agent is not None and (agent.key_hash != SshAgent.get_key_hash(credential) or
+                                      not agent.is_alive() or
+                                      time.time() - agent.started >= ttl):
+                # Jobs still using the old agent keep it until they're done.
+                del self.agents[credential.pk]
+                if not agent.in_use:
+                    agent.stop()
+                agent = None
+            if agent is None:
+                agent = SshAgent(credential)
+                if ttl > 0:
+                    self.agents[credential.pk] = agent
+            agent.in_use += 1
+            agent.expires = None
+            return agent
+
+    def release(self, agent):
+        with self.lock:
+            agent.in_use -= 1
+            if agent.in_use:
+                return
+            ttl = getattr(settings, 'SSH_AGENT_TTL', 300)
+            if self.agents.get(agent.credential_pk, None) is not agent or ttl <= 0:
+                agent.stop()
+                return
+            agent.expires = time.time() + ttl
+            self.evict()
+
+    def evict(self):
+        ''' stop expired agents, and the least recently used idle ones over the limit '''
+        with self.lock:
+            current_time = time.time()
+            idle = sorted([(agent.expires, pk) for pk, agent in self.agents.items()
+                           if not agent.in_use and agent.expires is not None])
+            extra = len(idle) - getattr(settings, 'SSH_AGENT_POOL_SIZE', 50)
+            for n, (expires, pk) in enumerate(idle):
+                if n < extra or expires <= current_time:
+                    self.agents.pop(pk).stop()
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = None
+            expires = [agent.expires for agent in self.agents.values() if agent.expires is not None]
+            if expires:
+                self.timer = threading.Timer(max(min(expires) - current_time, 0), self.evict)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def clear(self):
+        ''' stop every agent, including any still in use '''
+        with self.lock:
+            timer, self.timer = self.timer, None
+            if timer is not None:
+                timer.cancel()
+            for agent in self.agents.values():
+                agent.stop()
+            self.agents.clear()
+        # Outside the lock, which the timer may be waiting for.
+        if timer is not None and timer is not threading.current_thread():
+            timer.join()
+
+ssh_agent_pool = SshAgentPool()
+atexit.register(ssh_agent_pool.clear)
@@ -0,0 +1,226 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import select
+import socket
+import threading
+import time
+from django.conf import settings
+from django.db import connection, transaction
+from lib.main.models import *
+
+EVENT_TYPES = set([x[0] for x in LaunchJobStatusEvent.EVENT_TYPES])
+
+def parse_callback_event(line):
+    '''
+    Parse one newline-delimited JSON message sent by the acom_callback plugin,
+    returning an (event type, event data) tuple, or None if the message is
+    invalid or the event type is not supported.
+    '''
+    if not line.strip():
+        return None
+    try:
+        message = json.loads(line)
+        event_type = message['event']
+        event_data = message.get('event_data', {})
+    except (ValueError, KeyError, TypeError):
+        return None
+    if event_type not in EVENT_TYPES:
+        return None
+    return event_type, event_data
+
+class CallbackEventBuffer(object):
+    '''
+    Collect callback events for a launch job status in memory and write them
+    with multi-row inserts once enough events have been buffered or enough
+    time has passed since the last write.
+    '''
+
+    def __init__(self, launch_job_status_pk, batch_size=None, interval=None):
+        self.launch_job_status_pk = launch_job_status_pk
+        self.batch_size = batch_size or getattr(settings, 'CALLBACK_EVENT_BATCH_SIZE', 100)
+        self.interval = interval or getattr(settings, 'CALLBACK_EVENT_BATCH_INTERVAL', 1.0)
+        self.events = []
+        self.last_flush = time.time()
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event_type, event_data):
+        self.events.append(LaunchJobStatusEvent(launch_job_status_id=self.launch_job_status_pk,
+                                                event=event_type,
+                                                event_data=event_data))
+        if len(self.events) >= self.batch_size:
+            self.flush()
+
+    def flush_if_needed(self):
+        if self.events and time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    @transaction.commit_on_success
+    def flush(self):
+        '''
+        Write all buffered events, returning the number saved.  Events are
+        only added while the launch job is running; the status is checked
+        once for the whole batch.
+        '''
+        events, self.events = self.events, []
+        self.last_flush = time.time()
+        if not events:
+            return 0
+        launch_job_statuses = LaunchJobStatus.objects.filter(pk=self.launch_job_status_pk,
+                                                             status='running')
+        if not launch_job_statuses.exists():
+            return 0
+        LaunchJobStatusEvent.objects.bulk_create(events)
+        return len(events)
+
+class CallbackEventReceiver(threading.Thread):
+    '''
+    Receive callback events from the acom_callback plugin over a Unix domain
+    socket for the duration of one ansible-playbook run and save them in
+    batches as launch job status events.
+
+    Each connection carries newline-delimited JSON messages of the form
+    {"event": "<event type>", "event_data": {...}}.  The plugin connects once
+    per ansible-playbook process (including forked workers), so an entire
+    run only needs a handful of connections instead of a new interpreter and
+    Django startup for every event.
+    '''
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, launch_job_status_pk, socket_path):
+        super(CallbackEventReceiver, self).__init__()
+        self.daemon = True
+        self.launch_job_status_pk = launch_job_status_pk
+        self.socket_path = socket_path
+        self.buffer = CallbackEventBuffer(launch_job_status_pk)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(64)
+        self._stopping = threading.Event()
+
+    def stop(self):
+        '''
+        Signal the receiver to exit once all pending events have been read,
+        then wait for it to finish.  Should only be called after the
+        ansible-playbook process has exited.
+        '''
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        clients = {}
+        try:
+            while True:
+                readable = select.select([self.listener] + clients.keys(),
+                                         [], [], self.POLL_INTERVAL)[0]
+                for sock in readable:
+                    if sock is self.listener:
+                        conn = self.listener.accept()[0]
+                        clients[conn] = ''
+                        continue
+                    data = sock.recv(65536)
+                    if data:
+                        lines = (clients[sock] + data).split('\n')
+                        clients[sock] = lines.pop()
+                    else:
+                        lines = [clients.pop(sock)]
+                        sock.close()
+                    for line in lines:
+                        self.handle_message(line)
+                self.buffer.flush_if_needed()
+                # Once the playbook has exited, anything it sent is already
+                # buffered in the socket, so an idle poll means we're done.
+                if self._stopping.is_set() and not readable:
+                    break
+            self.buffer.flush()
+        finally:
+            for sock in clients.keys():
+                sock.close()
+            self.listener.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            # Each thread gets its own database connection; don't leak it.
+            connection.close()
+
+    def handle_message(self, line):
+        event = parse_callback_event(line)
+        if event is not None:
+            self.buffer.add(*event)
+
+class CallbackEventSpool(object):
+    '''
+    Load callback events that the acom_callback plugin wrote to a spool file
+    (as newline-delimited JSON) into the database in bulk.
+
+    Each batch of events is saved in the same transaction as the byte offset
+    of the next unread line, so a drain that is interrupted part of the way
+    through can be run again without duplicating events.  Events are loaded
+    regardless of the launch job status, since they were all written while
+    the job was running.
+    '''
+
+    def __init__(self, launch_job_status_pk, path, batch_size=None):
+        self.launch_job_status_pk = launch_job_status_pk
+        self.path = path
+        self.batch_size = batch_size or getattr(settings, 'CALLBACK_EVENT_BATCH_SIZE', 100)
+
+    def drain(self):
+        '''
+        Load all complete events after the saved offset, returning the number
+        of events saved.  A partially written last line is left for the next
+        drain.
+        '''
+        launch_job_status = LaunchJobStatus.objects.get(pk=self.launch_job_status_pk)
+        offset = launch_job_status.event_spool_offset
+        saved = 0
+        spool_file = file(self.path, 'rb')
+        try:
+            spool_file.seek(offset)
+            while True:
+                events, end = [], offset
+                while len(events) < self.batch_size:
+                    line = spool_file.readline()
+                    if not line.endswith('\n'):
+                        break
+                    end += len(line)
+                    event = parse_callback_event(line)
+                    if event is not None:
+                        events.append(LaunchJobStatusEvent(launch_job_status_id=self.launch_job_status_pk,
+                                                           event=event[0],
+                                                           event_data=event[1]))
+                if end == offset:
+                    break
+                self.save_batch(events, end)
+                saved += len(events)
+                offset = end
+                # Seek back to the end of the last complete line in case a
+                # partial line was read.
+                spool_file.seek(offset)
+        finally:
+            spool_file.close()
+        return saved
+
+    @transaction.commit_on_success
+    def save_batch(self, events, offset):
+        if events:
+            LaunchJobStatusEvent.objects.bulk_create(events)
+        LaunchJobStatus.objects.filter(pk=self.launch_job_status_pk).update(event_spool_offset=offset)
@@ -0,0 +1,119 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from lib.main.models import *
+
+class EffectiveVariables(object):
+    '''
+    Compute the variables ansible would use for hosts in an inventory, by
+    merging the inventory's own variables, the variables of all of a host's
+    groups and their ancestors, then the host's own variables.
+
+    As in ansible, groups are applied in order of depth (the longest path from
+    a group without parents), so variables of more specific groups win, with
+    ties broken by name.  Keys are replaced rather than merged recursively,
+    like ansible's default hash_behaviour.
+
+    The inventory's groups are loaded once, and the merged group variables
+    are kept for each distinct set of groups, so hosts in the same groups
+    (and groups shared between them) are only merged once.
+    '''
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+        # like ansible's "all" group, below every other group
+        self.inventory_variables = {}
+        if inventory.variable_data is not None:
+            self.inventory_variables = inventory.variable_data.variables
+        groups = Group.objects.filter(inventory=inventory, active=True)
+        self.group_names = {}
+        group_variable_data = {}
+        for pk, name, variable_data_pk in groups.values_list('pk', 'name', 'variable_data'):
+            self.group_names[pk] = name
+            group_variable_data[pk] = variable_data_pk
+        self.parents = {}
+        # from_group is the child and to_group is the parent.
+        group_parents = Group.parents.through.objects.filter(from_group__inventory=inventory)
+        for child_pk, parent_pk in group_parents.values_list('from_group_id', 'to_group_id'):
+            if child_pk in self.group_names and parent_pk in self.group_names:
+                self.parents.setdefault(child_pk, []).append(parent_pk)
+        self.variables = {}
+        used = VariableData.objects.filter(pk__in=groups.values('variable_data'))
+        for pk, data_hash, data in used.values_list('pk', 'data_hash', 'data'):
+            self.variables[pk] = VariableData.parse(data_hash, data)
+        self.group_variables = dict([(pk, self.variables.get(variable_data_pk, {}))
+                                     for pk, variable_data_pk in group_variable_data.items()])
+        self._depths = {}
+        self._ancestors = {}
+        self._merged = {}
+
+    def get_depth(self, group_pk):
+        if group_pk not in self._depths:
+            # groups can't be their own ancestors, so this always finishes
+            self._depths[group_pk] = max([self.get_depth(pk) + 1 for pk in self.parents.get(group_pk, [])] or [0])
+        return self._depths[group_pk]
+
+    def get_ancestors(self, group_pk):
+        ''' return the set of a group and all of its ancestors '''
+        if group_pk not in self._ancestors:
+            ancestors = set([group_pk])
+            for pk in self.parents.get(group_pk, []):
+                ancestors.update(self.get_ancestors(pk))
+            self._ancestors[group_pk] = ancestors
+        return self._ancestors[group_pk]
+
+    def get_group_variables(self, group_pks):
+        '''
+        Return the merged variables of the given groups and their ancestors.
+        The result is shared, so callers must not modify it.
+        '''
+        key = tuple(sorted([pk for pk in group_pks if pk in self.group_names]))
+        if key not in self._merged:
+            groups = set()
+            for pk in key:
+                groups.update(self.get_ancestors(pk))
+            merged = dict(self.inventory_variables)
+            for pk in sorted(groups, key=lambda pk: (self.get_depth(pk), self.group_names[pk])):
+                merged.update(self.group_variables[pk])
+            self._merged[key] = merged
+        return self._merged[key]
+
+    def get_host_variables(self, host):
+        ''' return the effective variables for one host '''
+        group_pks = host.groups.values_list('pk', flat=True)
+        variables = dict(self.get_group_variables(group_pks))
+        if host.variable_data is not None:
+            variables.update(host.variable_data.variables)
+        return variables
+
+    def get_all_host_variables(self):
+        ''' return a dict of host name to effective variables for every host '''
+        host_groups = {}
+        group_hosts = Group.hosts.through.objects.filter(group__inventory=self.inventory)
+        for host_pk, group_pk in group_hosts.values_list('host_id', 'group_id'):
+            host_groups.setdefault(host_pk, []).append(group_pk)
+        hosts = self.inventory.hosts.all()
+        host_variables = {}
+        used = VariableData.objects.filter(pk__in=hosts.values('variable_data'))
+        for pk, data_hash, data in used.values_list('pk', 'data_hash', 'data'):
+            host_variables[pk] = VariableData.parse(data_hash, data)
+        result = {}
+        for pk, name, variable_data_pk in hosts.values_list('pk', 'name', 'variable_data'):
+            variables = dict(self.get_group_variables(host_groups.get(pk, [])))
+            variables.update(host_variables.get(variable_data_pk, {}))
+            result[name] = variables
+        return result
@@ -43,10 +43,42 @@ class Command(NoArgsCommand):
                          'data (specify "-" to read from stdin)'),
         make_option('-d', '--data', dest='event_data_json', default=None,
                     help='JSON-formatted callback event data'),
+        make_option('-s', '--spool', dest='event_spool_file', default=None,
+                    help='Load all events from a spool file written by the '
+                         'callback plugin (resumes from where any previous '
+                         'load left off)'),
     )
 
+    def get_launch_job_status(self, options):
+        from lib.main.models import LaunchJobStatus
+        try:
+            launch_job_status_id = int(os.getenv('ACOM_LAUNCH_JOB_STATUS_ID',
+                                   options.get('launch_job_status_id', 0)))
+        except ValueError:
+            raise CommandError('Launch job status ID must be an integer')
+        if not launch_job_status_id:
+            raise CommandError('No launch job status ID specified')
+        try:
+            return LaunchJobStatus.objects.get(id=launch_job_status_id)
+        except LaunchJobStatus.DoesNotExist:
+            raise CommandError('Launch job status with ID %d not found' % launch_job_status_id)
+
+    def load_spool(self, **options):
+        from lib.main.events import CallbackEventSpool
+        event_spool_file = options['event_spool_file']
+        launch_job_status = self.get_launch_job_status(options)
+        try:
+            count = CallbackEventSpool(launch_job_status.pk, event_spool_file).drain()
+        except IOError, e:
+            raise CommandError('Error %r reading from %s' % (e, event_spool_file))
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write('Loaded %d events from %s\n' % (count, event_spool_file))
+
     def handle_noargs(self, **options):
         from lib.main.models import LaunchJobStatus, LaunchJobStatusEvent
+        event_spool_file = options.get('event_spool_file', None)
+        if event_spool_file:
+            return self.load_spool(**options)
         event_type = options.get('event_type', None)
         if not event_type:
             raise CommandError('No event specified')
@@ -56,17 +88,7 @@ class Command(NoArgsCommand):
         event_data_json = options.get('event_data_json', None)
         if event_data_file is None and event_data_json is None:
             raise CommandError('Either --file or --data must be specified')
-        try:
-            launch_job_status_id = int(os.getenv('ACOM_LAUNCH_JOB_STATUS_ID',
-                                   options.get('launch_job_status_id', 0)))
-        except ValueError:
-            raise CommandError('Launch job status ID must be an integer')
-        if not launch_job_status_id:
-            raise CommandError('No launch job status ID specified')
-        try:
-            launch_job_status = LaunchJobStatus.objects.get(id=launch_job_status_id)
-        except LaunchJobStatus.DoesNotExist:
-            raise CommandError('Launch job status with ID %d not found' % launch_job_status_id)
+        launch_job_status = self.get_launch_job_status(options)
         if launch_job_status.status != 'running':
             raise CommandError('Unable to add event except when launch job is running')
         try:
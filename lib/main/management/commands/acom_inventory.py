@@ -18,11 +18,26 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import glob
 import json
+import mmap
 from optparse import make_option
 import os
+import tempfile
+import zlib
+from django.conf import settings
 from django.core.management.base import NoArgsCommand, CommandError
 
+def get_host_slice(host_name, slice_count):
+    '''
+    Return which of slice_count slices of a sliced launch job a host belongs
+    to.  This only depends on the host name, so every slice agrees on where
+    each host goes even if hosts are added while the slices run.
+    '''
+    if isinstance(host_name, unicode):
+        host_name = host_name.encode('utf-8')
+    return (zlib.crc32(host_name) & 0xffffffff) % slice_count
+
 class Command(NoArgsCommand):
 
     help = 'Ansible Commander Inventory script'
@@ -37,27 +52,182 @@ class Command(NoArgsCommand):
                     help='Return JSON hash of host vars.'),
         make_option('--indent', dest='indent', type='int', default=None,
                     help='Indentation level for pretty printing output'),
+        make_option('--effective', action='store_true', dest='effective',
+                    default=False, help='Return host vars merged with the '
+                    'vars of all of their groups.'),
+        make_option('--slice-index', dest='slice_index', type='int', default=None,
+                    help='Only list hosts in this slice, from 0 to one less '
+                         'than the slice count (can also be specified using '
+                         'ACOM_INVENTORY_SLICE_INDEX environment variable)'),
+        make_option('--slice-count', dest='slice_count', type='int', default=None,
+                    help='Number of slices to split hosts between (can also '
+                         'be specified using ACOM_INVENTORY_SLICE_COUNT '
+                         'environment variable)'),
     )
 
-    def get_list(self, inventory, indent=None):
-        groups = {}
-        for group in inventory.groups.all():
-            # FIXME: Check if group is active?
-            group_info = {
-                'hosts': list(group.hosts.values_list('name', flat=True)),
-                'children': list(group.children.values_list('name', flat=True)),
-            }
-            if group.variable_data is not None:
-                group_info['vars'] = json.loads(group.variable_data.data)
+    def load_variables(self, inventory):
+        '''
+        Return a dict of VariableData pk to variables for the inventory and
+        every host and group in it.  Hosts and groups with the same variables
+        share one VariableData, so each distinct set of variables is only
+        loaded and parsed once.
+        '''
+        from django.db.models import Q
+        from lib.main.models import VariableData
+        used = VariableData.objects.filter(Q(pk__in=inventory.hosts.values('variable_data')) |
+                                           Q(pk__in=inventory.groups.values('variable_data')) |
+                                           Q(pk=inventory.variable_data_id))
+        return dict([(pk, VariableData.parse(data_hash, data))
+                     for pk, data_hash, data in used.values_list('pk', 'data_hash', 'data')])
+
+    def build_list(self, inventory):
+        from lib.main.models import Group
+        variables = self.load_variables(inventory)
+        # Load groups, group hosts and group children in bulk, so the number
+        # of queries doesn't depend on the number of groups in the inventory.
+        # FIXME: Check if group is active?
+        group_names = {}
+        group_infos = {}
+        for group_pk, name, variable_data_pk in inventory.groups.values_list('pk', 'name', 'variable_data'):
+            group_names[group_pk] = name
+            group_infos[group_pk] = {'hosts': [], 'children': []}
+            if variable_data_pk is not None:
+                group_infos[group_pk]['vars'] = variables[variable_data_pk]
+        group_hosts = Group.hosts.through.objects.filter(group__inventory=inventory)
+        for group_pk, host_name in group_hosts.values_list('group_id', 'host__name'):
+            group_infos[group_pk]['hosts'].append(host_name)
+        # from_group is the child and to_group is the parent.  Children from
+        # other inventories aren't part of this one.
+        group_parents = Group.parents.through.objects.filter(from_group__inventory=inventory,
+                                                             to_group__inventory=inventory)
+        for child_pk, parent_pk in group_parents.values_list('from_group_id', 'to_group_id'):
+            group_infos[parent_pk]['children'].append(group_names[child_pk])
 
+        groups = {}
+        for group_pk, group_info in group_infos.items():
             group_info = dict(filter(lambda x: bool(x[1]), group_info.items()))
             if group_info.keys() in ([], ['hosts']):
-                groups[group.name] = group_info.get('hosts', [])
+                groups[group_names[group_pk]] = group_info.get('hosts', [])
             else:
-                groups[group.name] = group_info
-        self.stdout.write(json.dumps(groups, indent=indent))
+                groups[group_names[group_pk]] = group_info
+
+        # ansible applies the vars of a group named all to every host.
+        inventory_variables = variables.get(inventory.variable_data_id, {})
+        if inventory_variables:
+            all_info = groups.get('all', {})
+            if isinstance(all_info, list):
+                all_info = {'hosts': all_info}
+            all_info['vars'] = dict(inventory_variables, **all_info.get('vars', {}))
+            groups['all'] = all_info
 
-    def get_host(self, inventory, hostname, indent=None):
+        # Include variables for every host, so ansible doesn't need to run
+        # this script again with --host for each one.
+        hostvars = {}
+        for host_name, variable_data_pk in inventory.hosts.values_list('name', 'variable_data'):
+            hostvars[host_name] = variables.get(variable_data_pk, {})
+        groups['_meta'] = {'hostvars': hostvars}
+        return groups
+
+    def get_snapshot_path(self, inventory):
+        '''
+        Return the path of the cached --list output for the current contents
+        of the inventory, or None if snapshots are disabled.
+        '''
+        snapshot_dir = os.getenv('ACOM_INVENTORY_SNAPSHOT_DIR', '') or \
+                       getattr(settings, 'INVENTORY_SNAPSHOT_DIR', '')
+        if not snapshot_dir:
+            return None
+        if not inventory.snapshot_version:
+            # Inventory hasn't been saved since snapshots were added.
+            inventory.snapshot_version = inventory.update_snapshot_version([inventory.pk])
+        return os.path.join(snapshot_dir, '%d-%s.json' % (inventory.pk,
+                                                          inventory.snapshot_version))
+
+    def write_snapshot(self, path, data):
+        '''
+        Atomically write a new snapshot and remove older snapshots for the
+        same inventory.
+        '''
+        snapshot_dir = os.path.dirname(path)
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        handle, temp_path = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+        try:
+            os.write(handle, data)
+        finally:
+            os.close(handle)
+        os.rename(temp_path, path)
+        inventory_pk = os.path.basename(path).split('-')[0]
+        for old_path in glob.glob(os.path.join(snapshot_dir, '%s-*.json' % inventory_pk)):
+            if old_path != path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+
+    def get_slice(self, groups, slice_index, slice_count):
+        '''
+        Remove hosts that aren't in the given slice from the --list output.
+        Groups are kept even when none of their hosts are left.
+        '''
+        in_slice = lambda host_name: get_host_slice(host_name, slice_count) == slice_index
+        for group_name, group_info in groups.items():
+            if group_name == '_meta':
+                hostvars = group_info['hostvars']
+                group_info['hostvars'] = dict([(k, v) for k, v in hostvars.items() if in_slice(k)])
+            elif isinstance(group_info, list):
+                groups[group_name] = filter(in_slice, group_info)
+            elif 'hosts' in group_info:
+                group_info['hosts'] = filter(in_slice, group_info['hosts'])
+        return groups
+
+    def get_list(self, inventory, indent=None, effective=False, slice_index=0,
+                 slice_count=1):
+        # Only the plain list is kept as a snapshot.
+        if effective:
+            from lib.main.hostvars import EffectiveVariables
+            groups = self.build_list(inventory)
+            groups['_meta']['hostvars'] = EffectiveVariables(inventory).get_all_host_variables()
+            if slice_count > 1:
+                groups = self.get_slice(groups, slice_index, slice_count)
+            self.stdout.write(json.dumps(groups, indent=indent))
+            return
+        snapshot_path = self.get_snapshot_path(inventory)
+        if slice_count > 1:
+            # Every slice shares the snapshot of the whole inventory.
+            if snapshot_path is None:
+                groups = self.build_list(inventory)
+            elif os.path.exists(snapshot_path):
+                snapshot_file = file(snapshot_path, 'rb')
+                try:
+                    groups = json.load(snapshot_file)
+                finally:
+                    snapshot_file.close()
+            else:
+                groups = self.build_list(inventory)
+                self.write_snapshot(snapshot_path, json.dumps(groups))
+            groups = self.get_slice(groups, slice_index, slice_count)
+            self.stdout.write(json.dumps(groups, indent=indent))
+            return
+        if snapshot_path is None or indent is not None:
+            self.stdout.write(json.dumps(self.build_list(inventory), indent=indent))
+            return
+        if not os.path.exists(snapshot_path):
+            self.write_snapshot(snapshot_path, json.dumps(self.build_list(inventory)))
+        # Copy the snapshot straight to stdout without loading it all.
+        out = getattr(self.stdout, '_out', self.stdout)
+        snapshot_file = file(snapshot_path, 'rb')
+        try:
+            snapshot = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for start in xrange(0, len(snapshot), 1048576):
+                    out.write(snapshot[start:start + 1048576])
+            finally:
+                snapshot.close()
+        finally:
+            snapshot_file.close()
+
+    def get_host(self, inventory, hostname, indent=None, effective=False):
         from lib.main.models import Host
         hostvars = {}
         try:
@@ -66,8 +236,11 @@ class Command(NoArgsCommand):
         except Host.DoesNotExist:
             raise CommandError('Host %s not found in the given inventory' % hostname)
         hostvars = {}
-        if host.variable_data is not None:
-            hostvars = json.loads(host.variable_data.data)
+        if effective:
+            from lib.main.hostvars import EffectiveVariables
+            hostvars = EffectiveVariables(inventory).get_host_variables(host)
+        elif host.variable_data is not None:
+            hostvars = host.variable_data.variables
         self.stdout.write(json.dumps(hostvars, indent=indent))
 
     def handle_noargs(self, **options):
@@ -89,12 +262,25 @@ class Command(NoArgsCommand):
             host = options.get('host', '')
             list_ = options.get('list', False)
             indent = options.get('indent', None)
+            effective = options.get('effective', False)
+            try:
+                slice_index = options.get('slice_index', None)
+                if slice_index is None:
+                    slice_index = int(os.getenv('ACOM_INVENTORY_SLICE_INDEX', 0))
+                slice_count = options.get('slice_count', None)
+                if slice_count is None:
+                    slice_count = int(os.getenv('ACOM_INVENTORY_SLICE_COUNT', 1))
+            except ValueError:
+                raise CommandError('Slice index and count must be integers')
+            if slice_count < 1 or not 0 <= slice_index < slice_count:
+                raise CommandError('Slice index must be from 0 to one less than the slice count')
             if list_ and host:
                 raise CommandError('Only one of --list or --host can be specified')
             elif list_:
-                self.get_list(inventory, indent=indent)
+                self.get_list(inventory, indent=indent, effective=effective,
+                              slice_index=slice_index, slice_count=slice_count)
             elif host:
-                self.get_host(inventory, host, indent=indent)
+                self.get_host(inventory, host, indent=indent, effective=effective)
             else:
                 raise CommandError('Either --list or --host must be specified')
         except CommandError, e:
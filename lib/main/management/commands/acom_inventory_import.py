@@ -0,0 +1,218 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+from optparse import make_option
+import os
+import re
+import shlex
+import subprocess
+from django.core.exceptions import ValidationError
+from django.core.management.base import NoArgsCommand, CommandError
+
+def expand_host_pattern(pattern):
+    '''
+    Expand numeric or alphabetic ranges in a host name from an INI inventory,
+    e.g. web[01:03].example.com or db-[a:c].
+    '''
+    match = re.match(r'^(.*?)\[([0-9a-z]+):([0-9a-z]+)\](.*)$', pattern)
+    if not match:
+        return [pattern]
+    head, start, end, tail = match.groups()
+    if start.isdigit() and end.isdigit():
+        width = len(start) if start.startswith('0') else 0
+        values = ['%0*d' % (width, n) for n in xrange(int(start), int(end) + 1)]
+    elif len(start) == 1 and len(end) == 1 and start.isalpha() and end.isalpha():
+        values = [chr(n) for n in xrange(ord(start), ord(end) + 1)]
+    else:
+        raise ValueError('invalid range in host pattern %s' % pattern)
+    return [head + value + rest for value in values for rest in expand_host_pattern(tail)]
+
+class InventorySource(object):
+    '''
+    Hosts, groups and variables read from an INI inventory file or returned
+    by an inventory script.  As in ansible, the group named all holds every
+    host, so its variables are the inventory's own rather than a group's.
+    '''
+
+    def __init__(self):
+        # variables of the all group
+        self.variables = {}
+        # host name -> dict of variables
+        self.hosts = {}
+        # group name -> dict of variables, hosts and children
+        self.groups = {}
+
+    def add_host(self, name, variables=None):
+        self.hosts.setdefault(name, {}).update(variables or {})
+
+    def get_group(self, name):
+        return self.groups.setdefault(name, {'vars': {}, 'hosts': set(), 'children': set()})
+
+    def load_ini(self, path):
+        group_name, section = None, 'hosts'
+        for lineno, line in enumerate(file(path, 'rb'), 1):
+            line = line.strip()
+            if not line or line.startswith('#') or line.startswith(';'):
+                continue
+            # section headers may be followed by a comment
+            match = re.match(r'^\[([^\]:]+)(?::(\w+))?\]\s*(?:[#;].*)?$', line)
+            if match:
+                group_name, section = match.group(1), match.group(2) or 'hosts'
+                if section not in ('hosts', 'vars', 'children'):
+                    raise CommandError('%s:%d: unknown section type %s' % (path, lineno, section))
+                if group_name == 'all':
+                    group_name = None
+                else:
+                    self.get_group(group_name)
+                continue
+            if line.startswith('['):
+                raise CommandError('%s:%d: invalid section header "%s"' % (path, lineno, line))
+            try:
+                tokens = shlex.split(line, comments=True)
+                if section == 'vars':
+                    key, value = line.split('=', 1)
+                    if group_name is None:
+                        self.variables[key.strip()] = value.strip()
+                    else:
+                        self.get_group(group_name)['vars'][key.strip()] = value.strip()
+                elif section == 'children':
+                    self.get_group(tokens[0])
+                    if group_name is not None:
+                        self.get_group(group_name)['children'].add(tokens[0])
+                else:
+                    variables = dict([token.split('=', 1) for token in tokens[1:]])
+                    # host:port is shorthand for ansible_ssh_port
+                    match = re.match(r'^(.*?):(\d+)$', tokens[0])
+                    pattern = tokens[0]
+                    if match:
+                        pattern = match.group(1)
+                        variables['ansible_ssh_port'] = match.group(2)
+                    for host_name in expand_host_pattern(pattern):
+                        self.add_host(host_name, variables)
+                        if group_name is not None:
+                            self.get_group(group_name)['hosts'].add(host_name)
+            except ValueError, e:
+                raise CommandError('%s:%d: unable to parse "%s" (%s)' % (path, lineno, line, e))
+
+    def run_script(self, path, *args):
+        proc = subprocess.Popen([path] + list(args), stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            raise CommandError('%s %s failed (%d): %s' % (path, ' '.join(args),
+                                                         proc.returncode, stderr))
+        try:
+            return json.loads(stdout)
+        except ValueError:
+            raise CommandError('%s %s returned invalid JSON' % (path, ' '.join(args)))
+
+    def load_script(self, path):
+        data = self.run_script(path, '--list')
+        # Scripts that include variables for every host in _meta don't need
+        # to be run again for each host.
+        hostvars = data.pop('_meta', {}).get('hostvars', None)
+        for group_name, info in data.items():
+            if isinstance(info, list):
+                info = {'hosts': info}
+            if group_name == 'all':
+                self.variables.update(info.get('vars', {}))
+                group = {'hosts': set(), 'children': set()}
+            else:
+                group = self.get_group(group_name)
+                group['vars'].update(info.get('vars', {}))
+            for host_name in info.get('hosts', []):
+                self.add_host(host_name)
+                group['hosts'].add(host_name)
+            for child_name in info.get('children', []):
+                self.get_group(child_name)
+                group['children'].add(child_name)
+        for host_name in self.hosts:
+            if hostvars is None:
+                self.add_host(host_name, self.run_script(path, '--host', host_name))
+            else:
+                self.add_host(host_name, hostvars.get(host_name, {}))
+
+    def load(self, path):
+        if not os.path.exists(path):
+            raise CommandError('Inventory source %s not found' % path)
+        if os.access(path, os.X_OK) and not os.path.isdir(path):
+            self.load_script(path)
+        else:
+            self.load_ini(path)
+
+    def add_to(self, loader):
+        '''
+        Add everything to an InventoryLoader.  Empty variables only replace
+        existing ones when overwriting.
+        '''
+        empty = {} if loader.overwrite else None
+        loader.set_inventory_variables(self.variables or empty)
+        for host_name, variables in self.hosts.items():
+            loader.add_host(host_name, variables or empty)
+        for group_name, group in self.groups.items():
+            loader.add_group(group_name, group['vars'] or empty)
+            for host_name in group['hosts']:
+                loader.add_group_host(group_name, host_name)
+            for child_name in group['children']:
+                loader.add_group_child(group_name, child_name)
+
+class Command(NoArgsCommand):
+    '''
+    Management command to import hosts, groups and variables from an existing
+    Ansible INI inventory file or inventory script.
+    '''
+
+    help = 'Import or sync hosts and groups from an Ansible inventory file or script'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('-i', '--inventory', dest='inventory', type='int', default=0,
+                    help='Inventory ID to import into'),
+        make_option('--source', dest='source', default='',
+                    help='INI inventory file or executable inventory script'),
+        make_option('--overwrite', action='store_true', dest='overwrite',
+                    default=False, help='Remove hosts, groups and group '
+                    'memberships not in the source and clear variables not '
+                    'given by it'),
+    )
+
+    def handle_noargs(self, **options):
+        from lib.main.models import Inventory
+        from lib.main.bulk import InventoryLoader
+        inventory_id = options.get('inventory', 0)
+        if not inventory_id:
+            raise CommandError('No inventory ID specified')
+        try:
+            inventory = Inventory.objects.get(id=inventory_id)
+        except Inventory.DoesNotExist:
+            raise CommandError('Inventory with ID %d not found' % inventory_id)
+        source_path = options.get('source', '')
+        if not source_path:
+            raise CommandError('No inventory source specified')
+        source = InventorySource()
+        source.load(source_path)
+        # Everything is compared with the inventory and only the differences
+        # are written, in a single transaction.
+        loader = InventoryLoader(inventory, overwrite=options.get('overwrite', False))
+        source.add_to(loader)
+        try:
+            result = loader.save()
+        except ValidationError, e:
+            raise CommandError('; '.join(e.messages))
+        self.stdout.write('%s\n' % ', '.join(['%s: %d' % (key.replace('_', ' '), value)
+                                              for key, value in sorted(result.items())]))
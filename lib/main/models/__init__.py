@@ -16,11 +16,19 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
-from django.db import models
+import functools
+import hashlib
+import json
+import uuid
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
 from django.db.models import CASCADE, SET_NULL, PROTECT
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, get_script_prefix, get_urlconf
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.utils.timezone import now
 import exceptions
 from jsonfield import JSONField
@@ -72,6 +80,89 @@ PERMISSION_TYPE_CHOICES = [
     (PERM_INVENTORY_CHECK, _('Deploy To Inventory (Dry Run)')),
 ]
 
+# URL templates for views taking a pk, by (view, urlconf, script prefix)
+_pk_url_templates = {}
+_PK_URL_PLACEHOLDER = '8675309000'
+
+def reverse_pk(view, pk):
+    '''
+    Return the same URL as reverse(view, args=(pk,)), but only resolve the URL
+    once for each view and fill in the pk after that.
+    '''
+    key = (view, get_urlconf(), get_script_prefix())
+    template = _pk_url_templates.get(key, None)
+    if template is None:
+        url = reverse(view, args=(_PK_URL_PLACEHOLDER,))
+        template = url.replace('%', '%%').replace(_PK_URL_PLACEHOLDER, '%s')
+        _pk_url_templates[key] = template
+    return template % pk
+
+class UserAccessCache(object):
+    '''
+    Request-scoped cache of permission decisions for a user.  CustomRbac
+    installs one on request.user; the can_user_* methods use it when present
+    and otherwise query the database directly.  The user's memberships and
+    inventory permissions are all loaded with a few queries on first use.
+    '''
+
+    def __init__(self, user):
+        self.user = user
+        self.decisions = {}
+        self._memberships = None
+
+    @classmethod
+    def install(cls, user):
+        if getattr(user, '_access_cache', None) is None:
+            user._access_cache = cls(user)
+        return user._access_cache
+
+    @classmethod
+    def memberships_for(cls, user):
+        ''' return the cached memberships for the user, or None if not installed '''
+        access_cache = getattr(user, '_access_cache', None)
+        if access_cache is None:
+            return None
+        return access_cache.memberships
+
+    @property
+    def memberships(self):
+        if self._memberships is None:
+            self._memberships = UserMemberships(self.user)
+        return self._memberships
+
+class UserMemberships(object):
+    ''' organizations, teams and inventory permissions for a user '''
+
+    def __init__(self, user):
+        self.organization_ids = set(user.organizations.values_list('pk', flat=True))
+        self.admin_of_organization_ids = set(user.admin_of_organizations.values_list('pk', flat=True))
+        self.team_ids = set(user.teams.values_list('pk', flat=True))
+        # permission types granted to the user directly or through a team, by
+        # inventory ID
+        self.inventory_permissions = {}
+        permissions = Permission.objects.filter(models.Q(user=user) | models.Q(team__in=self.team_ids))
+        for inventory_id, permission_type in permissions.values_list('inventory_id', 'permission_type'):
+            self.inventory_permissions.setdefault(inventory_id, set()).add(permission_type)
+
+    def has_inventory_permission_types(self, inventory_id, allowed):
+        return bool(self.inventory_permissions.get(inventory_id, set()) & set(allowed))
+
+def cache_access_decision(func):
+    '''
+    Decorator for can_user_*(cls, user, obj) classmethods to remember their
+    result for the rest of the request, when an access cache is installed.
+    '''
+    @functools.wraps(func)
+    def wrapper(cls, user, obj, *args):
+        access_cache = getattr(user, '_access_cache', None)
+        if access_cache is None or getattr(obj, 'pk', None) is None:
+            return func(cls, user, obj, *args)
+        key = (cls.__name__, obj.__class__.__name__, obj.pk, func.__name__) + args
+        if key not in access_cache.decisions:
+            access_cache.decisions[key] = func(cls, user, obj, *args)
+        return access_cache.decisions[key]
+    return wrapper
+
 class EditHelper(object):
 
     @classmethod
@@ -104,6 +195,7 @@ class UserHelper(object):
     admin_only_edit_fields = ('last_name', 'first_name', 'username', 'is_active', 'is_superuser')
 
     @classmethod
+    @cache_access_decision
     def can_user_administrate(cls, user, obj):
         ''' a user can be administrated if they are themselves, or by org admins or superusers '''
         if user == obj:
@@ -116,10 +208,15 @@ class UserHelper(object):
     @classmethod
     def can_user_read(cls, user, obj):
         ''' a user can be read if they are on the same team or can be administrated '''
-        matching_teams = user.teams.filter(users__in = [ user ]).count()
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            matching_teams = len(memberships.team_ids)
+        else:
+            matching_teams = user.teams.filter(users__in = [ user ]).count()
         return matching_teams or cls.can_user_administrate(user, obj)
 
     @classmethod
+    @cache_access_decision
     def can_user_delete(cls, user, obj):
         if user.is_superuser:
             return True
@@ -216,7 +313,7 @@ class Tag(models.Model):
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_TagsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_TagsDetail, self.pk)
 
     @classmethod
     def can_user_add(cls, user, data):
@@ -260,7 +357,7 @@ class Organization(CommonModel):
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_OrganizationsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_OrganizationsDetail, self.pk)
 
     @classmethod
     def can_user_delete(cls, user, obj):
@@ -271,14 +368,22 @@ class Organization(CommonModel):
         # FIXME: super user checks should be higher up so we don't have to repeat them
         if user.is_superuser:
             return True
-        if obj.created_by == user:
+        if obj.created_by_id == user.pk:
             return True
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            return obj.pk in memberships.admin_of_organization_ids
         rc = user in obj.admins.all()
         return rc
 
     @classmethod
     def can_user_read(cls, user, obj):
-        return cls.can_user_administrate(user,obj) or user in obj.users.all()
+        if cls.can_user_administrate(user, obj):
+            return True
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            return obj.pk in memberships.organization_ids
+        return user in obj.users.all()
 
     @classmethod
     def can_user_delete(cls, user, obj):
@@ -298,15 +403,35 @@ class Inventory(CommonModel):
         unique_together = (("name", "organization"),)
 
     organization = models.ForeignKey(Organization, null=False, related_name='inventories')
+    # Variables for every host in the inventory, below those of any group,
+    # like ansible's "all" group.
+    variable_data = models.ForeignKey('VariableData', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='inventories')
+    # Changed whenever hosts, groups or their variables change, to identify
+    # the cached inventory snapshot for the current contents.
+    snapshot_version = models.CharField(max_length=32, blank=True, default='', editable=False)
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_InventoryDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_InventoryDetail, self.pk)
+
+    @classmethod
+    def update_snapshot_version(cls, pks):
+        ''' mark the cached snapshots for the given inventories as out of date '''
+        pks = set(filter(None, pks))
+        if not pks:
+            return None
+        snapshot_version = uuid.uuid4().hex
+        cls.objects.filter(pk__in=pks).update(snapshot_version=snapshot_version)
+        return snapshot_version
 
     @classmethod
     def _has_permission_types(cls, user, obj, allowed):
         if user.is_superuser:
             return True
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            return obj.organization_id in memberships.admin_of_organization_ids or \
+                   memberships.has_inventory_permission_types(obj.pk, allowed)
         by_org_admin = obj.organization.admins.filter(pk = user.pk).count()
         by_team_permission = obj.permissions.filter(
             team__in = user.teams.all(),
@@ -330,6 +455,12 @@ class Inventory(CommonModel):
 
         if user.is_superuser:
             return True
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            if memberships.organization_ids & memberships.admin_of_organization_ids:
+                return True
+            allowed = set(allowed)
+            return any([bool(x & allowed) for x in memberships.inventory_permissions.values()])
         by_org_admin = user.organizations.filter(
             admins__in = [ user ]
         ).count()
@@ -389,13 +520,14 @@ class Host(CommonModelNameNotUnique):
         app_label = 'main'
         unique_together = (("name", "inventory"),)
 
-    variable_data  = models.OneToOneField('VariableData', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='host')
+    variable_data  = models.ForeignKey('VariableData', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='hosts')
     inventory      = models.ForeignKey('Inventory', null=False, related_name='hosts')
 
     def __unicode__(self):
         return self.name
 
     @classmethod
+    @cache_access_decision
     def can_user_read(cls, user, obj):
         return Inventory.can_user_read(user, obj.inventory)
 
@@ -409,7 +541,7 @@ class Host(CommonModelNameNotUnique):
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_HostsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_HostsDetail, self.pk)
 
     # relationship to LaunchJobStatus
     # relationship to LaunchJobStatusEvent
@@ -427,7 +559,7 @@ class Group(CommonModelNameNotUnique):
 
     inventory     = models.ForeignKey('Inventory', null=False, related_name='groups')
     parents       = models.ManyToManyField('self', symmetrical=False, related_name='children', blank=True)
-    variable_data = models.OneToOneField('VariableData', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='group')
+    variable_data = models.ForeignKey('VariableData', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='groups')
     hosts         = models.ManyToManyField('Host', related_name='groups', blank=True)
 
     def __unicode__(self):
@@ -447,43 +579,273 @@ class Group(CommonModelNameNotUnique):
         return Inventory._has_permission_types(user, obj.inventory, PERMISSION_TYPES_ALLOWING_INVENTORY_WRITE)
 
     @classmethod
+    @cache_access_decision
     def can_user_read(cls, user, obj):
         return Inventory.can_user_read(user, obj.inventory)
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_GroupsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_GroupsDetail, self.pk)
+
+class GroupAncestry(models.Model):
+    '''
+    Closure table of the group hierarchy: one row for each group and every
+    one of its ancestors, including the group itself at depth 0, so hosts or
+    groups at any depth can be found with a single join.  depth is the length
+    of the shortest path from the ancestor.  Paths only run through active
+    groups: an inactive group has just its own row.
+    '''
+
+    class Meta:
+        app_label = 'main'
+        unique_together = (('ancestor', 'descendant'),)
+        verbose_name_plural = _('group ancestries')
+
+    ancestor   = models.ForeignKey('Group', related_name='descendant_links', on_delete=CASCADE)
+    descendant = models.ForeignKey('Group', related_name='ancestor_links', on_delete=CASCADE)
+    depth      = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def check_edge(cls, parent_pk, child_pk):
+        ''' raise ValidationError if the child group is already above the parent '''
+        if parent_pk == child_pk or cls.objects.filter(ancestor=child_pk, descendant=parent_pk).exists():
+            raise ValidationError('Adding group %d as a parent of group %d would create a cycle' % (parent_pk, child_pk))
+
+    @classmethod
+    def add_edge(cls, parent_pk, child_pk):
+        '''
+        Add rows for a new parent/child edge: every ancestor of the parent
+        becomes an ancestor of every descendant of the child.
+        '''
+        ancestors = dict(cls.objects.filter(descendant=parent_pk).values_list('ancestor', 'depth'))
+        descendants = dict(cls.objects.filter(ancestor=child_pk).values_list('descendant', 'depth'))
+        rows = []
+        # groups added in bulk may not have their own row yet
+        for pk, related in ((parent_pk, ancestors), (child_pk, descendants)):
+            if pk not in related:
+                rows.append(cls(ancestor_id=pk, descendant_id=pk, depth=0))
+                related[pk] = 0
+        existing = cls.objects.filter(
+            ancestor__in=cls.objects.filter(descendant=parent_pk).values('ancestor'),
+            descendant__in=cls.objects.filter(ancestor=child_pk).values('descendant'),
+        )
+        existing = dict([((a, d), (pk, depth)) for pk, a, d, depth in
+                         existing.values_list('pk', 'ancestor', 'descendant', 'depth')])
+        for ancestor_pk, ancestor_depth in ancestors.items():
+            for descendant_pk, descendant_depth in descendants.items():
+                depth = ancestor_depth + 1 + descendant_depth
+                if (ancestor_pk, descendant_pk) not in existing:
+                    rows.append(cls(ancestor_id=ancestor_pk, descendant_id=descendant_pk, depth=depth))
+                elif existing[(ancestor_pk, descendant_pk)][1] > depth:
+                    cls.objects.filter(pk=existing[(ancestor_pk, descendant_pk)][0]).update(depth=depth)
+        cls.objects.bulk_create(rows)
+
+    @classmethod
+    def remove_edges(cls, child_pks):
+        '''
+        Update rows after edges to the parents of the given child groups
+        were removed.  Only rows for the children and the groups below them
+        can change, so just those are recomputed from the remaining edges.
+        '''
+        descendants = cls.objects.filter(ancestor__in=child_pks).values('descendant')
+        rows = cls.objects.filter(descendant__in=descendants)
+        existing = dict([((a, d), (pk, depth)) for pk, a, d, depth in
+                         rows.values_list('pk', 'ancestor', 'descendant', 'depth')])
+        # Every path that remains runs through groups that were already
+        # ancestors.
+        parents = {}
+        group_parents = cls.get_active_edges().filter(from_group__in=rows.values('ancestor'))
+        for child_pk, parent_pk in group_parents.values_list('from_group_id', 'to_group_id'):
+            parents.setdefault(child_pk, []).append(parent_pk)
+        depths = {}
+        for descendant_pk in set([d for a, d in existing]):
+            for ancestor_pk, depth in cls.get_depths(parents, descendant_pk).items():
+                depths[(ancestor_pk, descendant_pk)] = depth
+        stale = [pk for key, (pk, depth) in existing.items() if key not in depths]
+        for n in xrange(0, len(stale), 500):
+            cls.objects.filter(pk__in=stale[n:n + 500]).delete()
+        rows = []
+        for (ancestor_pk, descendant_pk), depth in depths.items():
+            if (ancestor_pk, descendant_pk) not in existing:
+                rows.append(cls(ancestor_id=ancestor_pk, descendant_id=descendant_pk, depth=depth))
+            elif existing[(ancestor_pk, descendant_pk)][1] != depth:
+                # the shortest remaining path is longer
+                cls.objects.filter(pk=existing[(ancestor_pk, descendant_pk)][0]).update(depth=depth)
+        cls.objects.bulk_create(rows)
+
+    @classmethod
+    def get_active_edges(cls):
+        ''' return parent/child rows between active groups (from_group is the child) '''
+        return Group.parents.through.objects.filter(from_group__active=True, to_group__active=True)
+
+    @classmethod
+    def get_depths(cls, parents, group):
+        '''
+        Return a dict of each ancestor of group (and group itself) to its
+        depth, given a dict of each group to a list of its parents, raising
+        ValidationError if group is its own ancestor.
+        '''
+        # breadth first, so each ancestor is first reached by the shortest path
+        depths = {group: 0}
+        frontier = [group]
+        while frontier:
+            next_frontier = []
+            for child in frontier:
+                for parent in parents.get(child, []):
+                    if parent == group:
+                        raise ValidationError('Group %s is its own ancestor' % group)
+                    if parent not in depths:
+                        depths[parent] = depths[child] + 1
+                        next_frontier.append(parent)
+            frontier = next_frontier
+        return depths
+
+    @classmethod
+    def rebuild(cls, inventory_ids):
+        '''
+        Recompute all rows for groups in the given inventories, raising
+        ValidationError if their groups contain a cycle.
+        '''
+        for inventory_id in inventory_ids:
+            parents = {}
+            group_parents = cls.get_active_edges().filter(from_group__inventory=inventory_id)
+            for child_pk, parent_pk in group_parents.values_list('from_group_id', 'to_group_id'):
+                parents.setdefault(child_pk, []).append(parent_pk)
+            rows = []
+            for pk in Group.objects.filter(inventory=inventory_id).values_list('pk', flat=True):
+                rows.extend([cls(ancestor_id=ancestor_pk, descendant_id=pk, depth=depth)
+                             for ancestor_pk, depth in cls.get_depths(parents, pk).items()])
+            cls.objects.filter(descendant__inventory=inventory_id).delete()
+            cls.objects.bulk_create(rows)
 
 # FIXME: audit nullables
 # FIXME: audit cascades
 
 class VariableData(CommonModelNameNotUnique):
     '''
-    A set of host or group variables
+    A set of host or group variables, which may be shared by any number of
+    hosts and groups with the same variables.  There is only one row for
+    each set of variables, and a row used by more than one host or group
+    can't be changed; use replace_for() to give a host or group new
+    variables.
     '''
 
     class Meta:
         app_label = 'main'
         verbose_name_plural = _('variable data')
 
-    #host  = models.OneToOneField('Host', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='variable_data')
-    #group = models.OneToOneField('Group', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='variable_data')
-    data  = models.TextField() # FIXME: JsonField
+    # data is kept as canonical JSON (sorted keys), so identical variables
+    # have the same data_hash.
+    data      = models.TextField() # FIXME: JsonField
+    data_hash = models.CharField(max_length=40, blank=True, default='', unique=True, editable=False)
+
+    # data_hash -> parsed variables, shared by every VariableData with the
+    # same contents.
+    _parsed_cache = {}
 
     def __unicode__(self):
         return '%s = %s' % (self.name, self.data)
 
+    def save(self, *args, **kwargs):
+        try:
+            self.data, self.data_hash = self.encode(json.loads(self.data or '{}'))
+        except ValueError:
+            self.data_hash = hashlib.sha1(self.data.encode('utf-8')).hexdigest()
+        if self.pk is not None and self.get_referrer_count() > 1:
+            saved = VariableData.objects.filter(pk=self.pk).values_list('data_hash', flat=True)
+            if list(saved) != [self.data_hash]:
+                raise ValidationError('Variable data %d is shared by more than one host or group' % self.pk)
+        super(VariableData, self).save(*args, **kwargs)
+
+    def get_referrer_count(self):
+        ''' return the number of hosts, groups and inventories using these variables '''
+        return self.hosts.count() + self.groups.count() + self.inventories.count()
+
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_VariableDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_VariableDetail, self.pk)
+
+    @classmethod
+    def encode(cls, variables):
+        ''' return the canonical JSON for variables and its hash '''
+        data = json.dumps(variables, sort_keys=True, separators=(',', ':'))
+        return data, hashlib.sha1(data).hexdigest()
+
+    @classmethod
+    def parse(cls, data_hash, data):
+        '''
+        Return the variables for data, which is only parsed once for each
+        data_hash.  The result is shared, so callers must not modify it.
+        '''
+        if data_hash and data_hash in cls._parsed_cache:
+            return cls._parsed_cache[data_hash]
+        try:
+            variables = json.loads(data or '{}')
+        except ValueError:
+            variables = {}
+        if data_hash:
+            if len(cls._parsed_cache) >= getattr(settings, 'VARIABLE_DATA_CACHE_SIZE', 10000):
+                cls._parsed_cache.clear()
+            cls._parsed_cache[data_hash] = variables
+        return variables
+
+    @property
+    def variables(self):
+        return self.parse(self.data_hash, self.data)
+
+    @classmethod
+    def get_or_create_for(cls, variables, created_by=None):
+        ''' return the VariableData for variables, creating it if needed '''
+        data, data_hash = cls.encode(variables)
+        existing = list(cls.objects.filter(data_hash=data_hash)[:1])
+        if existing:
+            return existing[0]
+        sid = transaction.savepoint()
+        try:
+            obj = cls.objects.create(data=data, created_by=created_by)
+        except IntegrityError:
+            # Someone else created it first.
+            transaction.savepoint_rollback(sid)
+            return cls.objects.get(data_hash=data_hash)
+        transaction.savepoint_commit(sid)
+        return obj
+
+    def replace_for(self, obj, variables):
+        '''
+        Set new variables for a host or group currently using this
+        VariableData.  The row is only changed in place when nothing else uses
+        it and no other row already has the new variables.
+        '''
+        data, data_hash = self.encode(variables)
+        if data_hash == self.data_hash:
+            return self
+        if self.get_referrer_count() <= 1 and not VariableData.objects.filter(data_hash=data_hash).exists():
+            sid = transaction.savepoint()
+            try:
+                self.data = data
+                self.save()
+            except IntegrityError:
+                # Another row with the new variables was just created.
+                transaction.savepoint_rollback(sid)
+                self.data, self.data_hash = VariableData.objects.filter(pk=self.pk).values_list('data', 'data_hash')[0]
+            else:
+                transaction.savepoint_commit(sid)
+                return self
+        obj.variable_data = VariableData.get_or_create_for(variables)
+        obj.save()
+        if self.get_referrer_count() == 0:
+            self.delete()
+        return obj.variable_data
 
     @classmethod
     def can_user_read(cls, user, obj):
-        ''' a user can be read if they are on the same team or can be administrated '''
-        if obj.host is not None:
-            return Inventory.can_user_read(user, obj.host.inventory)
-        if obj.group is not None:
-            return Inventory.can_user_read(user, obj.group.inventory)
+        ''' variables can be read by anyone who can read an inventory using them '''
+        inventory_pks = set(obj.hosts.values_list('inventory', flat=True))
+        inventory_pks.update(obj.groups.values_list('inventory', flat=True))
+        inventory_pks.update(obj.inventories.values_list('pk', flat=True))
+        for inventory in Inventory.objects.filter(pk__in=inventory_pks):
+            if Inventory.can_user_read(user, inventory):
+                return True
         return False
 
 class Credential(CommonModelNameNotUnique):
@@ -499,17 +861,14 @@ class Credential(CommonModelNameNotUnique):
     user            = models.ForeignKey('auth.User', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='credentials')
     team            = models.ForeignKey('Team', null=True, default=None, blank=True, on_delete=SET_NULL, related_name='credentials')
 
-    # IF ssh_key_path is SET
+    # IF ssh_key_data is SET
     #
     # STAGE 1: SSH KEY SUPPORT
     #
-    # ssh-agent bash &
-    # save keyfile to tempdir in /var/tmp (permissions guarded)
-    # ssh-add path-to-keydata
-    # key could locked or unlocked, so use 'expect like' code to enter it at the prompt
-    #    if key is locked:
-    #       if ssh_key_unlock is provided provide key password
-    #       if not provided, FAIL
+    # Launch jobs get an ssh-agent with the key from lib.main.credentials,
+    # which adds the key with ssh_key_unlock as its passphrase (failing if
+    # the key is locked and it isn't given) and keeps the agent for later
+    # jobs using the same credential.
     #
     # default_username if set corresponds to -u on ansible-playbook, if unset -u root
     #
@@ -533,6 +892,7 @@ class Credential(CommonModelNameNotUnique):
     sudo_password    = models.CharField(blank=True, default='', max_length=1024)
 
     @classmethod
+    @cache_access_decision
     def can_user_administrate(cls, user, obj):
         if user.is_superuser:
             return True
@@ -565,7 +925,7 @@ class Credential(CommonModelNameNotUnique):
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_CredentialsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_CredentialsDetail, self.pk)
 
 class Team(CommonModel):
     '''
@@ -581,13 +941,16 @@ class Team(CommonModel):
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_TeamsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_TeamsDetail, self.pk)
 
     @classmethod
     def can_user_administrate(cls, user, obj):
         # FIXME -- audit when this is called explicitly, if any
         if user.is_superuser:
             return True
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            return obj.organization_id in memberships.admin_of_organization_ids
         if user in obj.organization.admins.all():
             return True
         return False
@@ -596,6 +959,9 @@ class Team(CommonModel):
     def can_user_read(cls, user, obj):
         if cls.can_user_administrate(user, obj):
             return True
+        memberships = UserAccessCache.memberships_for(user)
+        if memberships is not None:
+            return obj.pk in memberships.team_ids
         if obj.users.filter(pk__in = [ user.pk ]).count():
             return True
         return False
@@ -622,11 +988,14 @@ class Project(CommonModel):
     inventories      = models.ManyToManyField('Inventory', blank=True, related_name='projects')
     local_repository = models.CharField(max_length=1024)
     scm_type         = models.CharField(max_length=64)
+    # Branch, tag or commit launch jobs check out from git projects (the
+    # repository's HEAD if blank).
+    scm_branch       = models.CharField(max_length=1024, blank=True, default='')
     default_playbook = models.CharField(max_length=1024)
 
     def get_absolute_url(self):
         import lib.urls
-        return reverse(lib.urls.views_ProjectsDetail, args=(self.pk,))
+        return reverse_pk(lib.urls.views_ProjectsDetail, self.pk)
 
     @classmethod
     def can_user_administrate(cls, user, obj):
@@ -693,6 +1062,69 @@ class Permission(CommonModelNameNotUnique):
             self.permission_type
         ))
 
+class InventoryAccess(models.Model):
+    '''
+    The effective permissions of a user on an inventory, from being an admin
+    of its organization or from user and team permissions.  This lets lists
+    of inventories, hosts and groups be filtered with a single join.  Rows
+    only exist when the user can at least read the inventory, and are kept
+    current by the signal handlers below.
+    '''
+
+    class Meta:
+        app_label = 'main'
+        unique_together = (('user', 'inventory'),)
+        verbose_name_plural = _('inventory access')
+
+    user      = models.ForeignKey('auth.User', related_name='inventory_accesses', on_delete=CASCADE)
+    inventory = models.ForeignKey('Inventory', related_name='accesses', on_delete=CASCADE)
+    can_read  = models.BooleanField(default=False)
+    can_write = models.BooleanField(default=False)
+    can_admin = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return unicode('InventoryAccess(user=%s,inventory=%s)' % (self.user_id, self.inventory_id))
+
+    @classmethod
+    def rebuild(cls, user_ids=None, inventory_ids=None):
+        '''
+        Recompute access for the given users and/or inventories (or for
+        everything when neither is given).
+        '''
+        inventories = Inventory.objects.all()
+        permissions = Permission.objects.filter(inventory__isnull=False,
+                                                permission_type__in=PERMISSION_TYPES_ALLOWING_INVENTORY_READ)
+        existing = cls.objects.all()
+        if user_ids is not None:
+            user_ids = set(filter(None, user_ids))
+            inventories = inventories.filter(organization__admins__in=user_ids)
+            permissions = permissions.filter(models.Q(user__in=user_ids) | models.Q(team__users__in=user_ids))
+            existing = existing.filter(user__in=user_ids)
+        if inventory_ids is not None:
+            inventory_ids = set(filter(None, inventory_ids))
+            inventories = inventories.filter(pk__in=inventory_ids)
+            permissions = permissions.filter(inventory__in=inventory_ids)
+            existing = existing.filter(inventory__in=inventory_ids)
+
+        # permission types for each (user ID, inventory ID)
+        granted = {}
+        for inventory_id, user_id in inventories.values_list('pk', 'organization__admins'):
+            granted.setdefault((user_id, inventory_id), set()).add(PERM_INVENTORY_ADMIN)
+        for inventory_id, user_id, permission_type in permissions.values_list('inventory', 'user', 'permission_type'):
+            granted.setdefault((user_id, inventory_id), set()).add(permission_type)
+        for inventory_id, user_id, permission_type in permissions.values_list('inventory', 'team__users', 'permission_type'):
+            granted.setdefault((user_id, inventory_id), set()).add(permission_type)
+
+        accesses = []
+        for (user_id, inventory_id), permission_types in granted.items():
+            if user_id is None or (user_ids is not None and user_id not in user_ids):
+                continue
+            accesses.append(cls(user_id=user_id, inventory_id=inventory_id, can_read=True,
+                                can_write=bool(permission_types & set(PERMISSION_TYPES_ALLOWING_INVENTORY_WRITE)),
+                                can_admin=bool(permission_types & set(PERMISSION_TYPES_ALLOWING_INVENTORY_ADMIN))))
+        existing.delete()
+        cls.objects.bulk_create(accesses)
+
 # TODO: other job types (later)
 
 class LaunchJob(CommonModel):
@@ -711,18 +1143,46 @@ class LaunchJob(CommonModel):
 
     # JOB_TYPE_CHOICES are a subset of PERMISSION_TYPE_CHOICES
     job_type       = models.CharField(max_length=64, choices=JOB_TYPE_CHOICES)
+    # Number of ansible-playbook processes to split the inventory's hosts
+    # between when running the job.
+    slice_count    = models.PositiveIntegerField(default=1)
+
+    def _create_status(self, priority=0):
+        # The slices are created along with their parent so the scheduler
+        # never sees a parent without them.  A caller managing its own
+        # transaction (as a request does) isn't committed partway through.
+        if transaction.is_managed():
+            return self._create_statuses(priority)
+        return transaction.commit_on_success(self._create_statuses)(priority)
+
+    def _create_statuses(self, priority):
+        name = 'Launch Job Status %s' % now().isoformat()
+        slice_count = max(self.slice_count, 1)
+        launch_job_status = self.launch_job_statuses.create(name=name, priority=priority,
+                                                            slice_count=slice_count)
+        if slice_count > 1:
+            for slice_index in xrange(slice_count):
+                self.launch_job_statuses.create(name='%s (slice %d of %d)' % (name, slice_index + 1, slice_count),
+                                                priority=priority, parent=launch_job_status,
+                                                slice_index=slice_index, slice_count=slice_count)
+        return launch_job_status
 
-    def start(self):
+    def start(self, priority=0):
         '''
-        Create a new launch job status and start the task via celery.
+        Create a new launch job status and start the task via celery, or leave
+        it pending until the scheduler has room for it.  Pending statuses with
+        a higher priority are started first.
+
+        When the job is split into slices, the status returned tracks a
+        separate status for each slice, which are run in parallel.
+
+        Scheduling commits the current transaction, so during a request it
+        waits until the request's transaction has been committed (see
+        LaunchJobSchedulerMiddleware).
         '''
-        from lib.main.tasks import run_launch_job
-        launch_job_status = self.launch_job_statuses.create(name='Launch Job Status %s' % now().isoformat())
-        task_result = run_launch_job.delay(launch_job_status.pk)
-        # The TaskMeta instance in the database isn't created until the worker
-        # starts processing the task, so we can only store the task ID here.
-        launch_job_status.celery_task_id = task_result.task_id
-        launch_job_status.save(update_fields=['celery_task_id'])
+        from lib.main.scheduler import schedule
+        launch_job_status = self._create_status(priority)
+        schedule()
         return launch_job_status
 
     # project has one default playbook but really should have a list of playbooks and flags ...
@@ -755,6 +1215,7 @@ class LaunchJobStatus(CommonModel):
         ('successful', _('Successful')),
         ('failed', _('Failed')),
         ('error', _('Error')),
+        ('canceled', _('Canceled')),
     ]
 
     class Meta:
@@ -766,10 +1227,129 @@ class LaunchJobStatus(CommonModel):
     result_stdout    = models.TextField(blank=True, default='')
     result_stderr    = models.TextField(blank=True, default='')
     result_traceback = models.TextField(blank=True, default='')
+    # Full output is streamed to these files while the job runs; the result
+    # fields above only keep the last JOB_OUTPUT_TAIL_SIZE bytes of each.
+    result_stdout_file = models.CharField(max_length=1024, blank=True, default='', editable=False)
+    result_stderr_file = models.CharField(max_length=1024, blank=True, default='', editable=False)
+    # Assigned when the scheduler sends the job to celery; pending statuses
+    # without one are waiting for a free slot.
     celery_task_id   = models.CharField(max_length=100, blank=True, default='', editable=False)
+    admitted         = models.DateTimeField(null=True, default=None, editable=False)
+    # Set when a worker picks the job up and it starts running.
+    started          = models.DateTimeField(null=True, default=None, editable=False)
+    priority         = models.IntegerField(default=0)
+    # A launch job split into slices has a status for each slice, which runs
+    # ansible-playbook against only the hosts in that slice.
+    parent           = models.ForeignKey('self', null=True, default=None, blank=True, on_delete=CASCADE, related_name='slices', editable=False)
+    slice_index      = models.PositiveIntegerField(default=0, editable=False)
+    slice_count      = models.PositiveIntegerField(default=1, editable=False)
+    # Commit the job ran when its project was checked out from git.
+    scm_revision     = models.CharField(max_length=40, blank=True, default='', editable=False)
+    # Set to ask the worker running the job to stop it.
+    cancel_flag      = models.BooleanField(default=False, editable=False)
+    # Byte offset of the next unread event in the callback event spool file.
+    event_spool_offset = models.BigIntegerField(default=0, editable=False)
     #hosts            = models.ManyToManyField('Host', blank=True, related_name='launch_job_statuses')
     # FIXME: Connect hosts based on inventory.
 
+    def get_absolute_url(self):
+        import lib.urls
+        return reverse_pk(lib.urls.views_LaunchJobStatusDetail, self.pk)
+
+    @classmethod
+    def _get_inventory(cls, obj):
+        if obj.launch_job is None:
+            return None
+        return obj.launch_job.inventory
+
+    @classmethod
+    def can_user_read(cls, user, obj):
+        ''' I can see job statuses (and output) when I can see the inventory the job ran against '''
+        if user.is_superuser:
+            return True
+        inventory = cls._get_inventory(obj)
+        if inventory is None:
+            return False
+        return Inventory.can_user_read(user, inventory)
+
+    @classmethod
+    def can_user_administrate(cls, user, obj):
+        if user.is_superuser:
+            return True
+        inventory = cls._get_inventory(obj)
+        if inventory is None:
+            return False
+        return Inventory.can_user_administrate(user, inventory)
+
+    @classmethod
+    def can_user_delete(cls, user, obj):
+        return cls.can_user_administrate(user, obj)
+
+    @property
+    def is_sliced(self):
+        ''' whether this status only tracks the statuses of its slices '''
+        return self.slice_count > 1 and self.parent_id is None
+
+    @transaction.commit_on_success
+    def update_from_slices(self):
+        '''
+        Set the status of a sliced launch job from the statuses of its
+        slices: running while any slice is, then the worst result of any of
+        them.  Tracebacks from the slices are collected once all are done.
+        '''
+        # Slices finishing at the same time take turns, so the last one
+        # always sees every other slice finished.
+        list(LaunchJobStatus.objects.select_for_update().filter(pk=self.pk).values_list('pk'))
+        slices = self.slices.order_by('slice_index')
+        statuses = set(slices.values_list('status', flat=True))
+        result_traceback = ''
+        if statuses <= set(['pending']):
+            status = 'pending'
+        elif statuses & set(['pending', 'running']):
+            status = 'running'
+        else:
+            for status in ('error', 'canceled', 'failed', 'successful'):
+                if status in statuses:
+                    break
+            result_traceback = '\n'.join(['%s:\n%s' % (name, tb) for name, tb in
+                                          slices.values_list('name', 'result_traceback') if tb])
+        LaunchJobStatus.objects.filter(pk=self.pk).update(status=status,
+                                                          result_traceback=result_traceback)
+
+    @property
+    def can_cancel(self):
+        return self.status in ('pending', 'running')
+
+    def cancel(self):
+        '''
+        Stop the job (or all of its slices), returning False if it had
+        already finished.  Jobs that haven't started are canceled right
+        away; running jobs are stopped by their worker, which checks
+        cancel_flag while the playbook runs.  As with LaunchJob.start, other
+        jobs are only scheduled into the freed slot once a request's
+        transaction has been committed.
+        '''
+        from lib.main.scheduler import schedule
+        pks = [self.pk] + list(self.slices.values_list('pk', flat=True))
+        statuses = LaunchJobStatus.objects.filter(pk__in=pks)
+        if not statuses.filter(status__in=('pending', 'running')).update(cancel_flag=True):
+            return False
+        # A worker only starts jobs that are still pending.
+        statuses.filter(status='pending').update(status='canceled')
+        if self.is_sliced:
+            self.update_from_slices()
+        elif self.parent is not None:
+            self.parent.update_from_slices()
+        self.status = LaunchJobStatus.objects.get(pk=self.pk).status
+        # Jobs canceled before they started don't use a slot any more.
+        schedule()
+        return True
+
+    def get_events(self):
+        ''' return events logged for this status or any of its slices '''
+        return LaunchJobStatusEvent.objects.filter(models.Q(launch_job_status=self) |
+                                                   models.Q(launch_job_status__parent=self))
+
     @property
     def celery_task(self):
         try:
@@ -815,4 +1395,200 @@ class LaunchJobStatusEvent(models.Model):
 
     # FIXME: Connect host based on event_data.
 
+class ModelVersion(models.Model):
+    '''
+    A counter for each model in MODEL_VERSION_MODELS, increased whenever
+    any instance of the model (or one of its many-to-many relationships)
+    changes, used to generate ETags for API responses.
+    '''
+
+    class Meta:
+        app_label = 'main'
+
+    model   = models.CharField(max_length=100, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    def __unicode__(self):
+        return unicode('%s=%d' % (self.model, self.version))
+
+    @classmethod
+    def bump(cls, model):
+        label = '%s.%s' % (model._meta.app_label, model._meta.object_name)
+        if not cls.objects.filter(model=label).update(version=models.F('version') + 1):
+            cls.objects.get_or_create(model=label)
+            cls.objects.filter(model=label).update(version=models.F('version') + 1)
+
+    @classmethod
+    def get_versions(cls, models):
+        ''' return a sorted list of (model, version) for the given models '''
+        labels = ['%s.%s' % (model._meta.app_label, model._meta.object_name) for model in models]
+        return list(cls.objects.filter(model__in=labels).order_by('model').values_list('model', 'version'))
+
 # TODO: reporting (MPD)
+
+# Signal handlers to keep inventory snapshot versions current.  A new random
+# version (rather than a counter) is used so snapshots can't be reused when
+# an inventory primary key is reused.
+
+@receiver(post_save, sender=Inventory)
+def inventory_saved(sender, instance, **kwargs):
+    # Also prevents a stale in-memory snapshot version from being saved back.
+    instance.snapshot_version = Inventory.update_snapshot_version([instance.pk])
+
+@receiver(post_save, sender=Host)
+@receiver(post_delete, sender=Host)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def inventory_contents_changed(sender, instance, **kwargs):
+    Inventory.update_snapshot_version([instance.inventory_id])
+
+@receiver(m2m_changed, sender=Group.hosts.through)
+@receiver(m2m_changed, sender=Group.parents.through)
+def inventory_relationships_changed(sender, instance, action, **kwargs):
+    # instance is either a group or a host, both belong to the inventory
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        Inventory.update_snapshot_version([instance.inventory_id])
+
+@receiver(post_save, sender=VariableData)
+@receiver(pre_delete, sender=VariableData)
+def variable_data_changed(sender, instance, **kwargs):
+    # pre_delete, since hosts and groups are unlinked as it's deleted.
+    pks = list(Host.objects.filter(variable_data=instance).values_list('inventory_id', flat=True))
+    pks.extend(Group.objects.filter(variable_data=instance).values_list('inventory_id', flat=True))
+    pks.extend(Inventory.objects.filter(variable_data=instance).values_list('pk', flat=True))
+    Inventory.update_snapshot_version(pks)
+
+# Signal handlers to keep GroupAncestry current.
+
+@receiver(pre_save, sender=Group)
+def group_ancestry_group_saving(sender, instance, **kwargs):
+    # groups are deleted through the API by marking them inactive
+    instance._active_changed = bool(instance.pk) and Group.objects.filter(
+        pk=instance.pk, active=not instance.active).exists()
+
+@receiver(post_save, sender=Group)
+def group_ancestry_group_saved(sender, instance, created, **kwargs):
+    if created:
+        GroupAncestry.objects.create(ancestor=instance, descendant=instance, depth=0)
+    elif getattr(instance, '_active_changed', False):
+        if instance.active:
+            # rare, and any cycle formed while it was inactive has to be found
+            GroupAncestry.rebuild([instance.inventory_id])
+        else:
+            GroupAncestry.remove_edges([instance.pk])
+
+@receiver(pre_delete, sender=Group)
+def group_ancestry_group_deleting(sender, instance, **kwargs):
+    # The cascade removes its edges without sending m2m_changed.
+    instance.parents.clear()
+    instance.children.clear()
+
+@receiver(m2m_changed, sender=Group.parents.through)
+def group_ancestry_parents_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # instance is the child for group.parents, or the parent for group.children
+    if action in ('pre_add', 'post_add'):
+        inactive_pks = set()
+        if action == 'post_add':
+            inactive_pks = set(Group.objects.filter(pk__in=list(pk_set) + [instance.pk],
+                                                    active=False).values_list('pk', flat=True))
+        for pk in pk_set:
+            parent_pk, child_pk = (instance.pk, pk) if reverse else (pk, instance.pk)
+            if action == 'pre_add':
+                GroupAncestry.check_edge(parent_pk, child_pk)
+            elif parent_pk not in inactive_pks and child_pk not in inactive_pks:
+                GroupAncestry.add_edge(parent_pk, child_pk)
+    elif action == 'pre_clear' and reverse:
+        # the children won't be known once they're removed
+        instance._cleared_child_pks = list(instance.children.values_list('pk', flat=True))
+    elif action == 'post_remove':
+        GroupAncestry.remove_edges(list(pk_set) if reverse else [instance.pk])
+    elif action == 'post_clear':
+        GroupAncestry.remove_edges(getattr(instance, '_cleared_child_pks', []) if reverse else [instance.pk])
+
+# Signal handlers to keep InventoryAccess current.
+
+@receiver(post_save, sender=Inventory)
+def inventory_access_inventory_saved(sender, instance, **kwargs):
+    # the organization (and so its admins) may have changed
+    InventoryAccess.rebuild(inventory_ids=[instance.pk])
+
+@receiver(pre_save, sender=Permission)
+def inventory_access_permission_changing(sender, instance, **kwargs):
+    instance._previous_inventory_id = None
+    if instance.pk:
+        previous = Permission.objects.filter(pk=instance.pk).values_list('inventory', flat=True)
+        instance._previous_inventory_id = previous[0] if previous else None
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def inventory_access_permission_changed(sender, instance, **kwargs):
+    inventory_ids = [instance.inventory_id, getattr(instance, '_previous_inventory_id', None)]
+    InventoryAccess.rebuild(inventory_ids=inventory_ids)
+
+def _m2m_changed_user_ids(instance, action, reverse, pk_set, relationship):
+    '''
+    Return the IDs of users affected by a change to an m2m relationship with
+    users, or None when nothing needs to be rebuilt yet.
+    '''
+    if reverse:
+        # instance is the user
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            return [instance.pk]
+    elif action == 'pre_clear':
+        instance._cleared_user_ids = list(getattr(instance, relationship).values_list('pk', flat=True))
+    elif action == 'post_clear':
+        return getattr(instance, '_cleared_user_ids', [])
+    elif action in ('post_add', 'post_remove'):
+        return pk_set
+    return None
+
+@receiver(m2m_changed, sender=Team.users.through)
+def inventory_access_team_users_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    user_ids = _m2m_changed_user_ids(instance, action, reverse, pk_set, 'users')
+    if user_ids is not None:
+        InventoryAccess.rebuild(user_ids=user_ids)
+
+@receiver(m2m_changed, sender=Organization.admins.through)
+def inventory_access_organization_admins_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    user_ids = _m2m_changed_user_ids(instance, action, reverse, pk_set, 'admins')
+    if user_ids is not None:
+        InventoryAccess.rebuild(user_ids=user_ids)
+
+@receiver(pre_delete, sender=Team)
+def inventory_access_team_deleting(sender, instance, **kwargs):
+    instance._deleted_user_ids = list(instance.users.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Team)
+def inventory_access_team_deleted(sender, instance, **kwargs):
+    InventoryAccess.rebuild(user_ids=getattr(instance, '_deleted_user_ids', []))
+
+# Signal handlers to keep ModelVersion current.  Only models shown by views
+# with ETags are counted, so frequent writes elsewhere (launch job statuses
+# and events, ancestry and access rows) don't update a shared row.
+
+MODEL_VERSION_MODELS = (User, Organization, Team, Permission, Inventory, Host, Group,
+                        VariableData, Credential, Project, LaunchJob, Tag, AuditTrail)
+
+def model_version_instance_changed(sender, **kwargs):
+    # logging in only updates last_login, which isn't shown anywhere
+    if kwargs.get('update_fields', None) == frozenset(['last_login']):
+        return
+    ModelVersion.bump(sender)
+
+def model_version_relationship_changed(sender, instance, action, model, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # both sides of the relationship have changed
+        for changed in (instance.__class__, model):
+            if changed in MODEL_VERSION_MODELS:
+                ModelVersion.bump(changed)
+
+def _connect_model_version_signals():
+    for model in MODEL_VERSION_MODELS:
+        uid = 'model_version_%s' % model._meta.object_name
+        post_save.connect(model_version_instance_changed, sender=model, dispatch_uid=uid)
+        post_delete.connect(model_version_instance_changed, sender=model, dispatch_uid=uid)
+        for field in model._meta.many_to_many:
+            m2m_changed.connect(model_version_relationship_changed, sender=field.rel.through,
+                                dispatch_uid='%s_%s' % (uid, field.name))
+
+_connect_model_version_signals()
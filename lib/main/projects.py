@@ -0,0 +1,227 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import time
+from django.conf import settings
+
+def run_git(*args):
+    ''' run git, returning its output or raising RuntimeError if it fails '''
+    proc = subprocess.Popen(('git',) + args, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, close_fds=True)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('git %s failed (%d): %s' % (' '.join(args), proc.returncode,
+                                                       stderr.strip()))
+    return stdout
+
+def set_writable(path, writable):
+    ''' add or remove write permission on path and everything below it '''
+    for dir_path, dir_names, file_names in os.walk(path):
+        for name in [dir_path] + [os.path.join(dir_path, n) for n in file_names]:
+            mode = os.lstat(name).st_mode
+            if stat.S_ISLNK(mode):
+                continue
+            if writable:
+                mode |= stat.S_IWUSR
+            else:
+                mode &= ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+            os.chmod(name, stat.S_IMODE(mode))
+
+def remove_tree(path):
+    ''' remove a directory tree, even if it was made read-only '''
+    if os.path.isdir(path):
+        set_writable(path, True)
+    shutil.rmtree(path, ignore_errors=True)
+
+def lock_file(path, operation=fcntl.LOCK_EX):
+    ''' return path opened and locked with flock, or None if LOCK_NB was given and it's held '''
+    fileobj = file(path, 'a')
+    try:
+        fcntl.flock(fileobj, operation)
+    except IOError:
+        fileobj.close()
+        if operation & fcntl.LOCK_NB:
+            return None
+        raise
+    return fileobj
+
+class ProjectCheckout(object):
+    '''
+    Git projects are cloned once into a bare mirror under
+    PROJECT_CHECKOUT_DIR, which launch jobs fetch into before they start.
+    The files for each revision used are extracted once into their own
+    directory, which every job at that revision shares, so concurrent jobs
+    never share a working tree that another sync could change.  The files
+    are made read-only once extracted, so one job can't change them under
+    another.
+
+    <PROJECT_CHECKOUT_DIR>/<project pk>/
+        mirror.git        bare mirror of local_repository
+        synced            touched after every successful fetch
+        sync.lock         held while cloning or fetching
+        revisions/<sha>   files at one revision, read-only
+        revisions/<sha>.lock  held (shared) by each job using the revision
+
+    Many jobs starting at once only fetch once: a job waiting for another
+    job's fetch uses its result instead of fetching again.  Revisions beyond
+    the PROJECT_CHECKOUT_KEEP most recently used are removed once no job is
+    using them.
+    '''
+
+    def __init__(self, project):
+        self.project = project
+        self.base_dir = os.path.join(settings.PROJECT_CHECKOUT_DIR, str(project.pk))
+        self.mirror_path = os.path.join(self.base_dir, 'mirror.git')
+        self.synced_path = os.path.join(self.base_dir, 'synced')
+        self.revisions_dir = os.path.join(self.base_dir, 'revisions')
+        self.revision = None
+        self.path = None
+        self.revision_lock = None
+
+    def get_synced_time(self):
+        try:
+            return os.stat(self.synced_path).st_mtime
+        except OSError:
+            return None
+
+    def sync(self, requested=None):
+        '''
+        Clone or fetch the mirror, returning False if it was already fetched
+        after requested (the current time by default) by someone else.
+        '''
+        if requested is None:
+            requested = time.time()
+        if not os.path.exists(self.revisions_dir):
+            os.makedirs(self.revisions_dir)
+        sync_lock = lock_file(os.path.join(self.base_dir, 'sync.lock'))
+        try:
+            synced = self.get_synced_time()
+            if synced is not None and synced >= requested:
+                return False
+            if os.path.exists(self.mirror_path):
+                # Follow the project if its repository has moved.
+                url = run_git('--git-dir', self.mirror_path, 'config', '--get', 'remote.origin.url').strip()
+                if url != self.project.local_repository:
+                    run_git('--git-dir', self.mirror_path, 'remote', 'set-url', 'origin',
+                            self.project.local_repository)
+                run_git('--git-dir', self.mirror_path, 'fetch', '--prune', '--quiet', 'origin')
+            else:
+                temp_path = tempfile.mkdtemp(dir=self.base_dir, prefix='mirror.')
+                try:
+                    run_git('clone', '--mirror', '--quiet', self.project.local_repository, temp_path)
+                    os.rename(temp_path, self.mirror_path)
+                except:
+                    shutil.rmtree(temp_path, ignore_errors=True)
+                    raise
+            file(self.synced_path, 'a').close()
+            os.utime(self.synced_path, None)
+            return True
+        finally:
+            sync_lock.close()
+
+    def get_revision(self):
+        ''' return the commit for the project's scm_branch (or HEAD) in the mirror '''
+        ref = self.project.scm_branch or 'HEAD'
+        try:
+            return run_git('--git-dir', self.mirror_path, 'rev-parse', '--verify',
+                           '--quiet', '%s^{commit}' % ref).strip()
+        except RuntimeError:
+            raise RuntimeError('%s not found in %s' % (ref, self.project.local_repository))
+
+    def extract(self, revision, path):
+        ''' write the files at revision into a new directory at path '''
+        temp_path = tempfile.mkdtemp(dir=self.revisions_dir, prefix='.%s.' % revision)
+        try:
+            proc = subprocess.Popen(['git', '--git-dir', self.mirror_path, 'archive',
+                                     '--format=tar', revision], stdout=subprocess.PIPE,
+                                    close_fds=True)
+            archive = tarfile.open(fileobj=proc.stdout, mode='r|')
+            try:
+                archive.extractall(temp_path)
+            finally:
+                archive.close()
+                proc.stdout.close()
+            if proc.wait() != 0:
+                raise RuntimeError('git archive %s failed (%d)' % (revision, proc.returncode))
+            set_writable(temp_path, False)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Another job extracted the same revision first.
+                if not os.path.isdir(path):
+                    raise
+                remove_tree(temp_path)
+        except:
+            remove_tree(temp_path)
+            raise
+
+    def acquire(self):
+        '''
+        Sync the mirror and make sure the files for the project's current
+        revision are on disk, setting revision and path.  The revision is
+        kept until release() is called.
+        '''
+        self.sync()
+        self.revision = self.get_revision()
+        self.path = os.path.join(self.revisions_dir, self.revision)
+        # Lock before checking for the directory, so it can't be pruned
+        # once it's found.
+        self.revision_lock = lock_file(self.path + '.lock', fcntl.LOCK_SH)
+        try:
+            if not os.path.isdir(self.path):
+                self.extract(self.revision, self.path)
+            # The modification time orders revisions by when they were last used.
+            os.utime(self.path, None)
+        except:
+            self.release()
+            raise
+        self.prune()
+        return self
+
+    def release(self):
+        if self.revision_lock is not None:
+            self.revision_lock.close()
+            self.revision_lock = None
+
+    def prune(self):
+        ''' remove revisions not used recently that no job is using '''
+        keep = getattr(settings, 'PROJECT_CHECKOUT_KEEP', 5)
+        revisions = []
+        for name in os.listdir(self.revisions_dir):
+            path = os.path.join(self.revisions_dir, name)
+            if not name.startswith('.') and not name.endswith('.lock') and os.path.isdir(path):
+                revisions.append((os.stat(path).st_mtime, path))
+        revisions.sort(reverse=True)
+        for mtime, path in revisions[keep:]:
+            if path == self.path:
+                continue
+            # Lock files are left in place, since a job may be about to lock
+            # one to use the revision.
+            revision_lock = lock_file(path + '.lock', fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if revision_lock is None:
+                continue
+            try:
+                remove_tree(path)
+            finally:
+                revision_lock.close()
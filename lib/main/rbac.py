@@ -37,6 +37,8 @@ class CustomRbac(permissions.BasePermission):
         # other users must have associated acom user records & be active
         if not request.user.is_active:
             raise PermissionDenied()
+        # cache permission decisions for the rest of this request
+        UserAccessCache.install(request.user)
         return True
 
     def has_permission(self, request, view, obj=None):
@@ -0,0 +1,209 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import fcntl
+import os
+import threading
+import traceback
+import uuid
+from datetime import timedelta
+from celery import states
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from djcelery.models import TaskMeta
+from lib.main.models import *
+
+# Whether this thread is already scheduling, since with CELERY_ALWAYS_EAGER
+# a dispatched job runs (and schedules again when it finishes) right away,
+# and whether scheduling is being held off until a request is committed.
+_state = threading.local()
+
+def dispatch_launch_job(launch_job_status):
+    ''' send a launch job status to a celery worker to run '''
+    from lib.main.tasks import run_launch_job
+    run_launch_job.apply_async([launch_job_status.pk],
+                               task_id=launch_job_status.celery_task_id)
+
+class LaunchJobScheduler(object):
+    '''
+    Starts pending launch job statuses without exceeding the limits on jobs
+    running at once, overall (LAUNCH_JOB_MAX_RUNNING) and for any one
+    inventory or project (LAUNCH_JOB_MAX_RUNNING_PER_INVENTORY and
+    LAUNCH_JOB_MAX_RUNNING_PER_PROJECT).  Jobs are started in order of
+    priority, then in the order they were launched; jobs blocked by their
+    inventory or project limit don't hold up the others.
+
+    A status counts against the limits from when it is sent to a worker (and
+    is given its celery_task_id) until it finishes.  Statuses whose worker
+    died never finish, so they are marked as errors once their celery task
+    has ended without updating them (as when it is killed at
+    CELERYD_TASK_TIME_LIMIT), or once they have been running for more than
+    LAUNCH_JOB_REAP_TIMEOUT seconds.  Jobs still waiting in the celery queue
+    for a worker are left alone, however long they wait.
+    '''
+
+    def __init__(self, dispatch=dispatch_launch_job):
+        self.dispatch = dispatch
+        self.max_running = getattr(settings, 'LAUNCH_JOB_MAX_RUNNING', 0)
+        self.max_per_inventory = getattr(settings, 'LAUNCH_JOB_MAX_RUNNING_PER_INVENTORY', 0)
+        self.max_per_project = getattr(settings, 'LAUNCH_JOB_MAX_RUNNING_PER_PROJECT', 0)
+
+    def lock(self):
+        ''' return an open file locked so only one process admits jobs at a time '''
+        lock_path = getattr(settings, 'LAUNCH_JOB_SCHEDULER_LOCK', '')
+        if not lock_path:
+            return None
+        lock_dir = os.path.dirname(lock_path)
+        if lock_dir and not os.path.exists(lock_dir):
+            os.makedirs(lock_dir)
+        lock_file = file(lock_path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def reap(self):
+        '''
+        Mark as errors the statuses sent to celery that will never finish,
+        returning their pks.
+        '''
+        sent = LaunchJobStatus.objects.filter(status__in=('pending', 'running')).exclude(celery_task_id='')
+        pks = dict(sent.values_list('celery_task_id', 'pk'))
+        if not pks:
+            return []
+        reasons = {}
+        ended = TaskMeta.objects.filter(task_id__in=pks.keys(), status__in=states.READY_STATES)
+        for task_id, task_status in ended.values_list('task_id', 'status'):
+            reasons[pks[task_id]] = 'celery task %s ended (%s) without finishing the job' % (task_id, task_status)
+        timeout = getattr(settings, 'LAUNCH_JOB_REAP_TIMEOUT', 0)
+        if timeout:
+            # Only jobs a worker has started, since a pending job may just be
+            # queued behind others until a worker is free.
+            stuck = sent.filter(status='running', started__lt=now() - timedelta(seconds=timeout))
+            for pk in stuck.values_list('pk', flat=True):
+                reasons.setdefault(pk, 'not finished %d seconds after it started running' % timeout)
+        reaped = []
+        for pk, reason in sorted(reasons.items()):
+            # The job may have finished since it was read.
+            if LaunchJobStatus.objects.filter(pk=pk, status__in=('pending', 'running')).update(
+                    status='error', result_traceback=reason):
+                reaped.append(pk)
+        for parent in LaunchJobStatus.objects.filter(slices__pk__in=reaped).distinct():
+            parent.update_from_slices()
+        return reaped
+
+    def admit(self):
+        '''
+        Assign task IDs to the pending statuses that can start now, returning
+        their pks.
+        '''
+        self.reap()
+        running = LaunchJobStatus.objects.filter(status__in=('pending', 'running')).exclude(celery_task_id='')
+        total = 0
+        per_inventory = {}
+        per_project = {}
+        for inventory_pk, project_pk in running.values_list('launch_job__inventory', 'launch_job__project'):
+            total += 1
+            per_inventory[inventory_pk] = per_inventory.get(inventory_pk, 0) + 1
+            per_project[project_pk] = per_project.get(project_pk, 0) + 1
+        admitted = []
+        # Sliced launch jobs only run their slices.
+        waiting = LaunchJobStatus.objects.filter(status='pending', celery_task_id='')
+        waiting = waiting.filter(Q(slice_count=1) | Q(parent__isnull=False)).order_by('-priority', 'pk')
+        for pk, inventory_pk, project_pk in waiting.values_list('pk', 'launch_job__inventory', 'launch_job__project'):
+            if self.max_running and total >= self.max_running:
+                break
+            if self.max_per_inventory and per_inventory.get(inventory_pk, 0) >= self.max_per_inventory:
+                continue
+            if self.max_per_project and per_project.get(project_pk, 0) >= self.max_per_project:
+                continue
+            task_id = str(uuid.uuid4())
+            unclaimed = LaunchJobStatus.objects.filter(pk=pk, celery_task_id='')
+            if not unclaimed.update(celery_task_id=task_id, admitted=now()):
+                continue
+            total += 1
+            per_inventory[inventory_pk] = per_inventory.get(inventory_pk, 0) + 1
+            per_project[project_pk] = per_project.get(project_pk, 0) + 1
+            admitted.append(pk)
+        return admitted
+
+    def schedule_once(self):
+        lock_file = self.lock()
+        try:
+            # Commit the claims (and anything the caller wrote before, such as
+            # a new status) before unlocking, even inside a request's
+            # transaction, so the next process to admit jobs counts them.
+            admitted = transaction.commit_on_success(self.admit)()
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        # Dispatch outside the lock, since an eager task runs right here.
+        for pk in admitted:
+            launch_job_status = LaunchJobStatus.objects.get(pk=pk)
+            try:
+                self.dispatch(launch_job_status)
+            except Exception:
+                # Don't hold a slot for a job that was never sent.
+                LaunchJobStatus.objects.filter(pk=pk).update(status='error',
+                    result_traceback=traceback.format_exc())
+                # Its slot can go to another job.
+                _state.again = True
+        return admitted
+
+    def schedule(self):
+        '''
+        Start as many pending launch job statuses as the limits allow,
+        returning the pks of those started.
+        '''
+        if getattr(_state, 'deferring', False):
+            _state.deferred = True
+            return []
+        if getattr(_state, 'scheduling', False):
+            # Let the outer call check again once it's done.
+            _state.again = True
+            return []
+        _state.scheduling = True
+        try:
+            admitted = []
+            _state.again = True
+            while _state.again:
+                _state.again = False
+                admitted.extend(self.schedule_once())
+            return admitted
+        finally:
+            _state.scheduling = False
+
+def schedule(dispatch=dispatch_launch_job):
+    ''' start as many pending launch job statuses as the limits allow '''
+    return LaunchJobScheduler(dispatch).schedule()
+
+def defer_scheduling():
+    '''
+    Hold off schedule() calls in this thread until run_deferred_scheduling()
+    is called, so scheduling (which commits) can wait for the caller's
+    transaction to be committed first.
+    '''
+    _state.deferring = True
+    _state.deferred = False
+
+def run_deferred_scheduling(dispatch=dispatch_launch_job):
+    ''' stop holding off schedule() calls, and schedule if any were held off '''
+    deferred = getattr(_state, 'deferred', False)
+    _state.deferring = _state.deferred = False
+    if deferred:
+        return schedule(dispatch)
+    return []
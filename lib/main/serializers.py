@@ -19,12 +19,17 @@
 from django.contrib.auth.models import User
 from lib.main.models import *
 from rest_framework import serializers, pagination
-from django.core.urlresolvers import reverse
 from django.core.serializers import json
 import lib.urls
 
 class BaseSerializer(serializers.ModelSerializer):
-    pass
+
+    # related objects used to serialize each item, which list views load along
+    # with the items instead of with separate queries for every item.  Foreign
+    # keys shown as primary keys are read from the item's own row, so only
+    # relations whose fields or members are read need to be listed here.
+    select_related   = ()
+    prefetch_related = ()
 
 class OrganizationSerializer(BaseSerializer):
 
@@ -44,11 +49,11 @@ class OrganizationSerializer(BaseSerializer):
         ''' related resource URLs '''
 
         return dict(
-            audit_trail = reverse(lib.urls.views_OrganizationsAuditTrailList, args=(obj.pk,)),
-            projects    = reverse(lib.urls.views_OrganizationsProjectsList,   args=(obj.pk,)),
-            users       = reverse(lib.urls.views_OrganizationsUsersList,      args=(obj.pk,)),
-            admins      = reverse(lib.urls.views_OrganizationsAdminsList,     args=(obj.pk,)),
-            tags        = reverse(lib.urls.views_OrganizationsTagsList,       args=(obj.pk,))
+            audit_trail = reverse_pk(lib.urls.views_OrganizationsAuditTrailList, obj.pk),
+            projects    = reverse_pk(lib.urls.views_OrganizationsProjectsList,   obj.pk),
+            users       = reverse_pk(lib.urls.views_OrganizationsUsersList,      obj.pk),
+            admins      = reverse_pk(lib.urls.views_OrganizationsAdminsList,     obj.pk),
+            tags        = reverse_pk(lib.urls.views_OrganizationsTagsList,       obj.pk)
         )
 
 class AuditTrailSerializer(BaseSerializer):
@@ -72,7 +77,7 @@ class ProjectSerializer(BaseSerializer):
 
     class Meta:
         model = Project
-        fields = ('url', 'id', 'name', 'description', 'creation_date', 'local_repository', 'default_playbook', 'scm_type')
+        fields = ('url', 'id', 'name', 'description', 'creation_date', 'local_repository', 'default_playbook', 'scm_type', 'scm_branch')
 
     def get_related(self, obj):
         # FIXME: add related resources: inventories
@@ -176,14 +181,14 @@ class UserSerializer(BaseSerializer):
 
     def get_related(self, obj):
         return dict(
-            teams                  = reverse(lib.urls.views_UsersTeamsList,              args=(obj.pk,)),
-            organizations          = reverse(lib.urls.views_UsersOrganizationsList,      args=(obj.pk,)),
-            admin_of_organizations = reverse(lib.urls.views_UsersAdminOrganizationsList, args=(obj.pk,)),
+            teams                  = reverse_pk(lib.urls.views_UsersTeamsList,              obj.pk),
+            organizations          = reverse_pk(lib.urls.views_UsersOrganizationsList,      obj.pk),
+            admin_of_organizations = reverse_pk(lib.urls.views_UsersAdminOrganizationsList, obj.pk),
         )
 
     def get_absolute_url_override(self, obj):
         import lib.urls
-        return reverse(lib.urls.views_UsersDetail, args=(obj.pk,))
+        return reverse_pk(lib.urls.views_UsersDetail, obj.pk)
 
 
 class TagSerializer(BaseSerializer):
@@ -213,5 +218,29 @@ class VariableDataSerializer(BaseSerializer):
         # FIXME: related resources, maybe just the audit trail
         return dict()
 
+class LaunchJobStatusSerializer(BaseSerializer):
+
+    # add the URL and related resources
+    url           = serializers.CharField(source='get_absolute_url', read_only=True)
+    related       = serializers.SerializerMethodField('get_related')
 
+    class Meta:
+        model = LaunchJobStatus
+        fields = ('url', 'id', 'name', 'description', 'creation_date', 'launch_job',
+                  'status', 'priority', 'parent', 'slice_index', 'slice_count',
+                  'scm_revision', 'result_traceback', 'related')
+
+    def get_related(self, obj):
+        # full output is only available through these resources, since it
+        # may be much too large to include here
+        res = dict(
+            stdout = reverse_pk(lib.urls.views_LaunchJobStatusStdout, obj.pk),
+            stderr = reverse_pk(lib.urls.views_LaunchJobStatusStderr, obj.pk),
+            cancel = reverse_pk(lib.urls.views_LaunchJobStatusCancel, obj.pk),
+        )
+        if obj.is_sliced:
+            res['slices'] = reverse_pk(lib.urls.views_LaunchJobStatusSlicesList, obj.pk)
+        if obj.parent_id is not None:
+            res['parent'] = reverse_pk(lib.urls.views_LaunchJobStatusDetail, obj.parent_id)
+        return res
 
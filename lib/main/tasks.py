@@ -16,21 +16,122 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import select
+import shutil
+import signal
 import subprocess
+import tempfile
+import time
 import traceback
 from celery import task
 from django.conf import settings
+from django.utils.timezone import now
+from lib.main.credentials import ssh_agent_pool
+from lib.main.events import CallbackEventReceiver, CallbackEventSpool
 from lib.main.models import *
+from lib.main.projects import ProjectCheckout
+from lib.main.scheduler import schedule
+
+class JobOutputFile(object):
+    '''
+    Append-only file capturing one output stream from ansible-playbook.  Only
+    the last tail_size bytes written are kept in memory.
+    '''
+
+    def __init__(self, path, tail_size):
+        self.path = path
+        self.tail_size = tail_size
+        self.tail = ''
+        self.fileobj = file(path, 'ab')
+
+    def write(self, data):
+        self.fileobj.write(data)
+        # Flush every chunk so the file can be read while the job runs.
+        self.fileobj.flush()
+        self.tail = (self.tail + data)[-self.tail_size:]
+
+    def close(self):
+        self.fileobj.close()
+
+def signal_process_group(proc, signum):
+    ''' send a signal to a process started in its own session and its children '''
+    try:
+        os.killpg(proc.pid, signum)
+    except OSError:
+        # Everything in the group has already exited.
+        pass
+
+def capture_output(proc, outputs, is_canceled=None, poll_interval=1.0,
+                   kill_timeout=5.0):
+    '''
+    Copy output from the process pipes to the corresponding JobOutputFile
+    (outputs is a dict mapping pipe to output file) in chunks as it arrives,
+    then wait for the process to exit.
+
+    When given, is_canceled is called every poll_interval seconds; once it
+    returns True, the process group is sent SIGTERM, then SIGKILL if it is
+    still running kill_timeout seconds later.  Returns the exit status and
+    whether the process was canceled.
+    '''
+    pipes = dict([(pipe.fileno(), output) for pipe, output in outputs.items()])
+    next_poll = time.time() + poll_interval
+    canceled_at = None
+    killed = False
+    while pipes:
+        for fd in select.select(pipes.keys(), [], [], poll_interval)[0]:
+            data = os.read(fd, 65536)
+            if data:
+                pipes[fd].write(data)
+            else:
+                del pipes[fd]
+        current_time = time.time()
+        if canceled_at is None:
+            if is_canceled is not None and current_time >= next_poll:
+                next_poll = current_time + poll_interval
+                if is_canceled():
+                    canceled_at = current_time
+                    signal_process_group(proc, signal.SIGTERM)
+        elif not killed and current_time - canceled_at >= kill_timeout:
+            killed = True
+            signal_process_group(proc, signal.SIGKILL)
+    return proc.wait(), canceled_at is not None
 
 @task(name='run_launch_job')
 def run_launch_job(launch_job_status_pk):
+    output_dir = settings.JOB_OUTPUT_DIR
+    # Statuses are only changed with conditional updates, so a job canceled
+    # before it gets here isn't started, and a cancel request made while it
+    # runs isn't overwritten.
+    statuses = LaunchJobStatus.objects.filter(pk=launch_job_status_pk)
+    if not statuses.filter(status='pending').update(
+            status='running', started=now(),
+            result_stdout_file=os.path.join(output_dir, '%d.stdout' % launch_job_status_pk),
+            result_stderr_file=os.path.join(output_dir, '%d.stderr' % launch_job_status_pk)):
+        schedule()
+        return
     launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status_pk)
-    launch_job_status.status = 'running'
-    launch_job_status.save()
+    if launch_job_status.parent is not None:
+        launch_job_status.parent.update_from_slices()
     launch_job = launch_job_status.launch_job
+    callback_receiver = None
+    callback_spool = None
+    ssh_agent = None
+    checkout = None
+    job_dir = None
+    stdout_file = None
+    stderr_file = None
+    status, tb = 'error', ''
 
+    # Anything that fails from here on still reaches the final status update,
+    # so the job doesn't stay running and hold its scheduler slot.
     try:
-        status, stdout, stderr, tb = 'error', '', '', ''
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # Private to this job, and removed once it finishes.
+        job_dir = tempfile.mkdtemp(prefix='acom_job_')
+        tail_size = getattr(settings, 'JOB_OUTPUT_TAIL_SIZE', 65536)
+        stdout_file = JobOutputFile(launch_job_status.result_stdout_file, tail_size)
+        stderr_file = JobOutputFile(launch_job_status.result_stderr_file, tail_size)
         plugin_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 
                                                   'plugins', 'callback'))
         inventory_script = os.path.abspath(os.path.join(os.path.dirname(__file__),
@@ -42,30 +143,109 @@ def run_launch_job(launch_job_status_pk):
         env = dict(os.environ.items())
         env['ACOM_LAUNCH_JOB_STATUS_ID'] = str(launch_job_status.pk)
         env['ACOM_INVENTORY_ID'] = str(launch_job.inventory.pk)
+        env['ACOM_INVENTORY_SNAPSHOT_DIR'] = getattr(settings, 'INVENTORY_SNAPSHOT_DIR', '')
+        # Each slice of a sliced launch job only sees its share of the hosts.
+        env['ACOM_INVENTORY_SLICE_INDEX'] = str(launch_job_status.slice_index)
+        env['ACOM_INVENTORY_SLICE_COUNT'] = str(launch_job_status.slice_count)
         env['ANSIBLE_CALLBACK_PLUGINS'] = plugin_dir
         env['ACOM_CALLBACK_EVENT_SCRIPT'] = callback_script
  
         if hasattr(settings, 'ANSIBLE_TRANSPORT'):
             env['ANSIBLE_TRANSPORT'] = getattr(settings, 'ANSIBLE_TRANSPORT')
+
+        # Jobs with the same credential share an ssh-agent with its key.
+        credential = launch_job.credential
+        if credential is not None and credential.ssh_key_data:
+            ssh_agent = ssh_agent_pool.acquire(credential)
+            env['SSH_AUTH_SOCK'] = ssh_agent.socket_path
  
-        playbook = launch_job.project.default_playbook
+        project = launch_job.project
+        playbook = project.default_playbook
+        cwd = None
+        if getattr(settings, 'PROJECT_CHECKOUT_DIR', '') and project.scm_type == 'git':
+            # Run from the files at the project's current revision, which
+            # other jobs at the same revision share.
+            checkout = ProjectCheckout(project).acquire()
+            statuses.update(scm_revision=checkout.revision)
+            playbook = os.path.join(checkout.path, playbook)
+            cwd = checkout.path
+            # The files are read-only, so ansible has to write anything it
+            # would keep next to the playbook somewhere else.
+            env['ANSIBLE_RETRY_FILES_SAVE_PATH'] = job_dir
         cmdline = ['ansible-playbook', '-i', inventory_script]
         if launch_job.job_type == 'check':
             cmdline.append('--check')
         cmdline.append(playbook)
 
-        # FIXME: How to cancel/interrupt job? (not that important for now)
+        if getattr(settings, 'CALLBACK_EVENT_SPOOL', False):
+            # The callback plugin appends events to a spool file that is
+            # loaded into the database once the playbook has finished.
+            spool_dir = settings.CALLBACK_EVENT_SPOOL_DIR
+            if not os.path.exists(spool_dir):
+                os.makedirs(spool_dir)
+            spool_path = os.path.join(spool_dir, '%d.json' % launch_job_status.pk)
+            env['ACOM_CALLBACK_EVENT_SPOOL'] = spool_path
+            callback_spool = CallbackEventSpool(launch_job_status.pk, spool_path)
+        else:
+            # The callback plugin streams events to this receiver over a
+            # single socket connection per process instead of running a
+            # script for every event.
+            env['ACOM_CALLBACK_EVENT_SOCKET'] = os.path.join(job_dir, 'events.sock')
+            callback_receiver = CallbackEventReceiver(launch_job_status.pk,
+                                                      env['ACOM_CALLBACK_EVENT_SOCKET'])
+            callback_receiver.start()
+
+        # The playbook runs in its own session, so canceling the job can
+        # signal it along with every process it starts.
         proc = subprocess.Popen(cmdline, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE, env=env)
-        stdout, stderr = proc.communicate()
-        status = 'successful' if proc.returncode == 0 else 'failed'
+                                stderr=subprocess.PIPE, env=env, cwd=cwd,
+                                preexec_fn=os.setsid)
+        is_canceled = lambda: statuses.filter(cancel_flag=True).exists()
+        returncode, canceled = capture_output(proc, {proc.stdout: stdout_file,
+                                                     proc.stderr: stderr_file},
+                                              is_canceled=is_canceled,
+                                              poll_interval=getattr(settings, 'JOB_CANCEL_POLL_INTERVAL', 1.0),
+                                              kill_timeout=getattr(settings, 'JOB_CANCEL_KILL_TIMEOUT', 5.0))
+        if canceled:
+            status = 'canceled'
+        else:
+            status = 'successful' if returncode == 0 else 'failed'
     except Exception:
         tb = traceback.format_exc()
+    finally:
+        for output_file in (stdout_file, stderr_file):
+            if output_file is not None:
+                output_file.close()
+        # Wait for any events still in flight before updating the status.
+        if callback_receiver is not None:
+            callback_receiver.stop()
+        if ssh_agent is not None:
+            ssh_agent_pool.release(ssh_agent)
+        if checkout is not None:
+            checkout.release()
+        if job_dir is not None:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+    if callback_spool is not None and os.path.exists(callback_spool.path):
+        try:
+            callback_spool.drain()
+            os.remove(callback_spool.path)
+        except Exception:
+            # Keep the spool file so the remaining events can be loaded
+            # later with "acom_callback_event --spool".
+            tb += traceback.format_exc()
  
-    # Reload from database before updating/saving.
-    launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status_pk)
-    launch_job_status.status = status
-    launch_job_status.result_stdout = stdout
-    launch_job_status.result_stderr = stderr
-    launch_job_status.result_traceback = tb
-    launch_job_status.save()
+    # The tail may start in the middle of a multibyte character.
+    tails = [(output_file.tail if output_file is not None else '').decode('utf-8', 'replace')
+             for output_file in (stdout_file, stderr_file)]
+    statuses.update(status=status, result_stdout=tails[0], result_stderr=tails[1],
+                    result_traceback=tb)
+    if launch_job_status.parent is not None:
+        launch_job_status.parent.update_from_slices()
+    # Start any jobs that were waiting for this one to finish.
+    schedule()
+
+@task(name='schedule_launch_jobs')
+def schedule_launch_jobs():
+    ''' give up on launch jobs that will never finish, and start pending ones '''
+    return schedule()
@@ -19,6 +19,9 @@
 from lib.main.tests.organizations import OrganizationsTest
 from lib.main.tests.users import UsersTest
 from lib.main.tests.inventory import InventoryTest
-from lib.main.tests.projects import ProjectsTest
+from lib.main.tests.projects import ProjectsTest, ProjectCheckoutTest
 from lib.main.tests.commands import *
-from lib.main.tests.tasks import RunLaunchJobTest
+from lib.main.tests.tasks import RunLaunchJobTest, CaptureOutputTest
+from lib.main.tests.launch_jobs import LaunchJobStatusTest, LaunchJobSchedulerTest
+from lib.main.tests.events import *
+from lib.main.tests.credentials import SshAgentPoolTest
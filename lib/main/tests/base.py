@@ -19,6 +19,8 @@ import datetime
 import json
 
 from django.contrib.auth.models import User as DjangoUser
+from django.core.signals import request_started
+from django.db import connection, reset_queries
 import django.test
 from django.test.client import Client
 from lib.main.models import *
@@ -129,6 +131,33 @@ class BaseTestMixin(object):
     def delete(self, url, expect=201, auth=None):
         return self._generic_rest(url, data=None, expect=expect, auth=auth, method='delete')
 
+    def count_queries(self, func, *args, **kwargs):
+        ''' return the number of queries run by func, and its result '''
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        # queries are otherwise reset at the start of each request
+        request_started.disconnect(reset_queries)
+        try:
+            start = len(connection.queries)
+            result = func(*args, **kwargs)
+            return len(connection.queries) - start, result
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            request_started.connect(reset_queries)
+
+    def check_list_queries(self, collection_url, auth=None):
+        '''
+        Fail if the number of queries to list a collection grows with the page
+        size (i.e. something is loaded separately for each item).  The
+        collection should have at least two items.
+        '''
+        sep = '&' if '?' in collection_url else '?'
+        one_count, one_data = self.count_queries(self.get, '%s%spage_size=1' % (collection_url, sep), auth=auth)
+        all_count, all_data = self.count_queries(self.get, '%s%spage_size=100' % (collection_url, sep), auth=auth)
+        self.assertTrue(len(all_data['results']) > 1, 'Need more than one item in %s' % collection_url)
+        self.assertEqual(one_count, all_count, 'Listing %d items from %s took %d queries, but only %d for one item' % (
+                         len(all_data['results']), collection_url, all_count, one_count))
+
     def get_urls(self, collection_url, auth=None):
         # TODO: this test helper function doesn't support pagination
         data = self.get(collection_url, expect=200, auth=auth)
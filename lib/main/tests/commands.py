@@ -18,6 +18,7 @@
 
 import json
 import os
+import shutil
 import StringIO
 import sys
 import tempfile
@@ -25,9 +26,10 @@ from django.core.management import call_command
 from django.core.management.base import CommandError
 from django.utils.timezone import now
 from lib.main.models import *
+from lib.main.hostvars import EffectiveVariables
 from lib.main.tests.base import BaseTest
 
-__all__ = ['AcomInventoryTest', 'AcomCallbackEventTest']
+__all__ = ['AcomInventoryTest', 'AcomInventoryImportTest', 'AcomCallbackEventTest']
 
 class BaseCommandTest(BaseTest):
     '''
@@ -88,6 +90,8 @@ class AcomInventoryTest(BaseCommandTest):
 
     def setUp(self):
         super(AcomInventoryTest, self).setUp()
+        self.snapshot_dir = tempfile.mkdtemp()
+        os.environ['ACOM_INVENTORY_SNAPSHOT_DIR'] = self.snapshot_dir
         self.setup_users()
         self.organizations = self.make_organizations(self.super_django_user, 2)
         self.projects = self.make_projects(self.normal_django_user, 2)
@@ -128,6 +132,10 @@ class AcomInventoryTest(BaseCommandTest):
                     group.parents.add(groups[3])
             self.groups.extend(groups)
 
+    def tearDown(self):
+        super(AcomInventoryTest, self).tearDown()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
     def test_without_inventory_id(self):
         result, stdout, stderr = self.run_command('acom_inventory', list=True)
         self.assertTrue(isinstance(result, CommandError))
@@ -143,6 +151,10 @@ class AcomInventoryTest(BaseCommandTest):
                                                   inventory=inventory.pk)
         self.assertEqual(result, None)
         data = json.loads(stdout)
+        # Hosts for this inventory have no variable data.
+        meta = data.pop('_meta')
+        self.assertEqual(meta['hostvars'],
+                         dict([(x, {}) for x in inventory.hosts.values_list('name', flat=True)]))
         self.assertEqual(set(data.keys()),
                          set(inventory.groups.values_list('name', flat=True)))
         # Groups for this inventory should only have hosts, and no group
@@ -168,6 +180,12 @@ class AcomInventoryTest(BaseCommandTest):
         result, stdout, stderr = self.run_command('acom_inventory', list=True)
         self.assertEqual(result, None)
         data = json.loads(stdout)
+        # Variables for all hosts are included with the groups.
+        meta = data.pop('_meta')
+        self.assertEqual(len(meta['hostvars']), inventory.hosts.count())
+        for host in inventory.hosts.all():
+            self.assertEqual(meta['hostvars'][host.name],
+                             json.loads(host.variable_data.data))
         self.assertEqual(set(data.keys()),
                          set(inventory.groups.values_list('name', flat=True)))
         # Groups for this inventory should have hosts, variable data, and one
@@ -186,6 +204,68 @@ class AcomInventoryTest(BaseCommandTest):
             else:
                 self.assertFalse('children' in v)
 
+    def test_list_queries_with_many_groups(self):
+        inventory = self.inventories[1]
+        for x in xrange(5, 50):
+            variable_data = VariableData.objects.create(data=json.dumps({'x': x}))
+            group = inventory.groups.create(name='group-%d' % x,
+                                            inventory=inventory,
+                                            variable_data=variable_data)
+            group.hosts.add(self.hosts[10 + x % 10])
+            group.parents.add(self.groups[5 + x % 5])
+        os.environ['ACOM_INVENTORY_ID'] = str(inventory.pk)
+        # One query for the inventory, then one each for variables, groups,
+        # group hosts, group children and hosts.
+        with self.assertNumQueries(6):
+            result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        self.assertEqual(result, None)
+        data = json.loads(stdout)
+        self.assertEqual(len(data), 51)
+        self.assertEqual(data['group-49']['vars'], {'x': 49})
+        self.assertEqual(data['group-49']['hosts'], [self.hosts[19].name])
+        self.assertTrue('group-49' in data['group-4']['children'])
+
+    def test_list_with_child_from_other_inventory(self):
+        inventory = self.inventories[1]
+        self.groups[0].parents.add(inventory.groups.get(name='group-3'))
+        os.environ['ACOM_INVENTORY_ID'] = str(inventory.pk)
+        result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        self.assertEqual(result, None)
+        data = json.loads(stdout)
+        self.assertEqual(data['group-3']['children'], ['group-4'])
+
+    def test_list_from_snapshot(self):
+        inventory = self.inventories[1]
+        os.environ['ACOM_INVENTORY_ID'] = str(inventory.pk)
+        result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        self.assertEqual(result, None)
+        snapshots = os.listdir(self.snapshot_dir)
+        self.assertEqual(snapshots, ['%d-%s.json' % (inventory.pk,
+            Inventory.objects.get(pk=inventory.pk).snapshot_version)])
+        # Only the inventory is loaded when the snapshot is current.
+        with self.assertNumQueries(1):
+            result, stdout2, stderr = self.run_command('acom_inventory', list=True)
+        self.assertEqual(result, None)
+        self.assertEqual(json.loads(stdout2), json.loads(stdout))
+        # Changing host variables replaces the snapshot.
+        host = inventory.hosts.all()[0]
+        host.variable_data.replace_for(host, {'ho': 'changed'})
+        result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        self.assertEqual(result, None)
+        data = json.loads(stdout)
+        self.assertEqual(data['_meta']['hostvars'][host.name], {'ho': 'changed'})
+        self.assertEqual(len(os.listdir(self.snapshot_dir)), 1)
+        self.assertNotEqual(os.listdir(self.snapshot_dir), snapshots)
+        # So does adding a group.
+        inventory.groups.create(name='new-group', inventory=inventory)
+        result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        self.assertTrue('new-group' in json.loads(stdout))
+        # As well as removing a host from a group.
+        group = inventory.groups.get(name='group-0')
+        group.hosts.remove(group.hosts.all()[0])
+        result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        self.assertEqual(len(json.loads(stdout)['group-0']['hosts']), 1)
+
     def test_valid_host(self):
         # Host without variable data.
         inventory = self.inventories[0]
@@ -206,6 +286,67 @@ class AcomInventoryTest(BaseCommandTest):
         data = json.loads(stdout)
         self.assertEqual(data, json.loads(host.variable_data.data))
 
+    def test_effective_variables(self):
+        inventory = self.inventories[1]
+        os.environ['ACOM_INVENTORY_ID'] = str(inventory.pk)
+        # group-4 is a child of group-3, so its variables win.
+        host = inventory.hosts.get(name='host-01-04.example.com')
+        result, stdout, stderr = self.run_command('acom_inventory',
+                                                  host=host.name, effective=True)
+        self.assertEqual(result, None)
+        self.assertEqual(json.loads(stdout), {'ho': 'hum-4', 'gee': 'whiz-4'})
+        result, stdout, stderr = self.run_command('acom_inventory', list=True,
+                                                  effective=True)
+        self.assertEqual(result, None)
+        data = json.loads(stdout)
+        self.assertEqual(data['_meta']['hostvars'][host.name], {'ho': 'hum-4', 'gee': 'whiz-4'})
+        self.assertEqual(data['_meta']['hostvars']['host-01-03.example.com'],
+                         {'ho': 'hum-3', 'gee': 'whiz-3'})
+        self.assertEqual(data['group-4']['vars'], {'gee': 'whiz-4'})
+
+    def test_list_slices(self):
+        inventory = self.inventories[1]
+        os.environ['ACOM_INVENTORY_ID'] = str(inventory.pk)
+        result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        full = json.loads(stdout)
+        # Every host is in exactly one slice, with its variables, and every
+        # slice lists all the groups.
+        host_names = []
+        for slice_index in xrange(3):
+            result, stdout, stderr = self.run_command('acom_inventory', list=True,
+                                                      slice_index=slice_index,
+                                                      slice_count=3)
+            self.assertEqual(result, None)
+            data = json.loads(stdout)
+            self.assertEqual(set(data.keys()), set(full.keys()))
+            hostvars = data['_meta']['hostvars']
+            for host_name, variables in hostvars.items():
+                self.assertEqual(variables, full['_meta']['hostvars'][host_name])
+            for group_name in ('group-0', 'group-1'):
+                self.assertEqual(set(data[group_name]['hosts']),
+                                 set(full[group_name]['hosts']) & set(hostvars))
+            host_names.extend(hostvars)
+        self.assertEqual(sorted(host_names), sorted(full['_meta']['hostvars']))
+        # The slice can also be given in the environment.
+        os.environ['ACOM_INVENTORY_SLICE_INDEX'] = '2'
+        os.environ['ACOM_INVENTORY_SLICE_COUNT'] = '3'
+        try:
+            result, stdout2, stderr = self.run_command('acom_inventory', list=True)
+        finally:
+            os.environ.pop('ACOM_INVENTORY_SLICE_INDEX')
+            os.environ.pop('ACOM_INVENTORY_SLICE_COUNT')
+        self.assertEqual(json.loads(stdout2), data)
+        result, stdout, stderr = self.run_command('acom_inventory', list=True,
+                                                  slice_index=3, slice_count=3)
+        self.assertTrue(isinstance(result, CommandError))
+        self.assertEqual(json.loads(stdout), {})
+        # The slice can be given on the command line.
+        from lib.main.management.commands.acom_inventory import Command
+        parser = Command().create_parser('manage.py', 'acom_inventory')
+        options, args = parser.parse_args(['--list', '--slice-index', '2', '--slice-count', '3'])
+        result, stdout2, stderr = self.run_command('acom_inventory', **options.__dict__)
+        self.assertEqual(json.loads(stdout2), data)
+
     def test_invalid_host(self):
         # Valid host, but not part of the specified inventory.
         inventory = self.inventories[0]
@@ -258,6 +399,191 @@ class AcomInventoryTest(BaseCommandTest):
         self.assertTrue(isinstance(result, CommandError))
         self.assertEqual(json.loads(stdout), {})
 
+TEST_INVENTORY_INI = '''
+# Ungrouped hosts
+localhost ansible_connection=local
+
+[web]
+web[01:03].example.com http_port=8080
+db.example.com:2222
+
+[web:vars]
+role = web
+
+[db]
+db.example.com
+
+[servers:children]
+web
+db
+'''
+
+TEST_INVENTORY_SCRIPT = '''#!/usr/bin/env python
+import json, sys
+if sys.argv[1] == '--host':
+    print json.dumps({'host': sys.argv[2]})
+else:
+    print json.dumps({'web': ['web1', 'web2'],
+                      'servers': {'children': ['web'], 'vars': {'env': 'prod'}}})
+'''
+
+class AcomInventoryImportTest(BaseCommandTest):
+    '''
+    Test cases for acom_inventory_import management command.
+    '''
+
+    def setUp(self):
+        super(AcomInventoryImportTest, self).setUp()
+        self.setup_users()
+        self.organization = self.make_organizations(self.super_django_user, 1)[0]
+        self.inventory = Inventory.objects.create(name='test-inventory',
+                                                  organization=self.organization)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(AcomInventoryImportTest, self).tearDown()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def write_source(self, name, data, executable=False):
+        path = os.path.join(self.temp_dir, name)
+        file(path, 'wb').write(data)
+        if executable:
+            os.chmod(path, 0755)
+        return path
+
+    def get_variables(self, obj):
+        if obj.variable_data is None:
+            return {}
+        return json.loads(obj.variable_data.data)
+
+    def test_import_ini(self):
+        path = self.write_source('hosts', TEST_INVENTORY_INI)
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertEqual(result, None, stderr)
+        self.assertTrue(stdout.endswith('\n'), stdout)
+        hosts = self.inventory.hosts
+        self.assertEqual(set(hosts.values_list('name', flat=True)),
+                         set(['localhost', 'web01.example.com', 'web02.example.com',
+                              'web03.example.com', 'db.example.com']))
+        self.assertEqual(self.get_variables(hosts.get(name='web02.example.com')),
+                         {'http_port': '8080'})
+        self.assertEqual(self.get_variables(hosts.get(name='db.example.com')),
+                         {'ansible_ssh_port': '2222'})
+        web = self.inventory.groups.get(name='web')
+        self.assertEqual(self.get_variables(web), {'role': 'web'})
+        self.assertEqual(web.hosts.count(), 4)
+        servers = self.inventory.groups.get(name='servers')
+        self.assertEqual(set(servers.children.values_list('name', flat=True)),
+                         set(['web', 'db']))
+        # Importing the same source again doesn't write anything.
+        version = Inventory.objects.get(pk=self.inventory.pk).snapshot_version
+        queries, (result, stdout, stderr) = self.count_queries(
+            self.run_command, 'acom_inventory_import', inventory=self.inventory.pk,
+            source=path)
+        self.assertEqual(result, None, stderr)
+        self.assertTrue(queries <= 10, queries)
+        self.assertEqual(Inventory.objects.get(pk=self.inventory.pk).snapshot_version, version)
+        # Changes are merged without removing anything.
+        path = self.write_source('hosts', '[web]\nweb01.example.com http_port=80\nweb04.example.com\n')
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertEqual(result, None, stderr)
+        self.assertEqual(hosts.filter(active=True).count(), 6)
+        self.assertEqual(self.get_variables(hosts.get(name='web01.example.com')),
+                         {'http_port': '80'})
+        self.assertEqual(self.get_variables(hosts.get(name='web02.example.com')),
+                         {'http_port': '8080'})
+        web = self.inventory.groups.get(name='web')
+        self.assertEqual(self.get_variables(web), {'role': 'web'})
+        # Everything else is removed when overwriting.
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path, overwrite=True)
+        self.assertEqual(result, None, stderr)
+        self.assertEqual(set(hosts.filter(active=True).values_list('name', flat=True)),
+                         set(['web01.example.com', 'web04.example.com']))
+        self.assertEqual(list(self.inventory.groups.filter(active=True).values_list('name', flat=True)),
+                         ['web'])
+        web = self.inventory.groups.get(name='web')
+        self.assertEqual(self.get_variables(web), {})
+        self.assertEqual(web.hosts.count(), 2)
+
+    def test_import_ini_all_group(self):
+        path = self.write_source('hosts', '[all:vars]\nntp = ntp.example.com\nhttp_port = 80\n'
+                                          '[web]  # web servers\nweb1 http_port=8080\n'
+                                          '[all:children] ; everything\nweb\n[all]\nlone\n')
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertEqual(result, None, stderr)
+        # The all group's variables are the inventory's, below any group's.
+        inventory = Inventory.objects.get(pk=self.inventory.pk)
+        self.assertEqual(self.get_variables(inventory), {'ntp': 'ntp.example.com', 'http_port': '80'})
+        self.assertEqual(list(inventory.groups.values_list('name', flat=True)), ['web'])
+        self.assertEqual(set(inventory.hosts.values_list('name', flat=True)), set(['web1', 'lone']))
+        hostvars = EffectiveVariables(inventory).get_all_host_variables()
+        self.assertEqual(hostvars['web1'], {'ntp': 'ntp.example.com', 'http_port': '8080'})
+        self.assertEqual(hostvars['lone'], {'ntp': 'ntp.example.com', 'http_port': '80'})
+        os.environ['ACOM_INVENTORY_ID'] = str(inventory.pk)
+        try:
+            with self.settings(INVENTORY_SNAPSHOT_DIR=self.temp_dir):
+                result, stdout, stderr = self.run_command('acom_inventory', list=True)
+        finally:
+            os.environ.pop('ACOM_INVENTORY_ID')
+        self.assertEqual(json.loads(stdout)['all'], {'vars': {'ntp': 'ntp.example.com', 'http_port': '80'}})
+        # Importing them again doesn't change anything, and overwriting
+        # without them clears them.
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertTrue('variables: 0' in stdout, stdout)
+        path = self.write_source('hosts', '[web]\nweb1\n')
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path, overwrite=True)
+        self.assertEqual(result, None, stderr)
+        self.assertEqual(Inventory.objects.get(pk=self.inventory.pk).variable_data, None)
+        self.assertEqual(VariableData.objects.filter(data__contains='ntp').count(), 0)
+
+    def test_import_script(self):
+        path = self.write_source('inventory.py', TEST_INVENTORY_SCRIPT, executable=True)
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertEqual(result, None, stderr)
+        self.assertEqual(set(self.inventory.hosts.values_list('name', flat=True)),
+                         set(['web1', 'web2']))
+        self.assertEqual(self.get_variables(self.inventory.hosts.get(name='web2')),
+                         {'host': 'web2'})
+        servers = self.inventory.groups.get(name='servers')
+        self.assertEqual(self.get_variables(servers), {'env': 'prod'})
+        self.assertEqual(list(servers.children.values_list('name', flat=True)), ['web'])
+
+    def test_with_invalid_args(self):
+        path = self.write_source('hosts', TEST_INVENTORY_INI)
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  source=path)
+        self.assertTrue(isinstance(result, CommandError))
+        path = self.write_source('hosts', '[web\nweb1\n')
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertTrue(isinstance(result, CommandError))
+        self.assertTrue('section header' in str(result), result)
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path + '.missing')
+        self.assertTrue(isinstance(result, CommandError))
+        path = self.write_source('hosts', '[web]\nweb1 novalue\n')
+        result, stdout, stderr = self.run_command('acom_inventory_import',
+                                                  inventory=self.inventory.pk,
+                                                  source=path)
+        self.assertTrue(isinstance(result, CommandError))
+        self.assertEqual(self.inventory.hosts.count(), 0)
+
 class AcomCallbackEventTest(BaseCommandTest):
     '''
     Test cases for acom_callback_event management command.
@@ -399,3 +725,29 @@ class AcomCallbackEventTest(BaseCommandTest):
         result, stdout, stderr = self.run_command('acom_callback_event', **kwargs)
         self.assertEqual(result, None)
         self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 4)
+
+    def test_load_spool_file(self):
+        h, tf = tempfile.mkstemp(suffix='.json')
+        self._temp_files.append(tf)
+        f = os.fdopen(h, 'w')
+        for event_type in ('playbook_on_start', 'playbook_on_stats'):
+            f.write(json.dumps({'event': event_type, 'event_data': {}}) + '\n')
+        f.close()
+        # Events can be loaded from a spool file even once the job is done.
+        self.launch_job_status.status = 'failed'
+        self.launch_job_status.save()
+        result, stdout, stderr = self.run_command('acom_callback_event',
+            launch_job_status_id=self.launch_job_status.id, event_spool_file=tf)
+        self.assertEqual(result, None)
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 2)
+        # Loading the same file again doesn't add any new events.
+        result, stdout, stderr = self.run_command('acom_callback_event',
+            launch_job_status_id=self.launch_job_status.id, event_spool_file=tf)
+        self.assertEqual(result, None)
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 2)
+        # Missing spool file.
+        result, stdout, stderr = self.run_command('acom_callback_event',
+            launch_job_status_id=self.launch_job_status.id,
+            event_spool_file='%s.missing' % tf)
+        self.assertTrue(isinstance(result, CommandError))
+        self.assertTrue('reading from' in str(result).lower())
@@ -0,0 +1,138 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from lib.main.models import *
+from lib.main.credentials import SshAgentPool
+from lib.main.tests.base import BaseTest
+
+# Starts an agent, then waits to be killed.
+AGENT_OWNER_SCRIPT = '''
+import sys, time
+from lib.main.credentials import SshAgent
+class Credential(object):
+    pk = 1
+    ssh_key_data = sys.stdin.read()
+    ssh_key_unlock = ''
+agent = SshAgent(Credential())
+print agent.socket_path
+sys.stdout.flush()
+time.sleep(60)
+'''
+
+class SshAgentPoolTest(BaseTest):
+    '''
+    Test cases for ssh-agents kept for launch job credentials.
+    '''
+
+    def setUp(self):
+        super(SshAgentPoolTest, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.pool = SshAgentPool()
+
+    def tearDown(self):
+        super(SshAgentPoolTest, self).tearDown()
+        self.pool.clear()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def make_key(self, passphrase=''):
+        key_path = os.path.join(self.temp_dir, 'key-%d' % len(os.listdir(self.temp_dir)))
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', passphrase,
+                               '-f', key_path])
+        return file(key_path, 'rb').read()
+
+    def list_keys(self, agent):
+        env = dict(os.environ.items(), SSH_AUTH_SOCK=agent.socket_path)
+        proc = subprocess.Popen(['ssh-add', '-l'], stdout=subprocess.PIPE, env=env)
+        return proc.communicate()[0].strip().splitlines()
+
+    def test_reuse_agent(self):
+        credential = Credential.objects.create(name='cred', ssh_key_data=self.make_key('secret'),
+                                               ssh_key_unlock='secret')
+        agent = self.pool.acquire(credential)
+        self.assertEqual(len(self.list_keys(agent)), 1)
+        # Only the socket is left on disk.
+        self.assertEqual(os.listdir(agent.temp_dir), ['agent.sock'])
+        self.assertTrue(self.pool.acquire(credential) is agent)
+        self.pool.release(agent)
+        self.pool.release(agent)
+        self.assertTrue(agent.is_alive())
+        self.assertTrue(self.pool.acquire(credential) is agent)
+        self.pool.release(agent)
+        # A new key gets a new agent.
+        credential.ssh_key_data = self.make_key()
+        credential.ssh_key_unlock = ''
+        credential.save()
+        agent2 = self.pool.acquire(credential)
+        self.assertFalse(agent2 is agent)
+        self.assertFalse(agent.is_alive())
+        self.assertFalse(os.path.exists(agent.temp_dir))
+        self.pool.release(agent2)
+        # Agents are stopped once they expire.
+        agent2.expires = 0
+        self.pool.evict()
+        self.assertFalse(agent2.is_alive())
+        self.assertFalse(os.path.exists(agent2.temp_dir))
+        self.assertEqual(self.pool.agents, {})
+
+    def test_pool_limits(self):
+        credentials = [Credential.objects.create(name='cred-%d' % x, ssh_key_data=self.make_key())
+                       for x in xrange(3)]
+        with self.settings(SSH_AGENT_POOL_SIZE=1):
+            agents = [self.pool.acquire(credential) for credential in credentials]
+            for agent in agents:
+                self.pool.release(agent)
+        # Only the most recently released idle agent is kept.
+        self.assertEqual([agent.is_alive() for agent in agents], [False, False, True])
+        with self.settings(SSH_AGENT_TTL=0):
+            agent = self.pool.acquire(credentials[0])
+            self.pool.release(agent)
+            self.assertFalse(agent.is_alive())
+            self.assertFalse(os.path.exists(agent.temp_dir))
+
+    def test_wrong_passphrase(self):
+        credential = Credential.objects.create(name='cred', ssh_key_data=self.make_key('secret'),
+                                               ssh_key_unlock='wrong')
+        self.assertRaises(RuntimeError, self.pool.acquire, credential)
+        credential.ssh_key_unlock = ''
+        self.assertRaises(RuntimeError, self.pool.acquire, credential)
+        self.assertEqual(self.pool.agents, {})
+
+    def test_owner_killed(self):
+        key_data = self.make_key()
+        owner = subprocess.Popen([sys.executable, '-c', AGENT_OWNER_SCRIPT],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))))
+        owner.stdin.write(key_data)
+        owner.stdin.close()
+        socket_path = owner.stdout.readline().strip()
+        agent = type('Agent', (object,), dict(socket_path=socket_path))
+        self.assertEqual(len(self.list_keys(agent)), 1)
+        # The agent stops even though its owner couldn't clean up.
+        os.kill(owner.pid, signal.SIGKILL)
+        owner.wait()
+        deadline = time.time() + 10
+        while os.path.exists(socket_path) and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(socket_path))
+        shutil.rmtree(os.path.dirname(socket_path), ignore_errors=True)
@@ -0,0 +1,189 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+from django.utils.timezone import now
+from lib.main.events import *
+from lib.main.models import *
+from lib.main.tests.base import BaseTransactionTest
+
+__all__ = ['CallbackEventBufferTest', 'CallbackEventReceiverTest',
+           'CallbackEventSpoolTest']
+
+class BaseEventTest(BaseTransactionTest):
+    '''
+    Base class for tests of callback event ingestion.
+    '''
+
+    def setUp(self):
+        super(BaseEventTest, self).setUp()
+        self.setup_users()
+        self.organization = self.make_organizations(self.super_django_user, 1)[0]
+        self.project = self.make_projects(self.normal_django_user, 1)[0]
+        self.inventory = Inventory.objects.create(name='test-inventory',
+                                                  organization=self.organization)
+        self.launch_job = LaunchJob.objects.create(name='test-launch-job',
+                                                   inventory=self.inventory,
+                                                   project=self.project)
+        self.launch_job_status = self.launch_job.launch_job_statuses.create(
+            name='launch-job-status-%s' % now().isoformat(), status='running')
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(BaseEventTest, self).tearDown()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+class CallbackEventBufferTest(BaseEventTest):
+    '''
+    Test cases for batched saving of callback events.
+    '''
+
+    def test_flush_with_single_insert(self):
+        buffer = CallbackEventBuffer(self.launch_job_status.pk, batch_size=100)
+        for x in xrange(50):
+            buffer.add('runner_on_ok', {'host': 'host-%d' % x})
+        self.assertEqual(len(buffer), 50)
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 0)
+        # One query to check the status and one to insert every event.
+        with self.assertNumQueries(2):
+            self.assertEqual(buffer.flush(), 50)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 50)
+
+    def test_flush_when_batch_size_reached(self):
+        buffer = CallbackEventBuffer(self.launch_job_status.pk, batch_size=3)
+        buffer.add('playbook_on_start', {})
+        buffer.add('playbook_on_play_start', {})
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 0)
+        buffer.add('playbook_on_task_start', {})
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 3)
+
+    def test_flush_when_not_running(self):
+        self.launch_job_status.status = 'failed'
+        self.launch_job_status.save()
+        buffer = CallbackEventBuffer(self.launch_job_status.pk)
+        buffer.add('playbook_on_start', {})
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 0)
+
+class CallbackEventReceiverTest(BaseEventTest):
+    '''
+    Test cases for receiving callback events over a Unix domain socket.
+    '''
+
+    def send_messages(self, socket_path, messages):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+        for message in messages:
+            if not isinstance(message, basestring):
+                message = json.dumps(message)
+            sock.sendall(message + '\n')
+        sock.close()
+
+    def test_receive_events(self):
+        socket_path = os.path.join(self.temp_dir, 'events.sock')
+        receiver = CallbackEventReceiver(self.launch_job_status.pk, socket_path)
+        receiver.start()
+        self.send_messages(socket_path, [
+            {'event': 'playbook_on_start', 'event_data': {}},
+            {'event': 'runner_on_ok', 'event_data': {'host': 'localhost'}},
+        ])
+        # Invalid messages and event types are ignored.
+        self.send_messages(socket_path, [
+            'not json',
+            {'event': 'invalid_event_type'},
+            {'event': 'playbook_on_stats', 'event_data': {'ok': {}}},
+        ])
+        receiver.stop()
+        self.assertFalse(os.path.exists(socket_path))
+        events = self.launch_job_status.launch_job_status_events
+        self.assertEqual(events.count(), 3)
+        self.assertEqual(events.get(event='runner_on_ok').event_data,
+                         {'host': 'localhost'})
+
+    def test_receive_events_when_not_running(self):
+        self.launch_job_status.status = 'successful'
+        self.launch_job_status.save()
+        socket_path = os.path.join(self.temp_dir, 'events.sock')
+        receiver = CallbackEventReceiver(self.launch_job_status.pk, socket_path)
+        receiver.start()
+        self.send_messages(socket_path, [
+            {'event': 'playbook_on_start', 'event_data': {}},
+        ])
+        receiver.stop()
+        self.assertEqual(self.launch_job_status.launch_job_status_events.count(), 0)
+
+class CallbackEventSpoolTest(BaseEventTest):
+    '''
+    Test cases for loading callback events from a spool file.
+    '''
+
+    def write_spool(self, path, messages, partial=''):
+        spool_file = file(path, 'ab')
+        for message in messages:
+            spool_file.write(json.dumps(message) + '\n')
+        spool_file.write(partial)
+        spool_file.close()
+
+    def test_drain_spool(self):
+        spool_path = os.path.join(self.temp_dir, 'events.json')
+        self.write_spool(spool_path, [
+            {'event': 'playbook_on_start', 'event_data': {}},
+            {'event': 'runner_on_ok', 'event_data': {'host': 'localhost'}},
+            {'event': 'invalid_event_type'},
+        ], partial='{"event": "playbook_on_st')
+        spool = CallbackEventSpool(self.launch_job_status.pk, spool_path,
+                                   batch_size=1)
+        self.assertEqual(spool.drain(), 2)
+        events = self.launch_job_status.launch_job_status_events
+        self.assertEqual(events.count(), 2)
+        # The partial last line is left for the next drain.
+        launch_job_status = LaunchJobStatus.objects.get(pk=self.launch_job_status.pk)
+        self.assertEqual(launch_job_status.event_spool_offset,
+                         os.path.getsize(spool_path) - len('{"event": "playbook_on_st'))
+        # Draining again doesn't duplicate any events.
+        self.assertEqual(spool.drain(), 0)
+        self.assertEqual(events.count(), 2)
+        # Finish the partial line and load the rest, even though the job is
+        # no longer running.
+        LaunchJobStatus.objects.filter(pk=self.launch_job_status.pk).update(status='successful')
+        self.write_spool(spool_path, [], partial='ats", "event_data": {}}\n')
+        self.assertEqual(spool.drain(), 1)
+        self.assertEqual(events.count(), 3)
+        self.assertEqual(events.filter(event='playbook_on_stats').count(), 1)
+
+    def test_drain_resumes_from_saved_offset(self):
+        spool_path = os.path.join(self.temp_dir, 'events.json')
+        self.write_spool(spool_path, [
+            {'event': 'playbook_on_start', 'event_data': {}},
+        ])
+        # Pretend a previous drain already saved the first event.
+        LaunchJobStatus.objects.filter(pk=self.launch_job_status.pk).update(
+            event_spool_offset=os.path.getsize(spool_path))
+        self.write_spool(spool_path, [
+            {'event': 'playbook_on_stats', 'event_data': {}},
+        ])
+        spool = CallbackEventSpool(self.launch_job_status.pk, spool_path)
+        self.assertEqual(spool.drain(), 1)
+        events = self.launch_job_status.launch_job_status_events
+        self.assertEqual(list(events.values_list('event', flat=True)),
+                         ['playbook_on_stats'])
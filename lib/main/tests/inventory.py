@@ -15,13 +15,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import base64
 import datetime
 import json
 
 from django.contrib.auth.models import User as DjangoUser
 import django.test
+from django.db import IntegrityError
 from django.test.client import Client
 from lib.main.models import *
+from lib.main.bulk import InventoryLoader
 from lib.main.tests.base import BaseTest
 
 class InventoryTest(BaseTest):
@@ -253,10 +256,12 @@ class InventoryTest(BaseTest):
         vars_b = dict(asdf=4321, dog='barky', cat='snarf',  unstructured=dict(a=[1,2,3],b=dict(x=2,y=3)))
         vars_c = dict(asdf=5555, dog='mouse', cat='mogwai', unstructured=dict(a=[3,0,3],b=dict(z=2600)))
 
-        # attempting to get a variable object creates it, even though it does not already exist
+        # attempting to get a variable object that does not exist yet returns empty variables, without creating it
         vdata_url = "/api/v1/hosts/%s/variable_data/" % (added_by_collection_a['id'])
         got = self.get(vdata_url, expect=200, auth=self.get_super_credentials())
         self.assertEquals(got, dict())
+        self.assertEquals(Host.objects.get(pk=added_by_collection_a['id']).variable_data, None)
+        self.assertEquals(VariableData.objects.count(), 0)
 
         # super user can create variable objects
         # an org admin can create variable objects (defers to inventory permissions)
@@ -390,3 +395,349 @@ class InventoryTest(BaseTest):
 
        
 
+
+    def test_access_cache(self):
+        # Without a cache, every check queries the database.
+        other = User.objects.get(pk=self.other_django_user.pk)
+        self.assertTrue(Inventory.can_user_read(other, self.inventory_b))
+        self.assertFalse(Inventory.can_user_read(other, self.inventory_a))
+        # With a cache installed, memberships are loaded once (organizations,
+        # admin of organizations, teams and permissions), then reused.
+        UserAccessCache.install(other)
+        with self.assertNumQueries(4):
+            self.assertTrue(Inventory.can_user_read(other, self.inventory_b))
+            self.assertFalse(Inventory.can_user_administrate(other, self.inventory_b))
+            self.assertFalse(Inventory.can_user_read(other, self.inventory_a))
+            self.assertTrue(Organization.can_user_read(other, self.organizations[0]))
+            self.assertFalse(Organization.can_user_administrate(other, self.organizations[0]))
+        normal = User.objects.get(pk=self.normal_django_user.pk)
+        UserAccessCache.install(normal)
+        self.assertTrue(Inventory.can_user_administrate(normal, self.inventory_a))
+        self.assertFalse(Inventory.can_user_read(normal, self.inventory_b))
+
+    def test_inventory_access(self):
+        def get_access(user, inventory):
+            try:
+                access = InventoryAccess.objects.get(user=user, inventory=inventory)
+                return (access.can_read, access.can_write, access.can_admin)
+            except InventoryAccess.DoesNotExist:
+                return None
+        # Organization admins can administrate all of its inventories.
+        self.assertEqual(get_access(self.normal_django_user, self.inventory_a), (True, True, True))
+        self.assertEqual(get_access(self.normal_django_user, self.inventory_b), None)
+        self.assertEqual(get_access(self.other_django_user, self.inventory_b), (True, False, False))
+        self.assertEqual(get_access(self.other_django_user, self.inventory_a), None)
+        # Permissions granted through a team.
+        team = Team.objects.create(name='team', organization=self.organizations[1])
+        perm_write = Permission.objects.create(inventory=self.inventory_b, team=team,
+                                               permission_type='write')
+        team.users.add(self.other_django_user)
+        self.assertEqual(get_access(self.other_django_user, self.inventory_b), (True, True, False))
+        self.nobody_django_user.teams.add(team)
+        self.assertEqual(get_access(self.nobody_django_user, self.inventory_b), (True, True, False))
+        team.users.clear()
+        self.assertEqual(get_access(self.other_django_user, self.inventory_b), (True, False, False))
+        self.assertEqual(get_access(self.nobody_django_user, self.inventory_b), None)
+        # Changing or removing permissions.
+        self.perm_read.inventory = self.inventory_a
+        self.perm_read.save()
+        self.assertEqual(get_access(self.other_django_user, self.inventory_a), (True, False, False))
+        self.assertEqual(get_access(self.other_django_user, self.inventory_b), None)
+        self.perm_read.delete()
+        self.assertEqual(get_access(self.other_django_user, self.inventory_a), None)
+        # Organization admins.
+        self.organizations[0].admins.remove(self.normal_django_user)
+        self.assertEqual(get_access(self.normal_django_user, self.inventory_a), None)
+        self.nobody_django_user.admin_of_organizations.add(self.organizations[1])
+        self.assertEqual(get_access(self.nobody_django_user, self.inventory_b), (True, True, True))
+        # Only one join is needed to list what a user can read.
+        self.inventory_b.hosts.create(name='host-b.example.com', inventory=self.inventory_b)
+        self.assertEqual(list(Host.objects.filter(inventory__accesses__user=self.nobody_django_user,
+                                                  inventory__accesses__can_read=True)),
+                         list(self.inventory_b.hosts.all()))
+
+    def test_list_queries(self):
+        for x in xrange(3):
+            host = self.inventory_a.hosts.create(name='host-%d' % x, inventory=self.inventory_a)
+            group = self.inventory_a.groups.create(name='group-%d' % x, inventory=self.inventory_a)
+            group.hosts.add(host)
+        Inventory.objects.create(name='inventory-c', organization=self.organizations[0])
+        for auth in (self.get_super_credentials(), self.get_normal_credentials()):
+            self.check_list_queries('/api/v1/inventories/', auth=auth)
+            self.check_list_queries('/api/v1/hosts/', auth=auth)
+            self.check_list_queries('/api/v1/groups/', auth=auth)
+            self.check_list_queries('/api/v1/inventories/%d/hosts/' % self.inventory_a.pk, auth=auth)
+            self.check_list_queries('/api/v1/inventories/%d/groups/' % self.inventory_a.pk, auth=auth)
+
+    def test_cursor_pagination(self):
+        for x in xrange(5):
+            self.inventory_a.hosts.create(name='host-%d' % (4 - x), inventory=self.inventory_a)
+        url = '/api/v1/inventories/%d/hosts/' % self.inventory_a.pk
+        auth = self.get_normal_credentials()
+        data = self.get(url + '?cursor=&page_size=2', expect=200, auth=auth)
+        self.assertEqual([x['name'] for x in data['results']], ['host-0', 'host-1'])
+        self.assertEqual(data['previous'], None)
+        # Hosts added before the cursor don't change the following pages.
+        self.inventory_a.hosts.create(name='host-00', inventory=self.inventory_a)
+        data = self.get(data['next'], expect=200, auth=auth)
+        self.assertEqual([x['name'] for x in data['results']], ['host-2', 'host-3'])
+        data = self.get(data['next'], expect=200, auth=auth)
+        self.assertEqual([x['name'] for x in data['results']], ['host-4'])
+        self.assertEqual(data['next'], None)
+        self.get(url + '?cursor=bogus', expect=400, auth=auth)
+        # Cursors that decode but don't fit the ordering are refused too.
+        for values in (['host-1', 'abc'], ['host-1', [1]], [None, 1], ['host-1'], dict(id=1)):
+            cursor = base64.urlsafe_b64encode(json.dumps(values))
+            self.get(url + '?cursor=%s' % cursor, expect=400, auth=auth)
+        # Cursors also work for lists filtered by permissions.
+        data = self.get('/api/v1/hosts/?cursor=&page_size=3', expect=200, auth=auth)
+        self.assertEqual([x['name'] for x in data['results']], ['host-0', 'host-00', 'host-1'])
+
+    def test_bulk_load(self):
+        url = '/api/v1/inventories/%d/bulk/' % self.inventory_a.pk
+        existing = self.inventory_a.hosts.create(name='host-0', inventory=self.inventory_a)
+        data = dict(
+            hosts=[dict(name='host-%d' % x) for x in xrange(200)] + [dict(name='web1', variables=dict(port=8080))],
+            groups=[
+                dict(name='web', variables=dict(role='web'), hosts=['web1', 'host-0'], children=['db']),
+                dict(name='db', hosts=['host-%d' % x for x in xrange(1, 100)]),
+            ],
+        )
+        self.post(url, data, expect=401)
+        self.post(url, data, expect=403, auth=self.get_other_credentials())
+        self.post(url, dict(hosts='web1'), expect=400, auth=self.get_normal_credentials())
+        self.post(url, dict(groups=[dict(name='web', hosts=[1])]), expect=400, auth=self.get_normal_credentials())
+        # Names too long for the database are refused before anything is written.
+        self.post(url, dict(hosts=[dict(name='web2')], groups=[dict(name='web', children=['x' * 600])]),
+                  expect=400, auth=self.get_normal_credentials())
+        self.assertFalse(self.inventory_a.hosts.filter(name='web2').exists())
+        loader = InventoryLoader(self.inventory_a)
+        self.assertEqual(loader.replaced_variable_data_pks, set())
+        loader.add_host('h' * 513)
+        loader.add_group('web', variables=['not', 'a', 'dict'])
+        try:
+            loader.save()
+            self.fail('expected ValidationError')
+        except ValidationError, e:
+            self.assertEqual(len(e.messages), 2)
+        version = Inventory.objects.get(pk=self.inventory_a.pk).snapshot_version
+        # The number of queries doesn't depend on the number of hosts.
+        queries, result = self.count_queries(self.post, url, data, expect=200, auth=self.get_normal_credentials())
+        self.assertTrue(queries < 50, queries)
+        self.assertEqual(result, dict(hosts=200, groups=2, variables=0, group_hosts=101, group_children=1))
+        self.assertEqual(self.inventory_a.hosts.count(), 201)
+        self.assertEqual(self.inventory_a.hosts.get(name='host-0').pk, existing.pk)
+        self.assertEqual(json.loads(self.inventory_a.hosts.get(name='web1').variable_data.data), dict(port=8080))
+        self.assertEqual(self.inventory_a.hosts.get(name='host-5').variable_data, None)
+        web = self.inventory_a.groups.get(name='web')
+        self.assertEqual(json.loads(web.variable_data.data), dict(role='web'))
+        self.assertEqual(set(web.hosts.values_list('name', flat=True)), set(['web1', 'host-0']))
+        self.assertEqual(list(web.children.values_list('name', flat=True)), ['db'])
+        self.assertEqual(self.inventory_a.groups.get(name='db').hosts.count(), 99)
+        self.assertNotEqual(Inventory.objects.get(pk=self.inventory_a.pk).snapshot_version, version)
+        # Loading again only replaces variables and adds nothing.
+        data['hosts'][-1]['variables'] = dict(port=8081)
+        result = self.post(url, data, expect=200, auth=self.get_normal_credentials())
+        self.assertEqual(result, dict(hosts=0, groups=0, variables=1, group_hosts=0, group_children=0))
+        self.assertEqual(json.loads(self.inventory_a.hosts.get(name='web1').variable_data.data), dict(port=8081))
+        self.assertEqual(VariableData.objects.filter(name='').count(), 2)
+
+    def test_variable_data_conditional_get(self):
+        host = self.inventory_a.hosts.create(name='host-1', inventory=self.inventory_a)
+        group = self.inventory_a.groups.create(name='group-1', inventory=self.inventory_a)
+        client = Client()
+        client.login(username=self.normal_username, password=self.normal_password)
+        for url in ('/api/v1/hosts/%d/variable_data/' % host.pk,
+                    '/api/v1/groups/%d/variable_data/' % group.pk):
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.put(url, dict(a=1), expect=200, auth=self.get_normal_credentials())
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), dict(a=1))
+            etag = response['ETag']
+            # Changing the variables in place is a change too.
+            self.put(url, dict(a=2), expect=200, auth=self.get_normal_credentials())
+            response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), dict(a=2))
+            etag = response['ETag']
+            other_client = Client()
+            other_client.login(username=self.other_username, password=self.other_password)
+            self.assertEqual(other_client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 403)
+
+    def test_shared_variable_data(self):
+        hosts = [self.inventory_a.hosts.create(name='host-%d' % x, inventory=self.inventory_a) for x in xrange(3)]
+        auth = self.get_normal_credentials()
+        for host in hosts:
+            url = '/api/v1/hosts/%d/variable_data/' % host.pk
+            self.assertEqual(self.put(url, dict(b=2, a=1), expect=200, auth=auth), dict(a=1, b=2))
+        # Hosts with the same variables share one VariableData.
+        self.assertEqual(len(set(Host.objects.filter(pk__in=[h.pk for h in hosts]).values_list('variable_data', flat=True))), 1)
+        variable_data = Host.objects.get(pk=hosts[0].pk).variable_data
+        self.assertEqual(variable_data.data, '{"a":1,"b":2}')
+        self.get('/api/v1/variable_data/%d/' % variable_data.pk, expect=200, auth=auth)
+        self.get('/api/v1/variable_data/%d/' % variable_data.pk, expect=403, auth=self.get_nobody_credentials())
+        # Changing the variables of one host doesn't change the others.
+        url = '/api/v1/hosts/%d/variable_data/' % hosts[0].pk
+        self.assertEqual(self.put(url, dict(a=3), expect=200, auth=auth), dict(a=3))
+        self.assertEqual(self.get(url, expect=200, auth=auth), dict(a=3))
+        url = '/api/v1/hosts/%d/variable_data/' % hosts[1].pk
+        self.assertEqual(self.get(url, expect=200, auth=auth), dict(a=1, b=2))
+        self.assertEqual(VariableData.objects.get(pk=variable_data.pk).variables, dict(a=1, b=2))
+        # Shared variables can't be changed in place, and there's only one
+        # row for each set of variables.
+        variable_data.data = '{"a":4}'
+        self.assertRaises(ValidationError, variable_data.save)
+        self.assertEqual(VariableData.get_or_create_for(dict(a=1, b=2)).pk, variable_data.pk)
+        self.assertRaises(IntegrityError, VariableData.objects.create, data='{"b":2,"a":1}')
+        # Unused variable data is removed when the last host stops using it.
+        for host in hosts[1:]:
+            url = '/api/v1/hosts/%d/variable_data/' % host.pk
+            self.put(url, dict(a=3), expect=200, auth=auth)
+        self.assertFalse(VariableData.objects.filter(pk=variable_data.pk).exists())
+        self.assertEqual(VariableData.objects.filter(data='{"a":3}').count(), 1)
+
+    def test_group_ancestry(self):
+        groups = dict([(name, self.inventory_a.groups.create(name=name, inventory=self.inventory_a))
+                       for name in ('a', 'b', 'c', 'd')])
+        hosts = dict([(name, self.inventory_a.hosts.create(name=name, inventory=self.inventory_a))
+                      for name in ('host-a', 'host-c', 'host-d')])
+        auth = self.get_normal_credentials()
+        # a > b > c and a > d, with another path a > d > c
+        for parent, child in (('a', 'b'), ('b', 'c'), ('a', 'd'), ('d', 'c')):
+            self.post('/api/v1/groups/%d/children/' % groups[parent].pk, dict(id=groups[child].pk), expect=204, auth=auth)
+        for name in hosts:
+            groups[name[-1]].hosts.add(hosts[name])
+        ancestry = dict([((a, d), depth) for a, d, depth in
+                         GroupAncestry.objects.values_list('ancestor__name', 'descendant__name', 'depth')])
+        self.assertEqual(ancestry, {('a', 'a'): 0, ('b', 'b'): 0, ('c', 'c'): 0, ('d', 'd'): 0,
+                                    ('a', 'b'): 1, ('a', 'd'): 1, ('b', 'c'): 1, ('d', 'c'): 1,
+                                    ('a', 'c'): 2})
+        # Cycles are refused.
+        self.post('/api/v1/groups/%d/children/' % groups['c'].pk, dict(id=groups['a'].pk), expect=400, auth=auth)
+        self.post('/api/v1/groups/%d/children/' % groups['c'].pk, dict(id=groups['c'].pk), expect=400, auth=auth)
+        self.assertRaises(ValidationError, groups['a'].parents.add, groups['d'])
+        self.assertFalse(groups['a'].parents.exists())
+
+        url = '/api/v1/groups/%d/all_hosts/' % groups['a'].pk
+        data = self.get(url, expect=200, auth=auth)
+        self.assertEqual(sorted([x['name'] for x in data['results']]), ['host-a', 'host-c', 'host-d'])
+        self.check_list_queries(url, auth=auth)
+        data = self.get('/api/v1/groups/%d/all_hosts/' % groups['b'].pk, expect=200, auth=auth)
+        self.assertEqual(sorted([x['name'] for x in data['results']]), ['host-c'])
+        url = '/api/v1/hosts/%d/all_groups/' % hosts['host-c'].pk
+        data = self.get(url, expect=200, auth=auth)
+        self.assertEqual(sorted([x['name'] for x in data['results']]), ['a', 'b', 'c', 'd'])
+        self.check_list_queries(url, auth=auth)
+        self.get(url, expect=200, auth=self.get_nobody_credentials())
+        self.assertEqual(self.get(url, expect=200, auth=self.get_nobody_credentials())['results'], [])
+
+        # Removing one path keeps the other.
+        self.post('/api/v1/groups/%d/children/' % groups['b'].pk, dict(id=groups['c'].pk, disassociate=1), expect=204, auth=auth)
+        self.assertEqual(GroupAncestry.objects.get(ancestor=groups['a'], descendant=groups['c']).depth, 2)
+        self.assertFalse(GroupAncestry.objects.filter(ancestor=groups['b'], descendant=groups['c']).exists())
+        groups['d'].children.clear()
+        data = self.get(url, expect=200, auth=auth)
+        self.assertEqual(sorted([x['name'] for x in data['results']]), ['c'])
+
+        # The bulk loader keeps ancestry current and refuses cycles too.
+        bulk_url = '/api/v1/inventories/%d/bulk/' % self.inventory_a.pk
+        self.post(bulk_url, dict(groups=[dict(name='e', children=['a'])]), expect=200, auth=auth)
+        self.assertEqual(GroupAncestry.objects.get(ancestor__name='e', descendant=groups['b']).depth, 2)
+        self.post(bulk_url, dict(groups=[dict(name='b', children=['e'])]), expect=400, auth=auth)
+        self.assertFalse(groups['b'].children.exists())
+
+    def test_group_ancestry_remove(self):
+        groups = dict([(name, self.inventory_a.groups.create(name=name, inventory=self.inventory_a))
+                       for name in ('a', 'b', 'c', 'd', 'e', 'x', 'y')])
+        # a > b > c > d and a > e > d, with x > y off to the side
+        for parent, child in (('a', 'b'), ('b', 'c'), ('c', 'd'), ('a', 'e'), ('e', 'd'), ('x', 'y')):
+            groups[child].parents.add(groups[parent])
+        def get_ancestry():
+            return dict([((a, d), depth) for a, d, depth in
+                         GroupAncestry.objects.values_list('ancestor__name', 'descendant__name', 'depth')
+                         if a != d])
+        other_pks = set(GroupAncestry.objects.filter(descendant__name__in=['a', 'b', 'x', 'y']).values_list('pk', flat=True))
+        # Only the rows below a removed edge change.
+        groups['e'].parents.remove(groups['a'])
+        self.assertEqual(get_ancestry(), {('a', 'b'): 1, ('a', 'c'): 2, ('a', 'd'): 3, ('b', 'c'): 1,
+                                          ('b', 'd'): 2, ('c', 'd'): 1, ('e', 'd'): 1, ('x', 'y'): 1})
+        groups['b'].children.clear()
+        self.assertEqual(get_ancestry(), {('a', 'b'): 1, ('c', 'd'): 1, ('e', 'd'): 1, ('x', 'y'): 1})
+        groups['d'].parents.clear()
+        self.assertEqual(get_ancestry(), {('a', 'b'): 1, ('x', 'y'): 1})
+        self.assertEqual(set(GroupAncestry.objects.filter(descendant__name__in=['a', 'b', 'x', 'y']).values_list('pk', flat=True)),
+                         other_pks)
+        self.assertEqual(GroupAncestry.objects.filter(ancestor=models.F('descendant')).count(), 7)
+
+    def test_group_ancestry_delete(self):
+        groups = dict([(name, self.inventory_a.groups.create(name=name, inventory=self.inventory_a))
+                       for name in ('a', 'b', 'c', 'd', 'e', 'f')])
+        host = self.inventory_a.hosts.create(name='host-c', inventory=self.inventory_a)
+        groups['c'].hosts.add(host)
+        # a > b > c and d > e > f
+        for parent, child in (('a', 'b'), ('b', 'c'), ('d', 'e'), ('e', 'f')):
+            groups[child].parents.add(groups[parent])
+        auth = self.get_super_credentials()
+        url = '/api/v1/groups/%d/all_hosts/' % groups['a'].pk
+        self.assertEqual([x['name'] for x in self.get(url, expect=200, auth=auth)['results']], ['host-c'])
+        # Deleting the group in the middle through the API leaves it inactive,
+        # and it no longer connects the groups around it.
+        self.delete('/api/v1/groups/%d/' % groups['b'].pk, expect=204, auth=auth)
+        self.assertEqual(self.get(url, expect=200, auth=auth)['results'], [])
+        data = self.get('/api/v1/hosts/%d/all_groups/' % host.pk, expect=200, auth=auth)
+        self.assertEqual([x['name'] for x in data['results']], ['c'])
+        # Reactivating it restores them.
+        b = Group.objects.get(pk=groups['b'].pk)
+        b.active = True
+        b.save()
+        self.assertEqual(GroupAncestry.objects.get(ancestor=groups['a'], descendant=groups['c']).depth, 2)
+        # Edges added to an inactive group aren't followed either.
+        b.active = False
+        b.save()
+        groups['c'].parents.add(b)
+        self.assertFalse(GroupAncestry.objects.filter(ancestor=groups['a'], descendant=groups['c']).exists())
+        # Deleting the row removes its edges too.
+        groups['e'].delete()
+        self.assertEqual(list(GroupAncestry.objects.filter(descendant=groups['f']).values_list('ancestor__name', flat=True)),
+                         ['f'])
+        self.assertFalse(groups['f'].parents.exists())
+
+    def test_effective_variables(self):
+        def make_group(name, parents=(), **variables):
+            group = self.inventory_a.groups.create(name=name, inventory=self.inventory_a,
+                                                   variable_data=VariableData.get_or_create_for(variables))
+            for parent in parents:
+                group.parents.add(parent)
+            return group
+        top = make_group('top', x=1, y=1, z=1)
+        web = make_group('web', [top], x=2)
+        east = make_group('web-east', [web], x=3)
+        a = make_group('a', [top], y='a')
+        b = make_group('b', [top], y='b')
+        # the deepest group, so applied last
+        c = make_group('c', [east], z='c')
+        host = self.inventory_a.hosts.create(name='host', inventory=self.inventory_a,
+                                             variable_data=VariableData.get_or_create_for(dict(z='host')))
+        for group in (east, b, a):
+            group.hosts.add(host)
+        other = self.inventory_a.hosts.create(name='other', inventory=self.inventory_a)
+        for group in (east, b, a, c):
+            group.hosts.add(other)
+        url = '/api/v1/hosts/%d/effective_variables/' % host.pk
+        auth = self.get_normal_credentials()
+        self.assertEqual(self.get(url, expect=200, auth=auth), dict(x=3, y='b', z='host'))
+        self.get(url, expect=403, auth=self.get_nobody_credentials())
+        self.put(url, dict(), expect=403, auth=auth)
+        url = '/api/v1/hosts/%d/effective_variables/' % other.pk
+        self.assertEqual(self.get(url, expect=200, auth=auth), dict(x=3, y='b', z='c'))
+        # Hosts in the same groups share the merged group variables.
+        from lib.main.hostvars import EffectiveVariables
+        effective = EffectiveVariables(self.inventory_a)
+        self.assertEqual(effective.get_all_host_variables(), {'host': dict(x=3, y='b', z='host'),
+                                                              'other': dict(x=3, y='b', z='c')})
+        self.assertEqual(len(effective._merged), 2)
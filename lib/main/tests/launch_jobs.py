@@ -0,0 +1,309 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import os
+import shutil
+import tempfile
+from django.test.client import Client
+from django.utils.timezone import now
+from djcelery.models import TaskMeta
+from lib.main.models import *
+from lib.main.scheduler import schedule, defer_scheduling, run_deferred_scheduling
+from lib.main.tasks import run_launch_job
+from lib.main.tests.base import BaseTest
+
+class LaunchJobStatusTest(BaseTest):
+    '''
+    Test cases for the launch job status and output resources.
+    '''
+
+    def setUp(self):
+        super(LaunchJobStatusTest, self).setUp()
+        self.setup_users()
+        self.organization = self.make_organizations(self.super_django_user, 1)[0]
+        self.organization.admins.add(self.normal_django_user)
+        self.project = self.make_projects(self.normal_django_user, 1)[0]
+        self.inventory = Inventory.objects.create(name='test-inventory',
+                                                  organization=self.organization)
+        self.launch_job = LaunchJob.objects.create(name='test-launch-job',
+                                                   inventory=self.inventory,
+                                                   project=self.project)
+        self.temp_dir = tempfile.mkdtemp()
+        self.output = ''.join(['line %d\n' % x for x in xrange(1000)])
+        stdout_path = os.path.join(self.temp_dir, 'job.stdout')
+        file(stdout_path, 'wb').write(self.output)
+        self.launch_job_status = self.launch_job.launch_job_statuses.create(
+            name='launch-job-status-%s' % now().isoformat(), status='running',
+            result_stdout_file=stdout_path, result_stderr='no stderr file')
+
+    def tearDown(self):
+        super(LaunchJobStatusTest, self).tearDown()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def get_output(self, url, expect=200, auth=None, **extra):
+        client = Client()
+        if auth:
+            client.login(username=auth[0], password=auth[1])
+        response = client.get(url, **extra)
+        self.assertEqual(response.status_code, expect)
+        if response.streaming:
+            response.output = ''.join(response.streaming_content)
+        return response
+
+    def test_get_launch_job_status(self):
+        url = self.launch_job_status.get_absolute_url()
+        self.get(url, expect=401)
+        self.get(url, expect=403, auth=self.get_other_credentials())
+        data = self.get(url, expect=200, auth=self.get_normal_credentials())
+        self.assertEqual(data['status'], 'running')
+        self.assertFalse('result_stdout' in data)
+        self.put(url, data, expect=403, auth=self.get_normal_credentials())
+        response = self.get_output(data['related']['stdout'],
+                                   auth=self.get_normal_credentials())
+        self.assertEqual(response.output, self.output)
+        self.assertEqual(response['Content-Length'], str(len(self.output)))
+        self.get_output(data['related']['stdout'], expect=403,
+                        auth=self.get_other_credentials())
+        # Output that was only saved in the database is still returned.
+        response = self.get_output(data['related']['stderr'],
+                                   auth=self.get_super_credentials())
+        self.assertEqual(response.output, 'no stderr file')
+
+    def test_get_output_range(self):
+        url = self.launch_job_status.get_absolute_url() + 'stdout/'
+        auth = self.get_normal_credentials()
+        size = len(self.output)
+        response = self.get_output(url, expect=206, auth=auth, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.output, self.output[10:20])
+        self.assertEqual(response['Content-Range'], 'bytes 10-19/%d' % size)
+        response = self.get_output(url, expect=206, auth=auth, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.output, self.output[100:])
+        response = self.get_output(url, expect=206, auth=auth, HTTP_RANGE='bytes=-7')
+        self.assertEqual(response.output, self.output[-7:])
+        self.assertEqual(response['Content-Range'], 'bytes %d-%d/%d' % (size - 7, size - 1, size))
+        response = self.get_output(url, expect=416, auth=auth, HTTP_RANGE='bytes=%d-' % size)
+        self.assertEqual(response['Content-Range'], 'bytes */%d' % size)
+        # Invalid or multiple ranges are ignored.
+        response = self.get_output(url, expect=200, auth=auth, HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.output, self.output)
+
+    def test_get_output_from_offset(self):
+        url = self.launch_job_status.get_absolute_url() + 'stdout/'
+        auth = self.get_normal_credentials()
+        size = len(self.output)
+        response = self.get_output(url + '?offset=100&limit=50', auth=auth)
+        self.assertEqual(response.output, self.output[100:150])
+        self.assertEqual(response['X-Output-Offset'], '150')
+        self.assertEqual(response['X-Output-Size'], str(size))
+        self.assertEqual(response['X-Launch-Job-Status'], 'running')
+        # Output added while the job is running is returned on the next poll.
+        file(self.launch_job_status.result_stdout_file, 'ab').write('more\n')
+        response = self.get_output(url + '?offset=%d' % size, auth=auth)
+        self.assertEqual(response.output, 'more\n')
+        self.assertEqual(response['X-Output-Offset'], str(size + 5))
+        # Nothing new yet.
+        response = self.get_output(url + '?offset=%d&wait=0' % (size + 5), auth=auth)
+        self.assertEqual(response.output, '')
+        self.assertEqual(response['X-Output-Offset'], str(size + 5))
+        self.get_output(url + '?offset=foo', expect=400, auth=auth)
+
+class LaunchJobSchedulerTest(BaseTest):
+    '''
+    Test cases for limiting how many launch jobs run at once.
+    '''
+
+    def setUp(self):
+        super(LaunchJobSchedulerTest, self).setUp()
+        self.setup_users()
+        self.organization = self.make_organizations(self.super_django_user, 1)[0]
+        self.projects = self.make_projects(self.normal_django_user, 2)
+        self.inventories = [Inventory.objects.create(name='test-inventory-%d' % x,
+                                                     organization=self.organization)
+                            for x in xrange(2)]
+        self.temp_dir = tempfile.mkdtemp()
+        self.scheduler_settings = self.settings(
+            LAUNCH_JOB_SCHEDULER_LOCK=os.path.join(self.temp_dir, 'scheduler.lock'),
+            LAUNCH_JOB_MAX_RUNNING=3, LAUNCH_JOB_MAX_RUNNING_PER_INVENTORY=2,
+            LAUNCH_JOB_MAX_RUNNING_PER_PROJECT=0)
+        self.scheduler_settings.enable()
+        self.dispatched = []
+
+    def tearDown(self):
+        super(LaunchJobSchedulerTest, self).tearDown()
+        self.scheduler_settings.disable()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def dispatch(self, launch_job_status):
+        self.assertTrue(launch_job_status.celery_task_id)
+        self.dispatched.append(launch_job_status.pk)
+
+    def create_status(self, inventory, project, priority=0):
+        launch_job = LaunchJob.objects.create(name='test-launch-job-%d' % LaunchJob.objects.count(),
+                                              inventory=inventory, project=project)
+        return launch_job.launch_job_statuses.create(name='launch-job-status-%s' % now().isoformat(),
+                                                     priority=priority)
+
+    def finish(self, launch_job_status):
+        LaunchJobStatus.objects.filter(pk=launch_job_status.pk).update(status='successful')
+
+    def test_schedule(self):
+        a1 = self.create_status(self.inventories[0], self.projects[0])
+        a2 = self.create_status(self.inventories[0], self.projects[0])
+        a3 = self.create_status(self.inventories[0], self.projects[1])
+        b1 = self.create_status(self.inventories[1], self.projects[1])
+        b2 = self.create_status(self.inventories[1], self.projects[1], priority=5)
+        # The third job for the first inventory waits without holding up the
+        # jobs for the second one, and higher priorities go first.
+        self.assertEqual(schedule(self.dispatch), [b2.pk, a1.pk, a2.pk])
+        self.assertEqual(self.dispatched, [b2.pk, a1.pk, a2.pk])
+        self.assertEqual(schedule(self.dispatch), [])
+        queued = LaunchJobStatus.objects.filter(status='pending', celery_task_id='')
+        self.assertEqual(sorted(queued.values_list('pk', flat=True)), [a3.pk, b1.pk])
+        # Room under the global limit isn't enough while the inventory is
+        # still at its limit.
+        self.finish(b2)
+        self.assertEqual(schedule(self.dispatch), [b1.pk])
+        self.finish(a1)
+        self.assertEqual(schedule(self.dispatch), [a3.pk])
+        # Jobs from a project at its limit wait too.
+        with self.settings(LAUNCH_JOB_MAX_RUNNING_PER_PROJECT=1):
+            self.finish(a2)
+            a4 = self.create_status(self.inventories[0], self.projects[1])
+            c1 = self.create_status(self.inventories[1], self.projects[0])
+            self.assertEqual(schedule(self.dispatch), [c1.pk])
+            self.finish(a3)
+            self.finish(b1)
+            self.assertEqual(schedule(self.dispatch), [a4.pk])
+
+    def test_schedule_dispatch_error(self):
+        def dispatch(launch_job_status):
+            if not self.dispatched:
+                self.dispatched.append(launch_job_status.pk)
+                raise RuntimeError('broker unavailable')
+            self.dispatch(launch_job_status)
+        launch_job_status = self.create_status(self.inventories[0], self.projects[0])
+        waiting = self.create_status(self.inventories[0], self.projects[0])
+        # The slot of the job that couldn't be sent goes to the next one.
+        with self.settings(LAUNCH_JOB_MAX_RUNNING=1):
+            self.assertEqual(schedule(dispatch), [launch_job_status.pk, waiting.pk])
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'error')
+        self.assertTrue('broker unavailable' in launch_job_status.result_traceback)
+        self.assertEqual(LaunchJobStatus.objects.get(pk=waiting.pk).status, 'pending')
+
+    def test_reap(self):
+        a1 = self.create_status(self.inventories[0], self.projects[0])
+        a2 = self.create_status(self.inventories[0], self.projects[0])
+        b1 = self.create_status(self.inventories[1], self.projects[0])
+        b2 = self.create_status(self.inventories[1], self.projects[0])
+        self.assertEqual(schedule(self.dispatch), [a1.pk, a2.pk, b1.pk])
+        an_hour_ago = now() - datetime.timedelta(hours=1)
+        LaunchJobStatus.objects.filter(pk__in=[a1.pk, a2.pk]).update(status='running',
+                                                                     started=an_hour_ago)
+        # The worker running a1 was killed at the time limit, and the worker
+        # running a2 died.
+        TaskMeta.objects.create(task_id=LaunchJobStatus.objects.get(pk=a1.pk).celery_task_id,
+                                status='FAILURE')
+        # b1 has been waiting in the celery queue for a worker.
+        LaunchJobStatus.objects.filter(pk=b1.pk).update(admitted=an_hour_ago)
+        with self.settings(LAUNCH_JOB_REAP_TIMEOUT=900):
+            self.assertEqual(schedule(self.dispatch), [b2.pk])
+        for pk in (a1.pk, a2.pk):
+            launch_job_status = LaunchJobStatus.objects.get(pk=pk)
+            self.assertEqual(launch_job_status.status, 'error')
+            self.assertTrue(launch_job_status.result_traceback)
+        launch_job_status = LaunchJobStatus.objects.get(pk=b1.pk)
+        self.assertEqual(launch_job_status.status, 'pending')
+        self.assertFalse(launch_job_status.result_traceback)
+
+    def test_defer_scheduling(self):
+        a1 = self.create_status(self.inventories[0], self.projects[0])
+        # Scheduling during a request waits until its transaction is committed.
+        defer_scheduling()
+        self.assertEqual(schedule(self.dispatch), [])
+        self.assertEqual(LaunchJobStatus.objects.get(pk=a1.pk).celery_task_id, '')
+        self.assertEqual(run_deferred_scheduling(self.dispatch), [a1.pk])
+        self.assertEqual(self.dispatched, [a1.pk])
+        # Nothing was held off this time.
+        defer_scheduling()
+        self.assertEqual(run_deferred_scheduling(self.dispatch), [])
+        a2 = self.create_status(self.inventories[0], self.projects[0])
+        self.assertEqual(schedule(self.dispatch), [a2.pk])
+
+    def test_schedule_slices(self):
+        launch_job = LaunchJob.objects.create(name='test-sliced-launch-job',
+                                              inventory=self.inventories[1],
+                                              project=self.projects[0],
+                                              slice_count=3)
+        with self.settings(LAUNCH_JOB_MAX_RUNNING=2):
+            launch_job_status = launch_job._create_status()
+            slices = list(launch_job_status.slices.order_by('slice_index'))
+            self.assertEqual([s.slice_index for s in slices], [0, 1, 2])
+            # Only the slices run, as many at once as the limits allow.
+            self.assertEqual(schedule(self.dispatch), [slices[0].pk, slices[1].pk])
+        LaunchJobStatus.objects.filter(pk=slices[0].pk).update(status='running')
+        launch_job_status.update_from_slices()
+        self.assertEqual(LaunchJobStatus.objects.get(pk=launch_job_status.pk).status, 'running')
+        LaunchJobStatus.objects.filter(pk__in=[slices[0].pk, slices[2].pk]).update(status='successful')
+        LaunchJobStatus.objects.filter(pk=slices[1].pk).update(status='failed',
+                                                               result_traceback='boom')
+        launch_job_status.update_from_slices()
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'failed')
+        self.assertTrue('boom' in launch_job_status.result_traceback)
+        # The slices are listed through the API.
+        url = launch_job_status.get_absolute_url()
+        data = self.get(url, expect=200, auth=self.get_super_credentials())
+        self.assertEqual(data['slice_count'], 3)
+        slices_url = data['related']['slices']
+        data = self.get(slices_url, expect=200, auth=self.get_super_credentials())
+        self.assertEqual([r['id'] for r in data['results']], [s.pk for s in slices])
+        self.assertEqual(data['results'][1]['status'], 'failed')
+        self.get(slices_url, expect=401)
+
+    def test_cancel(self):
+        self.organization.admins.add(self.normal_django_user)
+        a1 = self.create_status(self.inventories[0], self.projects[0])
+        a2 = self.create_status(self.inventories[0], self.projects[0])
+        a3 = self.create_status(self.inventories[0], self.projects[0])
+        self.assertEqual(schedule(self.dispatch), [a1.pk, a2.pk])
+        LaunchJobStatus.objects.filter(pk=a1.pk).update(status='running')
+        # A running job is only asked to stop; its worker marks it canceled.
+        url = a1.get_absolute_url()
+        cancel_url = self.get(url, expect=200, auth=self.get_normal_credentials())['related']['cancel']
+        self.get(cancel_url, expect=401)
+        self.post(cancel_url, {}, expect=403, auth=self.get_other_credentials())
+        self.assertEqual(self.get(cancel_url, expect=200, auth=self.get_normal_credentials()),
+                         {'can_cancel': True})
+        self.post(cancel_url, {}, expect=202, auth=self.get_normal_credentials())
+        a1 = LaunchJobStatus.objects.get(pk=a1.pk)
+        self.assertEqual(a1.status, 'running')
+        self.assertTrue(a1.cancel_flag)
+        # A job sent to a worker that hasn't started is canceled right away,
+        # and the worker won't start it.  (The limit keeps the waiting job
+        # from being sent to celery here.)
+        with self.settings(LAUNCH_JOB_MAX_RUNNING=1, JOB_OUTPUT_DIR=self.temp_dir):
+            self.assertTrue(LaunchJobStatus.objects.get(pk=a2.pk).cancel())
+            run_launch_job(a2.pk)
+        a2 = LaunchJobStatus.objects.get(pk=a2.pk)
+        self.assertEqual(a2.status, 'canceled')
+        self.assertFalse(a2.can_cancel)
+        self.post(cancel_url.replace('/%d/' % a1.pk, '/%d/' % a2.pk), {}, expect=409,
+                  auth=self.get_normal_credentials())
+        # Its slot goes to the job that was waiting.
+        self.assertEqual(schedule(self.dispatch), [a3.pk])
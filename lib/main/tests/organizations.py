@@ -111,6 +111,59 @@ class OrganizationsTest(BaseTest):
         # other user isn't a user or admin of anything, and similarly can't get in
         data = self.get(urls[0], expect=403, auth=self.get_other_credentials())
 
+    def test_related_urls(self):
+        import lib.urls
+        from django.core.urlresolvers import reverse
+        organization = self.organizations[0]
+        data = self.get(organization.get_absolute_url(), expect=200, auth=self.get_super_credentials())
+        self.assertEqual(data['url'], reverse(lib.urls.views_OrganizationsDetail, args=(organization.pk,)))
+        self.assertEqual(data['related']['users'], reverse(lib.urls.views_OrganizationsUsersList, args=(organization.pk,)))
+        # URL templates are cached, but URLs are still correct for any pk.
+        for pk in (1, 42, 8675309):
+            self.assertEqual(reverse_pk(lib.urls.views_HostsDetail, pk),
+                             reverse(lib.urls.views_HostsDetail, args=(pk,)))
+
+    def test_conditional_get(self):
+        organization = self.organizations[0]
+        url = organization.get_absolute_url()
+        client = Client()
+        client.login(username=self.normal_username, password=self.normal_password)
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        # Lists work the same way.
+        response = client.get(self.collection())
+        list_etag = response['ETag']
+        self.assertNotEqual(list_etag, etag)
+        response = client.get(self.collection(), HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEqual(response.status_code, 304)
+        # Changes to models the response doesn't use keep the ETag.
+        project = Project.objects.create(name='unrelated')
+        project.description = 'changed'
+        project.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # A change means a new response.
+        organization.description = 'changed'
+        organization.save()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['description'], 'changed')
+        self.assertNotEqual(response['ETag'], etag)
+        etag = response['ETag']
+        # Users without access still can't see the item.
+        client = Client()
+        client.login(username=self.other_username, password=self.other_password)
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 403)
+
+    def test_list_queries(self):
+        self.check_list_queries(self.collection(), auth=self.get_super_credentials())
+        self.check_list_queries(self.collection(), auth=self.get_normal_credentials())
+
     def test_get_item_subobjects_projects(self):
 
         # first get all the orgs
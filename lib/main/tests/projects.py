@@ -17,11 +17,17 @@
 
 import datetime
 import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
 
 from django.contrib.auth.models import User as DjangoUser
 import django.test
 from django.test.client import Client
 from lib.main.models import *
+from lib.main.projects import ProjectCheckout, remove_tree
 from lib.main.tests.base import BaseTest
 
 class ProjectsTest(BaseTest):
@@ -94,6 +100,15 @@ class ProjectsTest(BaseTest):
         # here is a user without any permissions...
         return ('nobody', 'nobody')
 
+    def test_list_queries(self):
+        auth = self.get_super_credentials()
+        self.check_list_queries('/api/v1/teams/', auth=auth)
+        for x in xrange(2):
+            Credential.objects.create(name='team-cred-%d' % x, team=self.team1)
+            Credential.objects.create(name='user-cred-%d' % x, user=self.normal_django_user)
+        self.check_list_queries('/api/v1/teams/%d/credentials/' % self.team1.pk, auth=auth)
+        self.check_list_queries('/api/v1/users/%d/credentials/' % self.normal_django_user.pk, auth=auth)
+
     def test_mainline(self):
 
         # =====================================================================
@@ -367,10 +382,107 @@ class ProjectsTest(BaseTest):
         # can remove credentials from a user
         # can remove credentials from a team
 
+class ProjectCheckoutTest(BaseTest):
+    '''
+    Test cases for mirroring git projects and checking out revisions.
+    '''
 
-
-
-
-
-
-
+    def setUp(self):
+        super(ProjectCheckoutTest, self).setUp()
+        self.setup_users()
+        self.temp_dir = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.temp_dir, 'repo')
+        self.git('init', '-q', self.repo_path)
+        self.commit('site.yml', '- hosts: all\n')
+        self.project = self.make_projects(self.normal_django_user, 1)[0]
+        self.project.local_repository = self.repo_path
+        self.project.default_playbook = 'site.yml'
+        self.project.save()
+        self.checkout_settings = self.settings(PROJECT_CHECKOUT_DIR=os.path.join(self.temp_dir, 'checkouts'),
+                                               PROJECT_CHECKOUT_KEEP=1)
+        self.checkout_settings.enable()
+
+    def tearDown(self):
+        super(ProjectCheckoutTest, self).tearDown()
+        self.checkout_settings.disable()
+        remove_tree(self.temp_dir)
+
+    def git(self, *args):
+        return subprocess.check_output(('git', '-c', 'user.name=test', '-c',
+                                        'user.email=test@example.com') + args).strip()
+
+    def commit(self, name, data):
+        file(os.path.join(self.repo_path, name), 'wb').write(data)
+        self.git('-C', self.repo_path, 'add', name)
+        self.git('-C', self.repo_path, 'commit', '-q', '-m', 'update %s' % name)
+        return self.git('-C', self.repo_path, 'rev-parse', 'HEAD')
+
+    def test_checkout(self):
+        first = self.git('-C', self.repo_path, 'rev-parse', 'HEAD')
+        checkout = ProjectCheckout(self.project).acquire()
+        self.assertEqual(checkout.revision, first)
+        self.assertEqual(file(os.path.join(checkout.path, 'site.yml')).read(), '- hosts: all\n')
+        # Jobs at the same revision share its files.
+        checkout2 = ProjectCheckout(self.project).acquire()
+        self.assertEqual(checkout2.path, checkout.path)
+        checkout2.release()
+        # A new commit is fetched into a new directory; the old one is kept
+        # while it's in use.
+        second = self.commit('site.yml', '- hosts: web\n')
+        checkout2 = ProjectCheckout(self.project).acquire()
+        self.assertEqual(checkout2.revision, second)
+        self.assertEqual(file(os.path.join(checkout2.path, 'site.yml')).read(), '- hosts: web\n')
+        self.assertTrue(os.path.exists(checkout.path))
+        checkout.release()
+        # Once it isn't, only the most recent revision is kept.
+        checkout2.release()
+        checkout2 = ProjectCheckout(self.project).acquire()
+        checkout2.release()
+        self.assertFalse(os.path.exists(checkout.path))
+        # Projects can be pinned to a branch, tag or commit.
+        self.project.scm_branch = first
+        checkout = ProjectCheckout(self.project).acquire()
+        self.assertEqual(checkout.revision, first)
+        self.assertEqual(file(os.path.join(checkout.path, 'site.yml')).read(), '- hosts: all\n')
+        checkout.release()
+        self.project.scm_branch = 'no-such-branch'
+        self.assertRaises(RuntimeError, ProjectCheckout(self.project).acquire)
+
+    def test_checkout_read_only(self):
+        os.makedirs(os.path.join(self.repo_path, 'roles', 'web', 'tasks'))
+        self.commit('roles/web/tasks/main.yml', '- command: true\n')
+        checkout = ProjectCheckout(self.project).acquire()
+        checkout2 = ProjectCheckout(self.project).acquire()
+        self.assertEqual(checkout2.path, checkout.path)
+        # Nothing one job writes next to the playbook can reach another job
+        # at the same revision.
+        for dir_path, dir_names, file_names in os.walk(checkout.path):
+            for path in [dir_path] + [os.path.join(dir_path, name) for name in file_names]:
+                self.assertEqual(os.stat(path).st_mode & 0222, 0, path)
+        if os.geteuid() != 0:
+            self.assertRaises(IOError, file, os.path.join(checkout.path, 'site.retry'), 'w')
+            self.assertRaises(IOError, file, os.path.join(checkout.path, 'site.yml'), 'a')
+        checkout.release()
+        checkout2.release()
+        # Read-only revisions are still removed once they're not used.
+        self.commit('site.yml', '- hosts: web\n')
+        ProjectCheckout(self.project).acquire().release()
+        self.assertFalse(os.path.exists(checkout.path))
+
+    def test_repository_moved(self):
+        ProjectCheckout(self.project).acquire().release()
+        self.repo_path = os.path.join(self.temp_dir, 'moved')
+        self.git('init', '-q', self.repo_path)
+        moved = self.commit('site.yml', '- hosts: moved\n')
+        self.project.local_repository = self.repo_path
+        checkout = ProjectCheckout(self.project).acquire()
+        self.assertEqual(checkout.revision, moved)
+        self.assertEqual(file(os.path.join(checkout.path, 'site.yml')).read(), '- hosts: moved\n')
+        checkout.release()
+
+    def test_sync_once(self):
+        requested = time.time()
+        self.assertTrue(ProjectCheckout(self.project).sync(requested))
+        # A job that was waiting while another fetched doesn't fetch again.
+        self.assertFalse(ProjectCheckout(self.project).sync(requested))
+        self.assertTrue(ProjectCheckout(self.project).sync())
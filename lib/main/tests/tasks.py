@@ -17,11 +17,18 @@
 
 
 import os
+import shutil
+import signal
+import subprocess
 import tempfile
+import threading
+import time
 from django.conf import settings
 from django.test.utils import override_settings
 from lib.main.models import *
-from lib.main.tests.base import BaseTransactionTest
+from lib.main.credentials import ssh_agent_pool
+from lib.main.tasks import JobOutputFile, capture_output, run_launch_job
+from lib.main.tests.base import BaseTest, BaseTransactionTest
 
 TEST_PLAYBOOK = '''- hosts: test-group
   gather_facts: False
@@ -37,6 +44,29 @@ TEST_PLAYBOOK2 = '''- hosts: test-group
     command: test 1 = 0
 '''
 
+TEST_PLAYBOOK3 = '''- hosts: test-group
+  gather_facts: False
+  tasks:
+  - name: should be canceled
+    command: sleep 60
+'''
+
+TEST_PLAYBOOK_SSH_AGENT = '''- hosts: test-group
+  gather_facts: False
+  tasks:
+  - name: should list the key in the agent
+    command: ssh-add -l
+'''
+
+TEST_PLAYBOOK_RETRY_PATH = '''- hosts: test-group
+  gather_facts: False
+  tasks:
+  - name: should have a retry path outside the playbook's directory
+    shell: test -d "$ANSIBLE_RETRY_FILES_SAVE_PATH" && test "$ANSIBLE_RETRY_FILES_SAVE_PATH" != "$PWD"
+  - name: should be the only job using the retry path
+    shell: test ! -e "$ANSIBLE_RETRY_FILES_SAVE_PATH/seen" && touch "$ANSIBLE_RETRY_FILES_SAVE_PATH/seen"
+'''
+
 @override_settings(CELERY_ALWAYS_EAGER=True,
                    CELERY_EAGER_PROPAGATES_EXCEPTIONS=True)
 class BaseCeleryTest(BaseTransactionTest):
@@ -69,11 +99,21 @@ class RunLaunchJobTest(BaseCeleryTest):
                                                    project=self.project)
         # Pass test database name in environment for use by the inventory script.
         os.environ['ACOM_TEST_DATABASE_NAME'] = settings.DATABASES['default']['NAME']
+        # Keep job output files, inventory snapshots and the scheduler lock
+        # out of the source tree.
+        self.job_output_dir = tempfile.mkdtemp()
+        lock_path = os.path.join(self.job_output_dir, 'scheduler.lock')
+        self.job_output_settings = self.settings(JOB_OUTPUT_DIR=self.job_output_dir,
+                                                 INVENTORY_SNAPSHOT_DIR=self.job_output_dir,
+                                                 LAUNCH_JOB_SCHEDULER_LOCK=lock_path)
+        self.job_output_settings.enable()
 
     def tearDown(self):
         super(RunLaunchJobTest, self).tearDown()
         os.environ.pop('ACOM_TEST_DATABASE_NAME', None)
         os.remove(self.test_playbook)
+        self.job_output_settings.disable()
+        shutil.rmtree(self.job_output_dir, ignore_errors=True)
 
     def create_test_playbook(self, s):
         handle, self.test_playbook = tempfile.mkstemp(suffix='.yml', prefix='playbook-')
@@ -94,6 +134,7 @@ class RunLaunchJobTest(BaseCeleryTest):
         #print settings.DATABASES
         self.assertEqual(launch_job_status.status, 'successful')
         self.assertTrue(launch_job_status.result_stdout)
+        self.assertTrue(launch_job_status.started >= launch_job_status.admitted)
         launch_job_status_events = launch_job_status.launch_job_status_events.all()
         #for ev in launch_job_status_events:
         #    print ev.event, ev.event_data
@@ -150,3 +191,179 @@ class RunLaunchJobTest(BaseCeleryTest):
         self.assertEqual(launch_job_status_events.filter(event='playbook_on_task_start').count(), 1)
         self.assertEqual(launch_job_status_events.filter(event='runner_on_skipped').count(), 1)
         self.assertEqual(launch_job_status_events.filter(event='playbook_on_stats').count(), 1)
+
+    def test_run_launch_job_with_event_spool(self):
+        self.create_test_playbook(TEST_PLAYBOOK)
+        spool_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(CALLBACK_EVENT_SPOOL=True,
+                               CALLBACK_EVENT_SPOOL_DIR=spool_dir):
+                launch_job_status = self.launch_job.start()
+            launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+            self.assertEqual(launch_job_status.status, 'successful')
+            launch_job_status_events = launch_job_status.launch_job_status_events.all()
+            self.assertEqual(launch_job_status_events.filter(event='playbook_on_start').count(), 1)
+            self.assertEqual(launch_job_status_events.filter(event='runner_on_ok').count(), 1)
+            self.assertEqual(launch_job_status_events.filter(event='playbook_on_stats').count(), 1)
+            # Spool file is removed once all events have been loaded.
+            self.assertEqual(os.listdir(spool_dir), [])
+        finally:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+    def test_run_launch_job_output_files(self):
+        self.create_test_playbook(TEST_PLAYBOOK)
+        with self.settings(JOB_OUTPUT_TAIL_SIZE=64):
+            launch_job_status = self.launch_job.start()
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'successful')
+        self.assertEqual(os.path.dirname(launch_job_status.result_stdout_file),
+                         self.job_output_dir)
+        self.assertTrue(os.path.exists(launch_job_status.result_stderr_file))
+        # The file has the complete output; only the tail is saved in the
+        # database.
+        stdout = file(launch_job_status.result_stdout_file, 'rb').read()
+        self.assertTrue(len(stdout) > 64)
+        self.assertEqual(len(launch_job_status.result_stdout), 64)
+        self.assertTrue(stdout.endswith(launch_job_status.result_stdout))
+
+    def test_run_sliced_launch_job(self):
+        self.create_test_playbook(TEST_PLAYBOOK)
+        for x in xrange(4):
+            self.group.hosts.add(self.inventory.hosts.create(name='host%d.example.com' % x,
+                                                             inventory=self.inventory))
+        self.launch_job.slice_count = 2
+        self.launch_job.save()
+        launch_job_status = self.launch_job.start()
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'successful')
+        slices = launch_job_status.slices.order_by('slice_index')
+        self.assertEqual(list(slices.values_list('slice_index', 'status')),
+                         [(0, 'successful'), (1, 'successful')])
+        # Each slice ran against its own hosts, and the events of all of
+        # them are available from the parent.
+        host_names = []
+        for slice_status in slices:
+            events = slice_status.launch_job_status_events.filter(event='runner_on_ok')
+            names = [event.event_data['host'] for event in events]
+            self.assertTrue(names)
+            host_names.extend(names)
+        self.assertEqual(sorted(host_names),
+                         sorted(self.inventory.hosts.values_list('name', flat=True)))
+        events = launch_job_status.get_events()
+        self.assertEqual(events.filter(event='runner_on_ok').count(), 5)
+        self.assertEqual(events.filter(event='playbook_on_stats').count(), 2)
+
+    def test_run_launch_job_output_dir_error(self):
+        self.create_test_playbook(TEST_PLAYBOOK)
+        # The output directory can't be created under a file.
+        with self.settings(JOB_OUTPUT_DIR=os.path.join(self.test_playbook, 'output')):
+            launch_job_status = self.launch_job.start()
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'error')
+        self.assertTrue('OSError' in launch_job_status.result_traceback)
+
+    def test_cancel_launch_job(self):
+        self.create_test_playbook(TEST_PLAYBOOK3)
+        launch_job_status = self.launch_job.launch_job_statuses.create(name='test-cancel')
+        def cancel():
+            # Wait for the playbook to start its task before canceling.
+            from django.db import connection
+            try:
+                for x in xrange(100):
+                    if LaunchJobStatus.objects.get(pk=launch_job_status.pk).launch_job_status_events.filter(event='playbook_on_task_start').exists():
+                        break
+                    time.sleep(0.1)
+                LaunchJobStatus.objects.get(pk=launch_job_status.pk).cancel()
+            finally:
+                connection.close()
+        thread = threading.Thread(target=cancel)
+        thread.start()
+        started = time.time()
+        with self.settings(JOB_CANCEL_POLL_INTERVAL=0.2, JOB_CANCEL_KILL_TIMEOUT=1.0):
+            run_launch_job(launch_job_status.pk)
+        thread.join()
+        # The sleep was killed along with ansible-playbook.
+        self.assertTrue(time.time() - started < 30)
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'canceled')
+        self.assertFalse(launch_job_status.launch_job_status_events.filter(event='runner_on_ok').exists())
+
+    def test_run_launch_job_with_ssh_key(self):
+        self.create_test_playbook(TEST_PLAYBOOK_SSH_AGENT)
+        key_dir = tempfile.mkdtemp()
+        try:
+            key_path = os.path.join(key_dir, 'key')
+            subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', 'secret',
+                                   '-f', key_path])
+            self.launch_job.credential = Credential.objects.create(
+                name='test-credential', ssh_key_data=file(key_path, 'rb').read(),
+                ssh_key_unlock='secret')
+            self.launch_job.save()
+            launch_job_status = self.launch_job.start()
+            launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+            self.assertEqual(launch_job_status.status, 'successful')
+            # The agent is kept for the next job with the same credential.
+            agent = ssh_agent_pool.agents[self.launch_job.credential.pk]
+            self.assertTrue(agent.is_alive())
+            launch_job_status = self.launch_job.start()
+            self.assertEqual(LaunchJobStatus.objects.get(pk=launch_job_status.pk).status, 'successful')
+            self.assertTrue(ssh_agent_pool.agents[self.launch_job.credential.pk] is agent)
+        finally:
+            ssh_agent_pool.clear()
+            shutil.rmtree(key_dir, ignore_errors=True)
+
+    def test_run_launch_job_from_git_checkout(self):
+        self.create_test_playbook(TEST_PLAYBOOK)
+        repo_path = os.path.join(self.job_output_dir, 'repo')
+        git = lambda *args: subprocess.check_output(('git', '-C', repo_path, '-c', 'user.name=test',
+                                                     '-c', 'user.email=test@example.com') + args)
+        os.makedirs(repo_path)
+        git('init', '-q')
+        shutil.copy(self.test_playbook, os.path.join(repo_path, 'site.yml'))
+        git('add', 'site.yml')
+        git('commit', '-q', '-m', 'add playbook')
+        self.project.local_repository = repo_path
+        self.project.scm_type = 'git'
+        self.project.default_playbook = 'site.yml'
+        self.project.save()
+        with self.settings(PROJECT_CHECKOUT_DIR=os.path.join(self.job_output_dir, 'checkouts')):
+            launch_job_status = self.launch_job.start()
+        launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+        self.assertEqual(launch_job_status.status, 'successful')
+        self.assertEqual(launch_job_status.scm_revision, git('rev-parse', 'HEAD').strip())
+        # Jobs at the same revision share its files, but each has its own
+        # place for files ansible would otherwise write next to the playbook.
+        checkout_path = os.path.join(self.job_output_dir, 'checkouts', str(self.project.pk),
+                                     'revisions', launch_job_status.scm_revision)
+        self.assertEqual(os.stat(os.path.join(checkout_path, 'site.yml')).st_mode & 0222, 0)
+        file(os.path.join(repo_path, 'site.yml'), 'wb').write(TEST_PLAYBOOK_RETRY_PATH)
+        git('commit', '-q', '-a', '-m', 'check retry path')
+        with self.settings(PROJECT_CHECKOUT_DIR=os.path.join(self.job_output_dir, 'checkouts')):
+            launch_job_statuses = [self.launch_job.start() for x in xrange(2)]
+        for launch_job_status in launch_job_statuses:
+            launch_job_status = LaunchJobStatus.objects.get(pk=launch_job_status.pk)
+            self.assertEqual(launch_job_status.status, 'successful', launch_job_status.result_stdout)
+
+class CaptureOutputTest(BaseTest):
+    '''
+    Test cases for copying output from and stopping ansible-playbook.
+    '''
+
+    def test_cancel_process_group(self):
+        output_dir = tempfile.mkdtemp()
+        try:
+            stdout_file = JobOutputFile(os.path.join(output_dir, 'stdout'), 1024)
+            # The background sleep keeps stdout open unless it is killed too.
+            proc = subprocess.Popen(['sh', '-c', 'echo started; sleep 60 & sleep 60'],
+                                    stdout=subprocess.PIPE, preexec_fn=os.setsid)
+            started = time.time()
+            returncode, canceled = capture_output(proc, {proc.stdout: stdout_file},
+                                                  is_canceled=lambda: True,
+                                                  poll_interval=0.1, kill_timeout=1.0)
+            stdout_file.close()
+            self.assertTrue(canceled)
+            self.assertEqual(returncode, -signal.SIGTERM)
+            self.assertTrue(time.time() - started < 30)
+            self.assertEqual(stdout_file.tail, 'started\n')
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
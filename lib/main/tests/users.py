@@ -125,6 +125,10 @@ class UsersTest(BaseTest):
         data = self.get(url, expect=200, auth=self.get_super_credentials())
         self.assertTrue('password' not in data['results'][0])
 
+    def test_list_queries(self):
+        self.check_list_queries(self.collection(), auth=self.get_super_credentials())
+        self.check_list_queries(self.collection(), auth=self.get_normal_credentials())
+
     def test_user_list_filtered(self):
         url = '/api/v1/users/'
         data3 = self.get(url, expect=200, auth=self.get_super_credentials())
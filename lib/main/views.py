@@ -15,13 +15,14 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from lib.main.models import *
 from django.contrib.auth.models import User
 from lib.main.serializers import *
 from lib.main.rbac import *
-from django.core.exceptions import PermissionDenied
+from django.core.exceptions import PermissionDenied, ValidationError
 from rest_framework import mixins
 from rest_framework import generics
 from rest_framework import permissions
@@ -29,7 +30,12 @@ from rest_framework.response import Response
 from rest_framework import status
 import exceptions
 import datetime
+import os
+import time
+from cStringIO import StringIO
 from base_views import *
+from lib.main.bulk import InventoryLoader
+from lib.main.hostvars import EffectiveVariables
 
 class OrganizationsList(BaseList):
 
@@ -433,20 +439,12 @@ class InventoryList(BaseList):
     model = Inventory
     serializer_class = InventorySerializer
     permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
 
     def _filter_queryset(self, base):
         if self.request.user.is_superuser:
             return base.all()
-        admin_of  = base.filter(organization__admins__in = [ self.request.user ]).distinct()
-        has_user_perms = base.filter(
-            permissions__user__in = [ self.request.user ],
-            permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        has_team_perms = base.filter(
-            permissions__team__in = self.request.user.teams.all(),
-            permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        return admin_of | has_user_perms | has_team_perms
+        return base.filter(accesses__user=self.request.user, accesses__can_read=True)
 
     def _get_queryset(self):
         ''' I can see inventory when I'm a superuser, an org admin of the inventory, or I have permissions on it '''
@@ -459,11 +457,69 @@ class InventoryDetail(BaseDetail):
     serializer_class = InventorySerializer
     permission_classes = (CustomRbac,)
 
+class InventoryBulk(generics.GenericAPIView):
+    '''
+    Add many hosts, groups and group memberships to an inventory in one
+    request, e.g.:
+
+       {"hosts": [{"name": "web1", "variables": {"port": 8080}}],
+        "groups": [{"name": "web", "hosts": ["web1"], "children": ["db"]}]}
+
+    Hosts and groups are matched by name; existing ones are kept (with new
+    variables if given) and nothing is removed.  Write permission is checked
+    once for the whole inventory.
+    '''
+
+    model = Inventory
+    permission_classes = (CustomRbac,)
+
+    def item_permissions_check(self, request, obj):
+        if request.method == 'POST':
+            return Inventory._has_permission_types(request.user, obj, PERMISSION_TYPES_ALLOWING_INVENTORY_WRITE)
+        return False
+
+    def load_items(self, data, key, add):
+        ''' check and add each host or group from the list under key '''
+        items = data.get(key, [])
+        if not isinstance(items, list):
+            raise exceptions.ValueError('%s must be a list' % key)
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get('name', None), basestring) or not item['name']:
+                raise exceptions.ValueError('each item in %s must have a name' % key)
+            variables = item.get('variables', None)
+            if variables is not None and not isinstance(variables, dict):
+                raise exceptions.ValueError('variables for %s must be a dict' % item['name'])
+            add(item['name'], variables, item.get('description', None))
+        return items
+
+    def post(self, request, *args, **kwargs):
+        inventory = self.get_object()
+        loader = InventoryLoader(inventory, created_by=request.user)
+        data = request.DATA
+        try:
+            if not isinstance(data, dict):
+                raise exceptions.ValueError('expected an object with hosts and/or groups')
+            self.load_items(data, 'hosts', loader.add_host)
+            for group in self.load_items(data, 'groups', loader.add_group):
+                for key, add in (('hosts', loader.add_group_host), ('children', loader.add_group_child)):
+                    names = group.get(key, [])
+                    if not isinstance(names, list) or not all([isinstance(n, basestring) and n for n in names]):
+                        raise exceptions.ValueError('%s of %s must be a list of names' % (key, group['name']))
+                    for name in names:
+                        add(group['name'], name)
+        except exceptions.ValueError, e:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=dict(msg=str(e)))
+        try:
+            return Response(status=status.HTTP_200_OK, data=loader.save())
+        except ValidationError, e:
+            return Response(status=status.HTTP_400_BAD_REQUEST, data=dict(msg='; '.join(e.messages)))
+
 class HostsList(BaseList):
 
     model = Host
     serializer_class = HostSerializer
     permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
 
     def _get_queryset(self):
         '''
@@ -475,16 +531,8 @@ class HostsList(BaseList):
         base = Host.objects
         if self.request.user.is_superuser:
             return base.all()
-        admin_of  = base.filter(inventory__organization__admins__in = [ self.request.user ]).distinct()
-        has_user_perms = base.filter(
-            inventory__permissions__user__in = [ self.request.user ],
-            inventory__permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        has_team_perms = base.filter(
-            inventory__permissions__team__in = self.request.user.teams.all(),
-            inventory__permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        return admin_of | has_user_perms | has_team_perms
+        return base.filter(inventory__accesses__user=self.request.user,
+                           inventory__accesses__can_read=True)
 
 class HostsDetail(BaseDetail):
 
@@ -492,11 +540,54 @@ class HostsDetail(BaseDetail):
     serializer_class = HostSerializer
     permission_classes = (CustomRbac,)
 
+class HostsAllGroupsList(BaseSubList):
+    ''' groups a host is in, along with all of their ancestors '''
+
+    model = Group
+    serializer_class = GroupSerializer
+    permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
+    parent_model = Host
+    relationship = 'groups'
+    postable = False
+    etag_models = (Host,)
+
+    def _get_queryset(self):
+        host = Host.objects.get(pk=self.kwargs['pk'])
+        base = Group.objects.filter(descendant_links__descendant__hosts=host).distinct()
+        if self.request.user.is_superuser:
+            return base
+        return base.filter(inventory__accesses__user=self.request.user,
+                           inventory__accesses__can_read=True)
+
+class HostsEffectiveVariableDetail(BaseDetail):
+    '''
+    The variables ansible will use for a host, merged from all of its groups
+    and their ancestors and then the host's own variables.  Read only.
+    '''
+
+    model = Host
+    serializer_class = HostSerializer
+    permission_classes = (CustomRbac,)
+    etag_models = (Group, VariableData)
+
+    def retrieve(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        return self.conditional_response(request, lambda: Response(
+            EffectiveVariables(self.object.inventory).get_host_variables(self.object)))
+
+    def put(self, request, *args, **kwargs):
+        raise PermissionDenied()
+
+    def destroy(self, request, *args, **kwargs):
+        raise PermissionDenied()
+
 class InventoryHostsList(BaseSubList):
 
     model = Host
     serializer_class = HostSerializer
     permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
     # to allow the sub-aspect listing
     parent_model = Inventory
     relationship = 'hosts'
@@ -517,6 +608,7 @@ class GroupsList(BaseList):
     model = Group
     serializer_class = GroupSerializer
     permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
 
     def _get_queryset(self):
         '''
@@ -525,25 +617,18 @@ class GroupsList(BaseList):
            or an organization admin of an inventory they are in
            or when I have allowing read permissions via a user or team on an inventory they are in
         '''
-        base = Groups.objects
+        base = Group.objects
         if self.request.user.is_superuser:
             return base.all()
-        admin_of  = base.filter(inventory__organization__admins__in = [ self.request.user ]).distinct()
-        has_user_perms = base.filter(
-            inventory__permissions__user__in = [ self.request.user ],
-            inventory__permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        has_team_perms = base.filter(
-            inventory__permissions__team__in = self.request.user.teams.all(),
-            inventory__permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        return admin_of | has_user_perms | has_team_perms
+        return base.filter(inventory__accesses__user=self.request.user,
+                           inventory__accesses__can_read=True)
 
 class GroupsChildrenList(BaseSubList):
 
     model = Group
     serializer_class = GroupSerializer
     permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
     parent_model = Group
     relationship = 'children'
     postable = True
@@ -560,16 +645,28 @@ class GroupsChildrenList(BaseSubList):
         base = parent.children
         if self.request.user.is_superuser:
             return base.all()
-        admin_of  = base.filter(inventory__organization__admins__in = [ self.request.user ]).distinct()
-        has_user_perms = base.filter(
-            inventory__permissions__user__in = [ self.request.user ],
-            inventory__permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        has_team_perms = base.filter(
-            inventory__permissions__team__in = self.request.user.teams.all(),
-            inventory__permissions__permission_type__in = PERMISSION_TYPES_ALLOWING_INVENTORY_READ,
-        ).distinct()
-        return admin_of | has_user_perms | has_team_perms
+        return base.filter(inventory__accesses__user=self.request.user,
+                           inventory__accesses__can_read=True)
+
+class GroupsAllHostsList(BaseSubList):
+    ''' hosts in a group or any of the groups below it, at any depth '''
+
+    model = Host
+    serializer_class = HostSerializer
+    permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
+    parent_model = Group
+    relationship = 'hosts'
+    postable = False
+    etag_models = (Group,)
+
+    def _get_queryset(self):
+        parent = Group.objects.get(pk=self.kwargs['pk'])
+        base = Host.objects.filter(groups__ancestor_links__ancestor=parent).distinct()
+        if self.request.user.is_superuser:
+            return base
+        return base.filter(inventory__accesses__user=self.request.user,
+                           inventory__accesses__can_read=True)
 
 class GroupsDetail(BaseDetail):
 
@@ -582,6 +679,7 @@ class InventoryGroupsList(BaseSubList):
     model = Group
     serializer_class = GroupSerializer
     permission_classes = (CustomRbac,)
+    cursor_ordering = ('name', 'id')
     # to allow the sub-aspect listing
     parent_model = Inventory
     relationship = 'groups'
@@ -605,6 +703,7 @@ class GroupsVariableDetail(VariableBaseDetail):
     permission_classes = (CustomRbac,)
     parent_model = Group
     reverse_relationship = 'variable_data'
+    etag_models = (Group,)
     relationship = 'group'
 
 class HostsVariableDetail(VariableBaseDetail):
@@ -614,6 +713,7 @@ class HostsVariableDetail(VariableBaseDetail):
     permission_classes = (CustomRbac,)
     parent_model = Host
     reverse_relationship = 'variable_data'
+    etag_models = (Host,)
     relationship = 'host'
 
 class VariableDetail(BaseDetail):
@@ -625,5 +725,200 @@ class VariableDetail(BaseDetail):
     def put(self, request, *args, **kwargs):
         raise PermissionDenied()
 
+class LaunchJobStatusDetail(BaseDetail):
+
+    model = LaunchJobStatus
+    serializer_class = LaunchJobStatusSerializer
+    permission_classes = (CustomRbac,)
+
+    def put(self, request, *args, **kwargs):
+        raise PermissionDenied()
+
+class LaunchJobStatusCancel(generics.GenericAPIView):
+    '''
+    GET shows whether a launch job status can be canceled; POST stops the
+    job if it is pending or running.  A running playbook is stopped by its
+    worker within a few seconds.
+    '''
+
+    model = LaunchJobStatus
+    permission_classes = (CustomRbac,)
+
+    def item_permissions_check(self, request, obj):
+        if request.method == 'GET':
+            return LaunchJobStatus.can_user_read(request.user, obj)
+        if request.method == 'POST':
+            return LaunchJobStatus.can_user_administrate(request.user, obj)
+        return False
+
+    def get(self, request, *args, **kwargs):
+        obj = self.get_object()
+        return Response(dict(can_cancel=obj.can_cancel))
 
+    def post(self, request, *args, **kwargs):
+        obj = self.get_object()
+        if not obj.cancel():
+            return Response(status=status.HTTP_409_CONFLICT,
+                            data=dict(msg='launch job status is already %s' % obj.status))
+        return Response(status=status.HTTP_202_ACCEPTED, data=dict(status=obj.status))
+
+class LaunchJobStatusSlicesList(BaseSubList):
+    ''' statuses for each slice of a launch job split into slices '''
+
+    model = LaunchJobStatus
+    serializer_class = LaunchJobStatusSerializer
+    permission_classes = (CustomRbac,)
+    cursor_ordering = ('slice_index', 'id')
+    parent_model = LaunchJobStatus
+    relationship = 'slices'
+    postable = False
+
+    def _get_queryset(self):
+        parent = LaunchJobStatus.objects.get(pk=self.kwargs['pk'])
+        base = parent.slices.all()
+        if self.request.user.is_superuser:
+            return base
+        return base.filter(launch_job__inventory__accesses__user=self.request.user,
+                           launch_job__inventory__accesses__can_read=True)
+
+def parse_byte_range(header, size):
+    '''
+    Parse a Range header with a single byte range, returning the (first, last)
+    byte positions clipped to the size of the content, or None if the header
+    should be ignored.  The range can't be satisfied when first >= size.
+    '''
+    units, sep, spec = header.partition('=')
+    if units.strip() != 'bytes' or ',' in spec:
+        # multiple ranges aren't supported; just return everything
+        return None
+    first, sep, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # suffix range for the last N bytes
+            return max(size - int(last), 0), size - 1
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+        if last < first and first < size:
+            return None
+    except ValueError:
+        return None
+    return first, last
+
+def read_output_chunks(fileobj, start, length, chunk_size=65536):
+    ''' yield length bytes from fileobj starting at start, then close it '''
+    try:
+        fileobj.seek(start)
+        while length > 0:
+            data = fileobj.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+class LaunchJobStatusStdout(BaseDetail):
+    '''
+    Raw output from ansible-playbook for a launch job status, which keeps
+    growing while the job is running.  Output is streamed from the file, so
+    any part of a large log can be fetched without reading the rest:
+
+       Range: bytes=first-last      standard single range request (206)
+       ?offset=N&limit=N            output from offset N, for polling; the
+                                    X-Output-Offset header gives the offset
+                                    to request next
+       ?offset=N&wait=N             wait up to N seconds for output past
+                                    offset while the job is still running
+    '''
+
+    model = LaunchJobStatus
+    serializer_class = LaunchJobStatusSerializer
+    permission_classes = (CustomRbac,)
+    output_file_field = 'result_stdout_file'
+    output_field = 'result_stdout'
+
+    def put(self, request, *args, **kwargs):
+        raise PermissionDenied()
+
+    def destroy(self, request, *args, **kwargs):
+        raise PermissionDenied()
 
+    def open_output(self, obj):
+        ''' return an open file object with the output and its current size '''
+        path = getattr(obj, self.output_file_field)
+        if path and os.path.exists(path):
+            fileobj = file(path, 'rb')
+            # output written after this point is left for the next request
+            fileobj.seek(0, os.SEEK_END)
+            return fileobj, fileobj.tell()
+        # jobs that haven't started yet (or were run before output was saved
+        # to files) only have output in the database
+        data = getattr(obj, self.output_field).encode('utf-8')
+        return StringIO(data), len(data)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # rest_framework only accepts an HttpResponse, not a streaming one
+        if isinstance(response, StreamingHttpResponse):
+            for key, value in self.headers.items():
+                response[key] = value
+            return response
+        return super(LaunchJobStatusStdout, self).finalize_response(request, response, *args, **kwargs)
+
+    def output_response(self, fileobj, start, end, status=200):
+        response = StreamingHttpResponse(read_output_chunks(fileobj, start, end - start),
+                                         status=status, content_type='text/plain; charset=utf-8')
+        response['Content-Length'] = str(end - start)
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    def get(self, request, *args, **kwargs):
+        obj = self.get_object()
+        if 'offset' in request.QUERY_PARAMS:
+            return self.get_from_offset(request, obj)
+        fileobj, size = self.open_output(obj)
+        byte_range = None
+        if 'HTTP_RANGE' in request.META:
+            byte_range = parse_byte_range(request.META['HTTP_RANGE'], size)
+        if byte_range is None:
+            return self.output_response(fileobj, 0, size)
+        first, last = byte_range
+        if first >= size:
+            fileobj.close()
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        response = self.output_response(fileobj, first, last + 1,
+                                        status=status.HTTP_206_PARTIAL_CONTENT)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        return response
+
+    def get_from_offset(self, request, obj):
+        max_limit = getattr(settings, 'JOB_OUTPUT_PAGE_SIZE', 1048576)
+        max_wait = getattr(settings, 'JOB_OUTPUT_MAX_WAIT', 30)
+        try:
+            offset = max(int(request.QUERY_PARAMS['offset']), 0)
+            limit = int(request.QUERY_PARAMS.get('limit', max_limit))
+            wait = float(request.QUERY_PARAMS.get('wait', 0))
+        except ValueError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if limit <= 0 or limit > max_limit:
+            limit = max_limit
+        deadline = time.time() + min(wait, max_wait)
+        fileobj, size = self.open_output(obj)
+        while size <= offset and obj.status in ('pending', 'running') and time.time() < deadline:
+            fileobj.close()
+            time.sleep(0.5)
+            obj = LaunchJobStatus.objects.get(pk=obj.pk)
+            fileobj, size = self.open_output(obj)
+        start = min(offset, size)
+        end = min(offset + limit, size)
+        response = self.output_response(fileobj, start, end)
+        response['X-Output-Offset'] = str(end)
+        response['X-Output-Size'] = str(size)
+        response['X-Launch-Job-Status'] = obj.status
+        return response
+
+class LaunchJobStatusStderr(LaunchJobStatusStdout):
+
+    output_file_field = 'result_stderr_file'
+    output_field = 'result_stderr'
@@ -0,0 +1,32 @@
+# Copyright (c) 2013 AnsibleWorks, Inc.
+#
+# This file is part of Ansible Commander
+#
+# Ansible Commander is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from lib.main.scheduler import defer_scheduling, run_deferred_scheduling
+
+class LaunchJobSchedulerMiddleware(object):
+    '''
+    Holds off scheduling launch jobs started or canceled during a request
+    until the request's transaction has been committed, since the scheduler
+    commits as it admits jobs.  Must come before TransactionMiddleware.
+    '''
+
+    def process_request(self, request):
+        defer_scheduling()
+
+    def process_response(self, request, response):
+        run_deferred_scheduling()
+        return response
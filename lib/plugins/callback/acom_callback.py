@@ -30,8 +30,10 @@
 # OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY 
 # OF SUCH DAMAGE.
 
+import atexit
 import json
 import os
+import socket
 import subprocess
 import sys
 
@@ -42,11 +44,62 @@ class CallbackModule(object):
 
     def __init__(self):
         self.acom_callback_event_script = os.getenv('ACOM_CALLBACK_EVENT_SCRIPT')
+        self.acom_callback_event_socket = os.getenv('ACOM_CALLBACK_EVENT_SOCKET')
+        self.acom_callback_event_spool = os.getenv('ACOM_CALLBACK_EVENT_SPOOL')
+        self.acom_callback_event_spool_batch = int(os.getenv('ACOM_CALLBACK_EVENT_SPOOL_BATCH', 50))
+        self._socket = None
+        self._socket_pid = None
+        self._spool_queue = []
+        self._pid = os.getpid()
+        if self.acom_callback_event_spool:
+            atexit.register(self._flush_spool)
+
+    def _get_socket(self):
+        # Runner events are sent from forked worker processes, so open one
+        # connection per process instead of sharing the parent's socket.
+        if self._socket is None or self._socket_pid != os.getpid():
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.acom_callback_event_socket)
+            self._socket_pid = os.getpid()
+        return self._socket
+
+    def _write_spool(self, data):
+        # Append with a single write so lines from concurrent processes
+        # don't interleave.
+        fd = os.open(self.acom_callback_event_spool,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _flush_spool(self):
+        if self._spool_queue and os.getpid() == self._pid:
+            data, self._spool_queue = ''.join(self._spool_queue), []
+            self._write_spool(data)
+
+    def _spool_event(self, message):
+        if os.getpid() != self._pid:
+            # Forked workers exit without running atexit handlers, so write
+            # their events right away (and leave any events inherited from
+            # the main process for it to write).
+            self._write_spool(message + '\n')
+        else:
+            self._spool_queue.append(message + '\n')
+            if len(self._spool_queue) >= self.acom_callback_event_spool_batch:
+                self._flush_spool()
 
     def _log_event(self, event, **event_data):
-        event_data_json = json.dumps(event_data)
-        cmdline = [self.acom_callback_event_script, '-e', event, '-d', event_data_json]
-        subprocess.check_call(cmdline)
+        if self.acom_callback_event_spool:
+            message = json.dumps({'event': event, 'event_data': event_data})
+            self._spool_event(message)
+        elif self.acom_callback_event_socket:
+            message = json.dumps({'event': event, 'event_data': event_data})
+            self._get_socket().sendall(message + '\n')
+        else:
+            event_data_json = json.dumps(event_data)
+            cmdline = [self.acom_callback_event_script, '-e', event, '-d', event_data_json]
+            subprocess.check_call(cmdline)
 
     def on_any(self, *args, **kwargs):
         pass
@@ -117,5 +170,7 @@ class CallbackModule(object):
         for attr in ('changed', 'dark', 'failures', 'ok', 'processed', 'skipped'):
             d[attr] = getattr(stats, attr)
         self._log_event('playbook_on_stats', **d)
+        if self.acom_callback_event_spool:
+            self._flush_spool()
 
 
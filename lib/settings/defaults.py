@@ -16,6 +16,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import datetime
 import os
 import sys
 
@@ -117,6 +118,8 @@ TEMPLATE_CONTEXT_PROCESSORS += (
 MIDDLEWARE_CLASSES += (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'lib.middleware.exceptions.ExceptionMiddleware',
+    # launch jobs are scheduled once the request's transaction is committed
+    'lib.middleware.scheduler.LaunchJobSchedulerMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     # middleware loaded after this point will be subject to transactions
 )
@@ -178,3 +181,79 @@ CELERYD_TASK_TIME_LIMIT = 600
 CELERYD_TASK_SOFT_TIME_LIMIT = 540
 CELERYBEAT_SCHEDULER = 'djcelery.schedulers.DatabaseScheduler'
 CELERYBEAT_MAX_LOOP_INTERVAL = 60
+
+# Callback events received while a launch job runs are saved in batches of up
+# to this many events, or after this many seconds, whichever comes first.
+CALLBACK_EVENT_BATCH_SIZE = 100
+CALLBACK_EVENT_BATCH_INTERVAL = 1.0
+
+# Write callback events to a per-job spool file instead of sending them
+# directly to the database, then load the file once the playbook finishes.
+CALLBACK_EVENT_SPOOL = False
+CALLBACK_EVENT_SPOOL_DIR = os.path.join(BASE_DIR, 'spool')
+
+# Output from ansible-playbook is streamed to files in this directory while a
+# launch job runs; only the last JOB_OUTPUT_TAIL_SIZE bytes of stdout/stderr
+# are also stored on the launch job status.
+JOB_OUTPUT_DIR = os.path.join(BASE_DIR, 'job_output')
+JOB_OUTPUT_TAIL_SIZE = 65536
+
+# Maximum bytes of job output returned per request when polling the stdout or
+# stderr resources by offset, and the longest a poll may wait for new output.
+JOB_OUTPUT_PAGE_SIZE = 1048576
+JOB_OUTPUT_MAX_WAIT = 30
+
+# How often (in seconds) a running launch job checks whether it has been
+# canceled, and how long the playbook has to exit after SIGTERM before it
+# (and everything it started) is sent SIGKILL.
+JOB_CANCEL_POLL_INTERVAL = 1.0
+JOB_CANCEL_KILL_TIMEOUT = 5.0
+
+# ssh-agents started for launch job credentials are kept by each worker for
+# SSH_AGENT_TTL seconds after their last job finishes (0 to stop them right
+# away), up to SSH_AGENT_POOL_SIZE idle agents.  An agent is only given to
+# new jobs for SSH_AGENT_TTL seconds after it starts, and drops its key once
+# the last of those jobs must have finished.
+SSH_AGENT_TTL = 300
+SSH_AGENT_POOL_SIZE = 50
+
+# Git projects (scm_type 'git') are mirrored in this directory, with the
+# files for each revision used by launch jobs extracted next to the mirror;
+# only the PROJECT_CHECKOUT_KEEP most recently used revisions are kept.  Set
+# to an empty string to run playbooks from where they are without syncing.
+PROJECT_CHECKOUT_DIR = ''
+PROJECT_CHECKOUT_KEEP = 5
+
+# Cached --list output for each inventory is kept in this directory, and
+# rebuilt when hosts, groups or their variables change.  Set to an empty
+# string to always build the inventory from the database.
+INVENTORY_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'inventory_snapshots')
+
+# Maximum number of distinct sets of host/group variables kept parsed in
+# memory by each process.
+VARIABLE_DATA_CACHE_SIZE = 10000
+
+# Maximum number of launch jobs running at once, overall and against any one
+# inventory or project (0 for no limit).  Further jobs stay pending until one
+# finishes, and are started in order of priority, then in the order launched.
+LAUNCH_JOB_MAX_RUNNING = 10
+LAUNCH_JOB_MAX_RUNNING_PER_INVENTORY = 0
+LAUNCH_JOB_MAX_RUNNING_PER_PROJECT = 0
+
+# Lock file held while deciding which pending launch jobs to start, so
+# processes starting jobs at the same time don't exceed the limits.
+LAUNCH_JOB_SCHEDULER_LOCK = os.path.join(BASE_DIR, 'launch_job_scheduler.lock')
+
+# Launch jobs that started running more than this many seconds ago and
+# still haven't finished are marked as errors, so jobs whose worker died
+# don't hold their slot forever (0 to never give up).  The
+# scheduler also runs every LAUNCH_JOB_REAP_INTERVAL seconds from celerybeat
+# to notice them when no other jobs are starting or finishing.
+LAUNCH_JOB_REAP_TIMEOUT = CELERYD_TASK_TIME_LIMIT + 300
+LAUNCH_JOB_REAP_INTERVAL = 60
+CELERYBEAT_SCHEDULE = {
+    'schedule-launch-jobs': {
+        'task': 'schedule_launch_jobs',
+        'schedule': datetime.timedelta(seconds=LAUNCH_JOB_REAP_INTERVAL),
+    },
+}
@@ -58,16 +58,20 @@ views_InventoryList                = views.InventoryList.as_view()
 views_InventoryDetail              = views.InventoryDetail.as_view()
 views_InventoryHostsList           = views.InventoryHostsList.as_view()
 views_InventoryGroupsList          = views.InventoryGroupsList.as_view()
+views_InventoryBulk                = views.InventoryBulk.as_view()
 
 # group service
 views_GroupsList                   = views.GroupsList.as_view()
 views_GroupsDetail                 = views.GroupsDetail.as_view()
 views_GroupsVariableDetail         = views.GroupsVariableDetail.as_view()
 views_GroupsChildrenList           = views.GroupsChildrenList.as_view()
+views_GroupsAllHostsList           = views.GroupsAllHostsList.as_view()
 
 # host service
 views_HostsList                    = views.HostsList.as_view()
 views_HostsDetail                  = views.HostsDetail.as_view()
+views_HostsAllGroupsList           = views.HostsAllGroupsList.as_view()
+views_HostsEffectiveVariableDetail = views.HostsEffectiveVariableDetail.as_view()
 views_HostsVariableDetail          = views.HostsVariableDetail.as_view()
 
 # seperate variable data
@@ -78,6 +82,11 @@ views_VariableDetail               = views.VariableDetail.as_view()
 # events services
 
 # jobs services
+views_LaunchJobStatusDetail        = views.LaunchJobStatusDetail.as_view()
+views_LaunchJobStatusStdout        = views.LaunchJobStatusStdout.as_view()
+views_LaunchJobStatusStderr        = views.LaunchJobStatusStderr.as_view()
+views_LaunchJobStatusSlicesList    = views.LaunchJobStatusSlicesList.as_view()
+views_LaunchJobStatusCancel        = views.LaunchJobStatusCancel.as_view()
 
 # tags service
 views_TagsDetail                   = views.TagsDetail.as_view()
@@ -133,18 +142,22 @@ urlpatterns = patterns('',
     url(r'^api/v1/inventories/(?P<pk>[0-9]+)/$',                  views_InventoryDetail),
     url(r'^api/v1/inventories/(?P<pk>[0-9]+)/hosts/$',            views_InventoryHostsList),
     url(r'^api/v1/inventories/(?P<pk>[0-9]+)/groups/$',           views_InventoryGroupsList),
+    url(r'^api/v1/inventories/(?P<pk>[0-9]+)/bulk/$',             views_InventoryBulk),
 
     # host service
     url(r'^api/v1/hosts/$',                                       views_HostsList),
     url(r'^api/v1/hosts/(?P<pk>[0-9]+)/$',                        views_HostsDetail),
+    url(r'^api/v1/hosts/(?P<pk>[0-9]+)/all_groups/$',             views_HostsAllGroupsList),
 
     # group service
     url(r'^api/v1/groups/$',                                      views_GroupsList),
     url(r'^api/v1/groups/(?P<pk>[0-9]+)/$',                       views_GroupsDetail),
     url(r'^api/v1/groups/(?P<pk>[0-9]+)/children/$',              views_GroupsChildrenList),
+    url(r'^api/v1/groups/(?P<pk>[0-9]+)/all_hosts/$',             views_GroupsAllHostsList),
 
     # variable data
     url(r'^api/v1/hosts/(?P<pk>[0-9]+)/variable_data/$',          views_HostsVariableDetail),
+    url(r'^api/v1/hosts/(?P<pk>[0-9]+)/effective_variables/$',    views_HostsEffectiveVariableDetail),
     url(r'^api/v1/groups/(?P<pk>[0-9]+)/variable_data/$',         views_GroupsVariableDetail),
     url(r'^api/v1/variable_data/(?P<pk>[0-9]+)/$',                views_VariableDetail),
 
@@ -154,7 +167,11 @@ urlpatterns = patterns('',
     # /jobs/
     # /jobs/N/
     # /job_statuses/
-    # /job_statuses/N/
+    url(r'^api/v1/launch_job_statuses/(?P<pk>[0-9]+)/$',          views_LaunchJobStatusDetail),
+    url(r'^api/v1/launch_job_statuses/(?P<pk>[0-9]+)/stdout/$',   views_LaunchJobStatusStdout),
+    url(r'^api/v1/launch_job_statuses/(?P<pk>[0-9]+)/stderr/$',   views_LaunchJobStatusStderr),
+    url(r'^api/v1/launch_job_statuses/(?P<pk>[0-9]+)/slices/$',   views_LaunchJobStatusSlicesList),
+    url(r'^api/v1/launch_job_statuses/(?P<pk>[0-9]+)/cancel/$',   views_LaunchJobStatusCancel),
 
     # tags service
     url(r'^api/v1/tags/(?P<pk>[0-9]+)/$',                         views_TagsDetail),